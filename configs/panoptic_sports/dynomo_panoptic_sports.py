@@ -36,6 +36,44 @@ config = dict(
     stride=1,
     kNN=20,
     gt_w2c=False,
+    neighbors=dict(
+        backend='faiss', # 'faiss', 'kdtree' (batched CPU KD-tree), 'voxel' (pure torch voxel grid, CPU or GPU)
+        persistent_index=False, # Keep segment memberships and per-segment FAISS indices (on the CPU) across frames, only added, removed and moved Gaussians are (re-)inserted, used by the per-segment search (single_pass=False)
+        single_pass=True, # Search all segments with one segmented kNN call
+        ann=None, # Exact search if None, else e.g. dict(type='hnsw', M=32, ef_search=64) or dict(type='ivf', nlist=1024, nprobe=16)
+        recall_every=0, # Measure recall@k of the approximate search every x frames
+        rerank_chunk_elements=2**24, # Max gathered feature elements per chunk when re-ranking by rgb / embeddings
+        refresh=None, # e.g. dict(max_drift=50, budget=10000) to re-query at most budget neighborhoods with relative drift > max_drift % per frame
+    ),
+    trajectory_store=dict(
+        chunk_size=16, # Frames per chunk of the append-only per-frame histories
+        memmap=False, # Keep closed chunks in memory-mapped files in <workdir>/<run_name>/trajectories
+        precision=dict( # Storage precision of closed chunks (float32, float16, bfloat16 or uint8), reduced precision changes the saved histories
+            rgb_colors='float32',
+            log_scales='float32',
+            unnorm_rotations='float32',
+            means3D='float32',
+            visibility='float32'),
+    ),
+    growth_buffers=dict(
+        in_place=True, # Grow per-Gaussian parameters, Adam moments and variables in reserved capacity
+        growth_factor=2.0, # Capacity is re-allocated to growth_factor times the live Gaussians once full
+    ),
+    optimizer=dict(
+        persistent=True, # Keep the Adam optimizer of each tracking phase across frames, re-bound to the current parameters
+        warm_start=False, # Keep the Adam moments of surviving Gaussians across frames instead of zeroing them
+        active_set=False, # Only optimize the rows of Gaussians of the current frame for parameters with turned off grads of old Gaussians
+    ),
+    render=dict(
+        single_pass=False, # Render depth, silhouette, bg and embeddings with the RGB pass: one C-channel pass with backend 'torch' (equivalent), composited from the top-K RGB contributors with backend 'cuda' (different loss: no gradients through the blending weights to means, scales and opacities)
+        backend='cuda', # 'cuda' (diff_gaussian_rasterization_w_dwv) or 'torch' (pure torch rasterizer, CPU or GPU)
+        cull_frustum=True, # Only rasterize Gaussians that are born and not culled by the camera frustum, shared by all passes
+    ),
+    pyramid=dict(
+        scales=[], # Integer downsampling factors of the coarse levels, coarsest first, e.g., [4, 2], empty to track at full resolution only
+        iter_fracs=[], # Fraction of the iterations of a tracking phase per coarse level, e.g., [0.2, 0.3], the remaining ones run at full resolution
+        phases=['tracking_obj', 'tracking_cam'], # Tracking phases that run the coarse levels first
+    ),
     wandb=dict(
         project="DynoSplaTAM",
         group=group_name,
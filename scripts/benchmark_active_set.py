@@ -0,0 +1,132 @@
+import os
+import sys
+sys.path.append(os.getcwd())
+import argparse
+import time
+import json
+
+import torch
+
+from src.utils.active_set import ActiveSet
+
+
+def make_problem(num_gauss, active_ratio, device):
+    # Gaussians of the current frame are appended at the end
+    num_active = max(1, int(num_gauss * active_ratio))
+    timestep = torch.zeros(num_gauss, device=device)
+    timestep[num_gauss - num_active:] = 1
+    params = {
+        'means3D': torch.randn(num_gauss, 3, device=device),
+        'rgb_colors': torch.rand(num_gauss, 3, device=device),
+        'log_scales': torch.randn(num_gauss, 1, device=device),
+        'logit_opacities': torch.randn(num_gauss, 1, device=device),
+        'embeddings': torch.randn(num_gauss, 32, device=device)}
+    target = {k: torch.randn_like(v) for k, v in params.items()}
+    return params, target, timestep
+
+
+def to_parameters(init):
+    return {k: torch.nn.Parameter(v.clone().requires_grad_(True)) for k, v in init.items()}
+
+
+def get_loss(params, target):
+    # per-Gaussian terms and a term mixing all Gaussians like the rendering loss
+    loss = sum(((params[k] - target[k]) ** 2).mean() for k in params.keys())
+    return loss + (params['means3D'] * params['rgb_colors']).sum(dim=1).mean() ** 2
+
+
+def get_hook(should_be_disabled):
+    def hook(grad):
+        grad = grad.clone()
+        grad[should_be_disabled, :] = 0
+        return grad
+    return hook
+
+
+def synchronize(device):
+    if device != 'cpu':
+        torch.cuda.synchronize(device)
+
+
+def hook_path(init, target, timestep, keys, num_iters, lr):
+    # previous path: gradients of old Gaussians are zeroed with hooks on the full parameters
+    params = to_parameters(init)
+    hooks = [params[k].register_hook(get_hook(timestep != 1)) for k in keys]
+    optimizer = torch.optim.Adam(params.values(), lr=lr)
+    for _ in range(num_iters):
+        loss = get_loss(params, target)
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+    for h in hooks:
+        h.remove()
+    return params
+
+
+def active_set_path(init, target, timestep, keys, num_iters, lr):
+    params = to_parameters(init)
+    active_set = ActiveSet(params, keys, timestep == 1)
+    optimizer = torch.optim.Adam(active_set.optimizer_params(params).values(), lr=lr)
+    for _ in range(num_iters):
+        params = active_set.assemble(params)
+        loss = get_loss(params, target)
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+    return active_set.merge(params)
+
+
+def time_func(func, device):
+    func()
+    synchronize(device)
+    if device != 'cpu':
+        torch.cuda.reset_peak_memory_stats(device)
+    base = torch.cuda.memory_allocated(device) if device != 'cpu' else 0
+    start = time.time()
+    out = func()
+    synchronize(device)
+    peak = torch.cuda.max_memory_allocated(device) - base if device != 'cpu' else float('nan')
+    return time.time() - start, peak / 2**20, out
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_gauss", type=int, nargs='+', default=[10000, 100000, 1000000], help="Number of Gaussians.")
+    parser.add_argument("--active_ratio", type=float, default=0.05, help="Ratio of Gaussians of the current frame.")
+    parser.add_argument("--keys", type=str, nargs='+', default=['rgb_colors', 'log_scales', 'logit_opacities', 'embeddings'], help="Parameters with turned off grads of old Gaussians.")
+    parser.add_argument("--num_iters", type=int, default=50, help="Number of iterations.")
+    parser.add_argument("--lr", type=float, default=0.001, help="Learning rate.")
+    parser.add_argument("--device", type=str, default="cuda:0" if torch.cuda.is_available() else "cpu", help="Device to run on.")
+    parser.add_argument("--out", type=str, default=None, help="Optional json file to write results to.")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    results = list()
+    for num_gauss in args.num_gauss:
+        torch.manual_seed(0)
+        init, target, timestep = make_problem(num_gauss, args.active_ratio, args.device)
+        t_hook, mem_hook, params_hook = time_func(
+            lambda: hook_path(init, target, timestep, args.keys, args.num_iters, args.lr), args.device)
+        t_active, mem_active, params_active = time_func(
+            lambda: active_set_path(init, target, timestep, args.keys, args.num_iters, args.lr), args.device)
+        max_abs_diff = max((params_hook[k] - params_active[k]).abs().max().item() for k in init.keys())
+        result = {
+            'num_gauss': num_gauss,
+            'num_active': int((timestep == 1).sum().item()),
+            'hook_s': t_hook / args.num_iters,
+            'active_set_s': t_active / args.num_iters,
+            'speedup': t_hook / t_active,
+            'hook_peak_mb': mem_hook,
+            'active_set_peak_mb': mem_active,
+            'max_abs_diff': max_abs_diff}
+        print(f"{num_gauss} Gaussians ({result['num_active']} active): hooks {result['hook_s']*1000:.3f}ms/iter ({mem_hook:.1f}MB), " \
+              f"active set {result['active_set_s']*1000:.3f}ms/iter ({mem_active:.1f}MB), " \
+              f"speedup {result['speedup']:.2f}x, max abs diff {max_abs_diff:.2e}")
+        results.append(result)
+
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=4)
@@ -0,0 +1,149 @@
+import os
+import sys
+sys.path.append(os.getcwd())
+import argparse
+import time
+import json
+import resource
+from importlib.machinery import SourceFileLoader
+
+import numpy as np
+import torch
+
+from src.utils.neighbor_search import (
+    torch_3d_knn,
+    o3d_knn,
+    calculate_neighbors_seg,
+    calculate_neighbors_seg_single_pass,
+    calculate_neighbors_between_pc)
+
+
+def make_scene(num_pts, num_segs, emb_dim, new_ratio, device):
+    """
+    Synthetic Gaussian scene: points on the surfaces of spherical instances
+    with instance colors / embeddings and a fraction of new Gaussians.
+    """
+    centers = torch.rand(num_segs, 3, device=device)
+    radii = 0.02 + 0.1 * torch.rand(num_segs, device=device)
+    instseg = torch.randint(0, num_segs, (num_pts,), device=device)
+    directions = torch.nn.functional.normalize(torch.randn(num_pts, 3, device=device), dim=1)
+    means = centers[instseg] + radii[instseg].unsqueeze(1) * directions + \
+        0.002 * torch.randn(num_pts, 3, device=device)
+
+    colors = (torch.rand(num_segs, 3, device=device)[instseg] + 0.05 * torch.randn(num_pts, 3, device=device)).clamp(0, 1)
+    embeddings = torch.randn(num_segs, emb_dim, device=device)[instseg] + 0.1 * torch.randn(num_pts, emb_dim, device=device)
+    timestep = (torch.rand(num_pts, device=device) < new_ratio).float()
+
+    params = {
+        'means3D': means.contiguous(),
+        'rgb_colors': colors,
+        'embeddings': embeddings,
+        'instseg': instseg}
+    variables = {'timestep': timestep}
+    return params, variables
+
+
+def synchronize(device):
+    if device != 'cpu':
+        torch.cuda.synchronize(device)
+
+
+def peak_memory_mb(device):
+    if device != 'cpu':
+        return torch.cuda.max_memory_allocated(device) / 1024**2
+    # process peak resident memory, monotonic over the run
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def time_stage(func, num_pts, device, repeats):
+    func()
+    synchronize(device)
+    if device != 'cpu':
+        torch.cuda.reset_peak_memory_stats(device)
+    start = time.time()
+    for _ in range(repeats):
+        func()
+    synchronize(device)
+    run_time = (time.time() - start) / repeats
+    return {
+        'time_s': run_time,
+        'points_per_s': num_pts / run_time,
+        'peak_mem_mb': peak_memory_mb(device)}
+
+
+def get_stages(params, variables, args, device):
+    gpu_id = int(device.split(':')[-1]) if device != 'cpu' else 0
+    num_knn = int(args.kNN / args.stride)
+    time_mask = variables['timestep'] < 1
+    means = params['means3D']
+    other_params = {k: v.clone() for k, v in params.items()}
+    other_params['means3D'] = other_params['means3D'] + 0.001 * torch.randn_like(means)
+
+    kwargs = dict(
+        num_knn=num_knn,
+        dist_to_use=args.dist_to_use,
+        inflate=args.inflate,
+        primary_device=device if device != 'cpu' else 'cuda:0',
+        backend=args.backend)
+    stages = {
+        'torch_3d_knn': lambda: torch_3d_knn(
+            means, num_knn=int(args.inflate*num_knn)+1, gpu_id=gpu_id, backend=args.backend),
+        'calculate_neighbors_seg': lambda: calculate_neighbors_seg(
+            params, variables, time_mask, 1, **kwargs),
+        'calculate_neighbors_seg_single_pass': lambda: calculate_neighbors_seg_single_pass(
+            params, variables, time_mask, 1, **kwargs),
+        'calculate_neighbors_between_pc': lambda: calculate_neighbors_between_pc(
+            params, None, other_params=other_params, num_knn=num_knn, dist_to_use=args.dist_to_use,
+            inflate=args.inflate, primary_device=kwargs['primary_device'], backend=args.backend)}
+    if device == 'cpu':
+        means_np = means.numpy().astype(np.float64)
+        stages['o3d_knn'] = lambda: o3d_knn(means_np, num_knn)
+    return {k: v for k, v in stages.items() if args.stages is None or k in args.stages}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default=None, help="Optional experiment config to take kNN, stride, dist_to_use and backend from.")
+    parser.add_argument("--num_pts", type=int, nargs='+', default=[10000, 100000, 1000000], help="Scene sizes to benchmark, e.g., 10k to 5M.")
+    parser.add_argument("--num_segs", type=int, default=100, help="Number of instances.")
+    parser.add_argument("--emb_dim", type=int, default=32, help="Embedding dimension.")
+    parser.add_argument("--new_ratio", type=float, default=0.1, help="Fraction of new Gaussians in the current frame.")
+    parser.add_argument("--kNN", type=int, default=20, help="Number of neighbors.")
+    parser.add_argument("--stride", type=int, default=1, help="Stride, uses kNN/stride neighbors.")
+    parser.add_argument("--inflate", type=float, default=2, help="Candidates are inflate*kNN+1 closest points in l2.")
+    parser.add_argument("--dist_to_use", type=str, default="embeddings", help="'l2', 'rgb' or 'embeddings'.")
+    parser.add_argument("--backend", type=str, default="faiss", help="Neighbor search backend.")
+    parser.add_argument("--stages", type=str, nargs='+', default=None, help="Only run these stages.")
+    parser.add_argument("--repeats", type=int, default=3, help="Number of timed repeats.")
+    parser.add_argument("--device", type=str, default="cpu", help="Device to run on.")
+    parser.add_argument("--out", type=str, default=None, help="Optional json file to write results to.")
+    args = parser.parse_args()
+
+    if args.config is not None:
+        config = SourceFileLoader(os.path.basename(args.config), args.config).load_module().config
+        args.kNN = config['kNN']
+        args.stride = config['stride']
+        args.dist_to_use = config['dist_to_use']
+        args.backend = config.get('neighbors', dict()).get('backend', args.backend)
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    torch.manual_seed(0)
+
+    results = list()
+    for num_pts in args.num_pts:
+        params, variables = make_scene(
+            num_pts, args.num_segs, args.emb_dim, args.new_ratio, args.device)
+        result = {'num_pts': num_pts, 'stages': dict()}
+        for name, func in get_stages(params, variables, args, args.device).items():
+            result['stages'][name] = time_stage(func, num_pts, args.device, args.repeats)
+            print(f"{num_pts} points, {name}: {result['stages'][name]['time_s']:.4f}s, " \
+                  f"{result['stages'][name]['points_per_s']:.0f} points/s, " \
+                  f"peak memory {result['stages'][name]['peak_mem_mb']:.1f}MB")
+        results.append(result)
+
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f, indent=4)
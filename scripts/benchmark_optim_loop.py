@@ -0,0 +1,144 @@
+import os
+import sys
+sys.path.append(os.getcwd())
+import argparse
+import time
+import json
+
+import torch
+
+from src.model.optimization import LossMonitor
+from src.model.logger import Logger
+
+
+class DummyRun():
+    # collects what would be logged to wandb
+    def __init__(self):
+        self.logged = list()
+
+    def log(self, log_dict):
+        self.logged.append(log_dict)
+
+
+def make_problem(num_gauss, device):
+    target = torch.randn(num_gauss, 4, device=device)
+    rot = torch.nn.Parameter(torch.randn(num_gauss, 4, device=device))
+    trans = torch.nn.Parameter(torch.randn(num_gauss, 3, device=device))
+    return target, {'rot': rot, 'trans': trans}
+
+
+def get_losses(params, target):
+    losses = {
+        'rot': ((params['rot'] - target) ** 2).mean(),
+        'trans': (params['trans'] ** 2).mean(),
+        'rigid': (params['rot'][:, :3] - params['trans']).abs().mean()}
+    return sum(losses.values()), losses
+
+
+def synchronize(device):
+    if device != 'cpu':
+        torch.cuda.synchronize(device)
+
+
+def readback_every_iter(params, target, num_iters, lr, wandb_run):
+    # previous loop: early_check, best candidate and loss report read back every iteration
+    optimizer = torch.optim.Adam(params.values(), lr=lr)
+    candidate = params['rot'].detach().clone()
+    current_min_loss = float(1e20)
+    last_loss, early_stop_count = 1000, 0
+    for it in range(num_iters):
+        loss, losses = get_losses(params, target)
+        loss.backward()
+        wandb_run.log({f"Per Iteration Object Tracking/{k}": v.item() for k, v in losses.items()})
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+        with torch.no_grad():
+            if loss < current_min_loss:
+                current_min_loss = loss
+                candidate = params['rot'].detach().clone()
+        if abs(last_loss - loss.detach().clone().item()) < 0.0001:
+            early_stop_count += 1
+            if early_stop_count == 20:
+                break
+        else:
+            early_stop_count = 0
+        last_loss = loss.detach().clone().item()
+    return it, candidate
+
+
+def deferred_readback(params, target, num_iters, lr, wandb_run):
+    optimizer = torch.optim.Adam(params.values(), lr=lr)
+    logger = Logger({'use_wandb': True}, wandb_run, None)
+    loss_monitor = LossMonitor()
+    loss_monitor.reset_best(rot=params['rot'])
+    for it in range(num_iters):
+        loss, losses = get_losses(params, target)
+        loss.backward()
+        logger.report_loss(losses, wandb_run, it, obj_tracking=True)
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+        with torch.no_grad():
+            loss_monitor.update_best(loss, rot=params['rot'])
+        if loss_monitor.early_check(loss):
+            break
+    logger.flush_losses(wandb_run)
+    return it, loss_monitor.candidates['rot'], loss_monitor.num_readbacks
+
+
+def time_func(func, device):
+    synchronize(device)
+    start = time.time()
+    out = func()
+    synchronize(device)
+    return time.time() - start, out
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_gauss", type=int, nargs='+', default=[1000, 100000], help="Number of Gaussians.")
+    parser.add_argument("--num_iters", type=int, default=2000, help="Max iterations, early stopping ends the loop before.")
+    parser.add_argument("--lr", type=float, default=0.001, help="Learning rate.")
+    parser.add_argument("--device", type=str, default="cuda:0" if torch.cuda.is_available() else "cpu", help="Device to run on.")
+    parser.add_argument("--out", type=str, default=None, help="Optional json file to write results to.")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    results = list()
+    for num_gauss in args.num_gauss:
+        torch.manual_seed(0)
+        target, params = make_problem(num_gauss, args.device)
+        init = {k: v.detach().clone() for k, v in params.items()}
+        run_sync = DummyRun()
+        t_sync, (it_sync, cand_sync) = time_func(
+            lambda: readback_every_iter(params, target, args.num_iters, args.lr, run_sync), args.device)
+        final_sync = {k: v.detach().clone() for k, v in params.items()}
+
+        with torch.no_grad():
+            for k, v in params.items():
+                v.copy_(init[k])
+        run_deferred = DummyRun()
+        t_deferred, (it_deferred, cand_deferred, num_readbacks) = time_func(
+            lambda: deferred_readback(params, target, args.num_iters, args.lr, run_deferred), args.device)
+
+        identical = it_sync == it_deferred and torch.equal(cand_sync, cand_deferred) \
+            and all(torch.equal(final_sync[k], v.detach()) for k, v in params.items()) \
+            and [{k: v for k, v in d.items() if not k.endswith('/step')} for d in run_deferred.logged] == run_sync.logged
+        result = {
+            'num_gauss': num_gauss,
+            'iterations': it_sync + 1,
+            'readback_every_iter_s': t_sync / (it_sync + 1),
+            'deferred_s': t_deferred / (it_deferred + 1),
+            'speedup': (t_sync / (it_sync + 1)) / (t_deferred / (it_deferred + 1)),
+            'early_stop_readbacks': num_readbacks,
+            'identical': identical}
+        print(f"{num_gauss} Gaussians, {it_sync + 1} iterations: every iteration {result['readback_every_iter_s']*1000:.3f}ms/iter, " \
+              f"deferred {result['deferred_s']*1000:.3f}ms/iter ({num_readbacks} early stop readbacks), " \
+              f"speedup {result['speedup']:.2f}x, identical {identical}")
+        results.append(result)
+
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=4)
@@ -0,0 +1,87 @@
+import os
+import sys
+sys.path.append(os.getcwd())
+import argparse
+import time
+import json
+
+import torch
+
+from src.utils.neighbor_search import torch_3d_knn, segmented_knn
+
+
+def make_points(num_pts, num_segs, device):
+    pts = torch.rand(num_pts, 3, device=device)
+    # spatially coherent segments: assign points to closest random center
+    centers = torch.rand(num_segs, 3, device=device)
+    seg = torch.cat([torch.cdist(p, centers).argmin(dim=1) for p in pts.split(2**16)])
+    return pts.contiguous(), seg
+
+
+def synchronize(device):
+    if device != 'cpu':
+        torch.cuda.synchronize(device)
+
+
+def per_segment_knn(pts, seg, num_knn, gpu_id):
+    # search as done per segment in calculate_neighbors_seg
+    aranged_idx = torch.arange(pts.shape[0], device=pts.device)
+    distances = torch.zeros(pts.shape[0], num_knn, device=pts.device)
+    indices = torch.zeros(pts.shape[0], num_knn, dtype=torch.long, device=pts.device)
+    for inst in seg.unique():
+        bin_mask = seg == inst
+        dist, idx = torch_3d_knn(pts[bin_mask].contiguous(), num_knn=num_knn, gpu_id=gpu_id)
+        distances[bin_mask] = dist
+        indices[bin_mask] = aranged_idx[bin_mask][idx]
+    return distances, indices
+
+
+def time_func(func, device, repeats):
+    func()
+    synchronize(device)
+    start = time.time()
+    for _ in range(repeats):
+        out = func()
+    synchronize(device)
+    return (time.time() - start) / repeats, out
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_pts", type=int, default=200000, help="Number of points.")
+    parser.add_argument("--num_segs", type=int, nargs='+', default=[1, 10, 100, 1000, 5000], help="Segment counts to benchmark.")
+    parser.add_argument("--num_knn", type=int, default=41, help="Number of neighbors, i.e., inflate*kNN+1.")
+    parser.add_argument("--repeats", type=int, default=3, help="Number of timed repeats.")
+    parser.add_argument("--device", type=str, default="cuda:0", help="Device to run on.")
+    parser.add_argument("--out", type=str, default=None, help="Optional json file to write results to.")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    gpu_id = int(args.device.split(':')[-1]) if args.device != 'cpu' else 0
+    torch.manual_seed(0)
+
+    results = list()
+    for num_segs in args.num_segs:
+        pts, seg = make_points(args.num_pts, num_segs, args.device)
+        t_loop, (dist_loop, idx_loop) = time_func(
+            lambda: per_segment_knn(pts, seg, args.num_knn, gpu_id), args.device, args.repeats)
+        t_single, (dist_single, idx_single) = time_func(
+            lambda: segmented_knn(pts, seg, pts, num_knn=args.num_knn, k_seg=seg, fill_missing_with_last=True),
+            args.device, args.repeats)
+        result = {
+            'num_pts': args.num_pts,
+            'num_segs': num_segs,
+            'per_segment_s': t_loop,
+            'single_pass_s': t_single,
+            'speedup': t_loop / t_single,
+            'identical_rows': (idx_loop == idx_single).all(dim=1).float().mean().item(),
+            'max_abs_dist_diff': (dist_loop - dist_single).abs().max().item()}
+        print(f"{num_segs} segments: per segment {t_loop:.4f}s, single pass {t_single:.4f}s, " \
+              f"speedup {result['speedup']:.2f}x, identical rows {result['identical_rows']*100:.2f}%")
+        results.append(result)
+
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=4)
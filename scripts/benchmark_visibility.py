@@ -0,0 +1,101 @@
+import os
+import sys
+sys.path.append(os.getcwd())
+import argparse
+import time
+import json
+
+import torch
+
+from src.model.feature_renderer import accumulate_visibility
+
+
+def make_contributors(num_gauss, num_contrib, width, height, empty_ratio, device):
+    # Gaussian ids and blending weights per pixel as returned by the rasterizer
+    visible = torch.randint(1, num_gauss, (num_contrib, height, width), dtype=torch.int32, device=device)
+    visible[torch.rand(visible.shape, device=device) < empty_ratio] = 0
+    weight = torch.rand(num_contrib, height, width, device=device)
+    weight[visible == 0] = 0
+    return visible, weight
+
+
+def clone_unique_visibility(visible, weight, num_gauss):
+    # previous RenderHelper.compute_visibility (thresh), torch_scatter.scatter_add
+    # replaced by the equivalent scatter_add_
+    w, h, contrib = visible.shape[2], visible.shape[1], visible.shape[0]
+    vis_pix_flat = visible.detach().clone().reshape(contrib, -1).permute(1, 0).flatten().long()
+    weight_pix_flat = weight.detach().clone().reshape(contrib, -1).permute(1, 0).flatten()
+    pix_id = torch.arange(w * h).unsqueeze(1).repeat(1, contrib).flatten()
+    weight_pix_flat = weight_pix_flat[vis_pix_flat!=0]
+    pix_id = pix_id[vis_pix_flat!=0]
+    vis_pix_flat = vis_pix_flat[vis_pix_flat!=0]
+    weight_sum_per_gauss = torch.zeros(num_gauss).to(weight_pix_flat.device)
+    summed = torch.zeros(int(vis_pix_flat.max()) + 1, device=weight_pix_flat.device).scatter_add_(
+        0, vis_pix_flat, weight_pix_flat)
+    weight_sum_per_gauss[torch.unique(vis_pix_flat)] = summed[torch.unique(vis_pix_flat)]
+    return weight_sum_per_gauss
+
+
+def synchronize(device):
+    if device != 'cpu':
+        torch.cuda.synchronize(device)
+
+
+def time_func(func, device, repeats):
+    func()
+    synchronize(device)
+    if device != 'cpu':
+        torch.cuda.reset_peak_memory_stats(device)
+    base = torch.cuda.memory_allocated(device) if device != 'cpu' else 0
+    start = time.time()
+    for _ in range(repeats):
+        out = func()
+    synchronize(device)
+    peak = torch.cuda.max_memory_allocated(device) - base if device != 'cpu' else float('nan')
+    return (time.time() - start) / repeats, peak / 2**20, out
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_gauss", type=int, default=500000, help="Number of Gaussians.")
+    parser.add_argument("--num_contrib", type=int, nargs='+', default=[20, 60, 100], help="Contributors per pixel to benchmark.")
+    parser.add_argument("--width", type=int, default=455, help="Image width.")
+    parser.add_argument("--height", type=int, default=240, help="Image height.")
+    parser.add_argument("--empty_ratio", type=float, default=0.5, help="Ratio of empty contributor slots.")
+    parser.add_argument("--max_elements", type=int, default=2**22, help="Contributor entries per tile.")
+    parser.add_argument("--repeats", type=int, default=5, help="Number of timed repeats.")
+    parser.add_argument("--device", type=str, default="cuda:0" if torch.cuda.is_available() else "cpu", help="Device to run on.")
+    parser.add_argument("--out", type=str, default=None, help="Optional json file to write results to.")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    torch.manual_seed(0)
+
+    results = list()
+    for num_contrib in args.num_contrib:
+        visible, weight = make_contributors(
+            args.num_gauss, num_contrib, args.width, args.height, args.empty_ratio, args.device)
+        t_clone, mem_clone, vis_clone = time_func(
+            lambda: clone_unique_visibility(visible, weight, args.num_gauss), args.device, args.repeats)
+        t_tiled, mem_tiled, vis_tiled = time_func(
+            lambda: accumulate_visibility(visible, weight, args.num_gauss, max_elements=args.max_elements),
+            args.device, args.repeats)
+        result = {
+            'num_gauss': args.num_gauss,
+            'num_contrib': num_contrib,
+            'clone_unique_s': t_clone,
+            'tiled_s': t_tiled,
+            'speedup': t_clone / t_tiled,
+            'clone_unique_peak_mb': mem_clone,
+            'tiled_peak_mb': mem_tiled,
+            'max_abs_diff': (vis_clone - vis_tiled).abs().max().item()}
+        print(f"{num_contrib} contributors: clone+unique {t_clone:.4f}s ({mem_clone:.1f}MB), " \
+              f"tiled {t_tiled:.4f}s ({mem_tiled:.1f}MB), speedup {result['speedup']:.2f}x, " \
+              f"max abs diff {result['max_abs_diff']:.2e}")
+        results.append(result)
+
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=4)
@@ -0,0 +1,133 @@
+import os
+import sys
+sys.path.append(os.getcwd())
+import argparse
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from src.utils.camera_helpers import setup_camera, Camera
+from src.model.feature_renderer import TorchRasterizer
+try:
+    from diff_gaussian_rasterization_w_dwv import GaussianRasterizer as Renderer
+except ImportError:
+    Renderer = None
+
+
+def make_fixture(num_gauss, width, height, device):
+    """
+    Synthetic Gaussians in front of an identity camera, fixed by the seed.
+    """
+    k = torch.tensor([[0.8 * width, 0, width / 2], [0, 0.8 * width, height / 2], [0, 0, 1]])
+    cam = setup_camera(width, height, k, np.eye(4), device=device)
+    means3D = torch.randn(num_gauss, 3, device=device) * torch.tensor([0.6, 0.4, 0.5], device=device)
+    means3D[:, 2] += 3
+    rendervar = {
+        'means3D': means3D,
+        'means2D': torch.zeros_like(means3D, requires_grad=True) + 0,
+        'opacities': torch.rand(num_gauss, 1, device=device),
+        'scales': torch.exp(torch.rand(num_gauss, 3, device=device) * 2 - 5),
+        'rotations': F.normalize(torch.randn(num_gauss, 4, device=device)),
+        'colors_precomp': torch.rand(num_gauss, 3, device=device)}
+    return cam, rendervar
+
+
+def fixture_inputs(cam, rendervar):
+    # inputs of the fixture, s.t. the comparison does not depend on the random generator of the device
+    return {
+        'width': np.array(int(cam.image_width)),
+        'height': np.array(int(cam.image_height)),
+        'viewmatrix': cam.viewmatrix.cpu().numpy(),
+        'projmatrix': cam.projmatrix.cpu().numpy(),
+        'tanfovx': np.array(float(cam.tanfovx)),
+        'tanfovy': np.array(float(cam.tanfovy)),
+        'campos': cam.campos.cpu().numpy(),
+        **{k: v.detach().cpu().numpy() for k, v in rendervar.items() if k != 'means2D'}}
+
+
+def load_fixture(fixture, device):
+    cam = Camera(
+        image_height=int(fixture['height']),
+        image_width=int(fixture['width']),
+        tanfovx=float(fixture['tanfovx']),
+        tanfovy=float(fixture['tanfovy']),
+        bg=torch.zeros(3, dtype=torch.float32, device=device),
+        scale_modifier=1.0,
+        viewmatrix=torch.from_numpy(fixture['viewmatrix']).to(device),
+        projmatrix=torch.from_numpy(fixture['projmatrix']).to(device),
+        sh_degree=0,
+        campos=torch.from_numpy(fixture['campos']).to(device),
+        prefiltered=False)
+    rendervar = {k: torch.from_numpy(fixture[k]).to(device) for k in
+                 ['means3D', 'opacities', 'scales', 'rotations', 'colors_precomp']}
+    rendervar['means2D'] = torch.zeros_like(rendervar['means3D'], requires_grad=True) + 0
+    return cam, rendervar
+
+
+def render(rasterizer, rendervar):
+    rendervar['means2D'].retain_grad()
+    im, radius, _, weight, visible = rasterizer(**rendervar)
+    im.sum().backward()
+    return {
+        'im': im.detach().cpu().numpy(),
+        'radius': radius.cpu().numpy(),
+        'weight_sum': weight.sum(dim=0).detach().cpu().numpy(),
+        'means2D_grad': rendervar['means2D'].grad[:, :2].cpu().numpy()}
+
+
+def compare(name, result, reference, atol):
+    ok = True
+    for k in result.keys():
+        diff = np.abs(result[k].astype(np.float64) - reference[k].astype(np.float64)).max()
+        ok = ok and diff <= atol
+        print(f"{name} {k}: max abs difference {diff}")
+    return ok
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Parity of the torch rasterizer backend with a fixture and the CUDA rasterizer.")
+    parser.add_argument("--num_gauss", type=int, default=2000)
+    parser.add_argument("--width", type=int, default=96)
+    parser.add_argument("--height", type=int, default=64)
+    parser.add_argument("--device", type=str, default='cuda:0' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument("--fixture", type=str, default=None, help="npz with inputs and reference outputs of the CUDA rasterizer, e.g., tests/fixtures/rasterizer_parity_cuda.npz")
+    parser.add_argument("--save_fixture", action='store_true', help="write the inputs and the CUDA rasterizer outputs to --fixture")
+    parser.add_argument("--atol", type=float, default=1e-4)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    ok = True
+
+    torch.manual_seed(0)
+    cam, rendervar = make_fixture(args.num_gauss, args.width, args.height, args.device)
+    result = render(TorchRasterizer(raster_settings=cam), rendervar)
+
+    if Renderer is not None and args.device != 'cpu':
+        torch.manual_seed(0)
+        cam, rendervar = make_fixture(args.num_gauss, args.width, args.height, args.device)
+        inputs = fixture_inputs(cam, rendervar)
+        reference = render(Renderer(raster_settings=cam), rendervar)
+        ok = compare('cuda', result, reference, args.atol) and ok
+        if args.fixture is not None and args.save_fixture:
+            # reference outputs of the CUDA rasterizer for tests/test_rasterizer_parity.py
+            os.makedirs(os.path.dirname(os.path.abspath(args.fixture)), exist_ok=True)
+            np.savez(args.fixture, **inputs, **{f"ref_{k}": v for k, v in reference.items()})
+            print(f"Saved fixture to {args.fixture}")
+    elif args.save_fixture:
+        raise RuntimeError("The fixture holds outputs of the CUDA rasterizer, run with diff_gaussian_rasterization_w_dwv on a GPU.")
+    else:
+        print("CUDA rasterizer not available, skipped parity with the cuda backend")
+
+    if args.fixture is not None and not args.save_fixture:
+        # torch backend on the fixture inputs against the CUDA reference outputs
+        fixture = dict(np.load(args.fixture))
+        cam, rendervar = load_fixture(fixture, args.device)
+        ok = compare('fixture', render(TorchRasterizer(raster_settings=cam), rendervar), {
+            k[len('ref_'):]: v for k, v in fixture.items() if k.startswith('ref_')}, args.atol) and ok
+
+    print("Parity OK" if ok else "Parity FAILED")
+    sys.exit(0 if ok else 1)
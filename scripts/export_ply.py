@@ -1,10 +1,14 @@
 import os
+import sys
+sys.path.append(os.getcwd())
 import argparse
 from importlib.machinery import SourceFileLoader
 
 import numpy as np
 from plyfile import PlyData, PlyElement
 
+from src.utils.trajectory_store import TrajectoryStore
+
 # Spherical harmonic constant
 C0 = 0.28209479177387814
 
@@ -17,6 +21,12 @@ def spherical_harmonic_to_rgb(sh):
     return sh*C0 + 0.5
 
 
+def get_frame(traj, time_idx):
+    if isinstance(traj, TrajectoryStore):
+        return traj.frame(time_idx).numpy()
+    return traj[:, :, time_idx]
+
+
 def save_ply(path, means, scales, rotations, rgbs, opacities, normals=None, timestamp=1):
     if normals is None:
         normals = np.zeros_like(means)
@@ -58,14 +68,18 @@ if __name__ == "__main__":
 
     print('Loading...')
     params = dict(np.load(args.params_path, allow_pickle=True))
+    for k, v in params.items():
+        if v.dtype.kind == 'U':
+            # memory-mapped trajectory store
+            params[k] = TrajectoryStore.load(str(v))
     print('Loaded!!!')
     for timestamp in range(params['means3D'].shape[2]):
         if timestamp != 0 and timestamp != 100:
             continue
-        means = params['means3D'][:, :, timestamp][params['timestep']<=timestamp]
-        scales = params['log_scales'][:, :, timestamp][params['timestep']<=timestamp]
-        rotations = params['unnorm_rotations'][:, :, timestamp][params['timestep']<=timestamp]
-        rgbs = params['rgb_colors'][:, :, timestamp][params['timestep']<=timestamp]
+        means = get_frame(params['means3D'], timestamp)[params['timestep']<=timestamp]
+        scales = get_frame(params['log_scales'], timestamp)[params['timestep']<=timestamp]
+        rotations = get_frame(params['unnorm_rotations'], timestamp)[params['timestep']<=timestamp]
+        rgbs = get_frame(params['rgb_colors'], timestamp)[params['timestep']<=timestamp]
         opacities = params['logit_opacities'][params['timestep']<=timestamp]
 
         ply_path = os.path.join(os.path.dirname(args.params_path), 'splats', f"splat_{timestamp}.ply")
@@ -12,6 +12,7 @@ import open3d as o3d
 from sklearn.decomposition import PCA
 import copy
 from src.utils.viz_utils import make_vid, get_cam_poses
+from src.utils.trajectory_store import TrajectoryStore, get_frame
 
 
 class RenderingEvaluator():
@@ -44,7 +45,7 @@ class RenderingEvaluator():
     def save_pc(final_params_time, save_dir, time_idx, time_mask):
         pcd = o3d.geometry.PointCloud()
         v3d = o3d.utility.Vector3dVector
-        pcd.points = v3d(final_params_time['means3D'][:, :, time_idx][time_mask].cpu().numpy())
+        pcd.points = v3d(get_frame(final_params_time['means3D'], time_idx)[time_mask].cpu().numpy())
         o3d.io.write_point_cloud(filename=os.path.join(save_dir, "pc_{:04d}_all.xyz".format(time_idx)), pointcloud=pcd)
 
     def save_normalized(self, img, save_dir, time_idx, vmin=None, vmax=None, num_frames=100):
@@ -100,7 +101,7 @@ class RenderingEvaluator():
         
         print("Evaluating Final Parameters ...")
         if novel_view_mode is not None:
-            poses, name = get_cam_poses(novel_view_mode, dataset, self.config, num_frames, final_params['means3D'].device, final_params)
+            poses, name = get_cam_poses(novel_view_mode, dataset, self.config, num_frames, final_params['logit_opacities'].device, final_params)
             torch.save(poses.cpu(), os.path.join(self.eval_dir, f'poses_{name}.pth'))
             print('Store to', os.path.join(self.eval_dir, f'poses_{name}.pth'))
             print(f"Evaluating novel view in mode {novel_view_mode}!!")
@@ -113,7 +114,8 @@ class RenderingEvaluator():
         pca = None
         visibilities = list()
         for time_idx in tqdm(range(num_frames)):
-            final_params_time = copy.deepcopy(final_params)
+            # trajectory stores are only read, i.e., not copied per frame
+            final_params_time = {k: v if isinstance(v, TrajectoryStore) else copy.deepcopy(v) for k, v in final_params.items()}
             # Get RGB-D Data & Camera Parameters
             color, depth, intrinsics, pose, embeddings, bg, instseg = dataset[time_idx]
 
@@ -126,7 +128,7 @@ class RenderingEvaluator():
                 w2c = final_params_time['w2c']
             
             if not isinstance(w2c, torch.Tensor):
-                w2c = torch.from_numpy(w2c).to(final_params['means3D'].device)
+                w2c = torch.from_numpy(w2c).to(final_params['logit_opacities'].device)
 
             # Setup Camera
             cam = setup_camera(
@@ -134,7 +136,7 @@ class RenderingEvaluator():
                 color.shape[1],
                 intrinsics.cpu().numpy(),
                 w2c.detach().cpu().numpy(),
-                device=final_params_time['means3D'].device)
+                device=final_params_time['logit_opacities'].device)
             
             # Define current frame data
             curr_data = {
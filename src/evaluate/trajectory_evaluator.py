@@ -14,6 +14,16 @@ import imageio
 import cv2
 import flow_vis
 from src.utils.viz_utils import make_vid
+from src.utils.trajectory_store import TrajectoryStore, get_frame, get_trajectory
+
+
+# per-frame histories, read per frame or per queried Gaussian instead of densified
+TRAJECTORY_KEYS = ('means3D', 'unnorm_rotations', 'visibility', 'rgb_colors', 'log_scales')
+
+
+def copy_params(params):
+    # trajectory stores are only read, i.e., not copied
+    return {k: v if isinstance(v, TrajectoryStore) else copy.deepcopy(v) for k, v in params.items()}
 
 
 class TrajEvaluator():
@@ -49,7 +59,9 @@ class TrajEvaluator():
         self.traj_len = traj_len
         self.vis_trajs = vis_trajs
         self.get_proj_and_params(primary_device)
-        self.dev = self.params['means3D'].device
+        self.dev = self.params['logit_opacities'].device
+        # Gaussians of the histories the rows of the other params refer to
+        self.traj_ids = torch.arange(self.params['logit_opacities'].shape[0], device=self.dev)
         self.queries_first_t = queries_first_t
         print(f"\nEvaluating queries for time only {self.queries_first_t}")
         if 'davis' in self.config['data']["gradslam_data_cfg"].lower():
@@ -96,7 +108,8 @@ class TrajEvaluator():
             dataset='panoptic_sport'
         ):
 
-        copied_params = copy.deepcopy(self.params)
+        copied_params = copy_params(self.params)
+        copied_traj_ids = self.traj_ids.clone()
         # get GT
         gt_traj_2D = data['points']
         gt_traj_3D = data['trajs'] if 'trajs' in data.keys() else None
@@ -231,7 +244,8 @@ class TrajEvaluator():
                 traj_len=self.traj_len,
                 fps=self.fps)
         
-        self.params = copy.deepcopy(copied_params)    
+        self.params = copy_params(copied_params)
+        self.traj_ids = copied_traj_ids
         return metrics
     
     def best_x_idx(
@@ -333,8 +347,8 @@ class TrajEvaluator():
                 self.h, self.w = self.params["desired_height"].cpu().item(), self.params["desired_width"].cpu().item()
             else:
                 self.h, self.w = self.config["data"]["desired_image_height"], self.config["data"]["desired_image_width"]
-            self.proj_matrix = get_projection_matrix(self.w, self.h, k, w2c, device=self.params['means3D'].device).squeeze()
-            self.cam = setup_camera(self.w, self.h, k, w2c, device=self.params['means3D'].device)
+            self.proj_matrix = get_projection_matrix(self.w, self.h, k, w2c, device=self.params['logit_opacities'].device).squeeze()
+            self.cam = setup_camera(self.w, self.h, k, w2c, device=self.params['logit_opacities'].device)
         else:
             self.proj_matrix = self.cam.projmatrix.squeeze()
             self.h = self.cam.image_height
@@ -360,25 +374,30 @@ class TrajEvaluator():
         if search_fg_only:
             fg_mask = (self.params['bg'] < 0.5).squeeze()
             first_occurance = first_occurance[fg_mask]
+            self.traj_ids = self.traj_ids[fg_mask]
             for k in self.params.keys():
+                if k in TRAJECTORY_KEYS:
+                    continue
                 try:
                     self.params[k] = self.params[k][fg_mask]
                 except:
                     self.params[k] = self.params[k]
 
         # only search gaussians inializaed at t=0
-        params_gs_traj_3D = copy.deepcopy(self.params)
+        params_gs_traj_3D = copy_params(self.params)
         if only_t0:
             first = first_occurance==first_occurance.min().item()
         else:
             first = torch.ones_like(first_occurance, dtype=bool, device=self.dev)
-        params_gs_traj_3D['means3D'] = params_gs_traj_3D['means3D'][first]
-        params_gs_traj_3D['unnorm_rotations'] = params_gs_traj_3D['unnorm_rotations'][first]
-        params_vis = params_gs_traj_3D['visibility'][first]
+        first_ids = self.traj_ids[first]
         # get Gauss IDs
         gauss_ids = torch.zeros(start_pixels.shape[0] * self.best_x, device=self.dev).long()
         start_time_best_x = start_time[..., None].repeat((1, self.best_x)).flatten()
         for time in start_time.unique():
+            # frame of the histories of the searched Gaussians
+            params_gs_traj_3D['means3D'] = get_frame(self.params['means3D'], int(time), first_ids, device=self.dev)
+            params_gs_traj_3D['unnorm_rotations'] = get_frame(self.params['unnorm_rotations'], int(time), first_ids, device=self.dev)
+            params_vis = get_frame(self.params['visibility'], int(time), first_ids, device=self.dev)
             gaussians_start_time_t = self.render_helper.transform_to_frame(
                     params_gs_traj_3D,
                     time,
@@ -391,12 +410,12 @@ class TrajEvaluator():
                     self.proj_matrix, means3D_start, self.w, self.h, do_normalize=self.use_norm_pix)
                 gauss_ids[start_time_best_x==time] = self.find_closest_to_start_pixels(
                     means2D_start.float(),
-                    params_vis[:, time],
+                    params_vis,
                     start_pixels[start_time==time])
             else:
                 gauss_ids[start_time_best_x==time] = self.find_closest_to_start_pixels(
                     means3D_start.float(),
-                    params_vis[:, time],
+                    params_vis,
                     start_3D[start_time==time])
         # get Gauss tracks
         gs_traj_3D, unnorm_rotations, visibility = self.get_3D_trajs_for_track(
@@ -405,7 +424,7 @@ class TrajEvaluator():
         return gs_traj_3D, unnorm_rotations, visibility
 
     def get_2D_track_from_3D(self, gs_traj_3D, unnorm_rotations):
-        params_gs_traj_3D = copy.deepcopy(self.params)
+        params_gs_traj_3D = copy_params(self.params)
         params_gs_traj_3D['means3D'] = gs_traj_3D
 
         params_gs_traj_3D['unnorm_rotations'] = unnorm_rotations
@@ -426,7 +445,7 @@ class TrajEvaluator():
         return gs_traj_2D
 
     def get_2D_track_from_3D_for_vis(self, gs_traj_3D, unnorm_rotations):
-        params_gs_traj_3D = copy.deepcopy(self.params)
+        params_gs_traj_3D = copy_params(self.params)
         params_gs_traj_3D['means3D'] = gs_traj_3D
 
         params_gs_traj_3D['unnorm_rotations'] = unnorm_rotations
@@ -487,13 +506,15 @@ class TrajEvaluator():
                 traj_2D = list()
                 visibility = list()
                 gs_traj_2D_per_time_per_start_pix = list()
-                start_pix_params = copy.deepcopy(self.params)
+                start_pix_params = copy_params(self.params)
+                visible_ids = self.traj_ids[visible_means].reshape(-1)
                 for cam_time in range(self.params['means3D'].shape[2]):
                     gs_traj_2D_per_time_per_start_pix_per_cam_time = list()
                     for gauss_time in range(self.params['means3D'].shape[2]):
                         if not self.visuals and cam_time != gauss_time:
                             continue
-                        loc_3D = ((weight_means/weight_means.sum()).unsqueeze(1) * self.params['means3D'][visible_means, :, gauss_time]).sum(dim=0).unsqueeze(0).unsqueeze(-1)
+                        loc_3D = ((weight_means/weight_means.sum()).unsqueeze(1) * get_frame(
+                            self.params['means3D'], gauss_time, visible_ids, device=self.dev)).sum(dim=0).unsqueeze(0).unsqueeze(-1)
                         start_pix_params['means3D'] = loc_3D
                         start_pix_params['unnorm_rotations'] = torch.zeros(1, 4, 1).to(self.dev)
                         transformed_loc_3D = self.render_helper.transform_to_frame(
@@ -504,7 +525,8 @@ class TrajEvaluator():
                                 gauss_time_idx=0)
                         loc_2D = three2two(self.proj_matrix, transformed_loc_3D['means3D'], self.w, self.h, do_normalize=False).float()
                         if cam_time == gauss_time:
-                            visibility.append(((weight_means/weight_means.sum()) * self.params['visibility'][visible_means, gauss_time].squeeze()).sum())
+                            visibility.append(((weight_means/weight_means.sum()) * get_frame(
+                                self.params['visibility'], gauss_time, visible_ids, device=self.dev).squeeze()).sum())
                             traj_3D.append(loc_3D)
                             traj_2D.append(loc_2D)
                         if self.visuals:
@@ -607,28 +629,21 @@ class TrajEvaluator():
         return torch.stack(gauss_ids).squeeze()
             
     def get_3D_trajs_for_track(self, gauss_ids, return_all=False):
-        gs_traj_3D = list()
-        unnorm_rotations = list()
-        visibility = list()
-
-        for gauss_id in gauss_ids:
-            if gauss_id != -1:
-                gs_traj_3D.append(
-                        self.params['means3D'][gauss_id].squeeze())
-                unnorm_rotations.append(self.params['unnorm_rotations'][gauss_id].squeeze())
-                visibility.append(self.params['visibility'][gauss_id].squeeze())
-            else:
-                gs_traj_3D.append(
-                        (torch.ones_like(self.params['means3D'][0]).squeeze()*-1).to(self.dev))
-                unnorm_rotations.append(
-                    (torch.ones_like(self.params['unnorm_rotations'][0]).squeeze()*-1).to(self.dev))
-                visibility.append(
-                        (torch.zeros(self.params['means3D'].shape[2])).to(self.dev))
-
-        if return_all:
-            return torch.stack(gs_traj_3D), torch.stack(unnorm_rotations), torch.stack(visibility)
-        else:
-            return torch.stack(gs_traj_3D)
+        # only the trajectories of the tracked Gaussians are read
+        gauss_ids = gauss_ids.flatten()
+        valid = gauss_ids != -1
+        ids = self.traj_ids[gauss_ids[valid]]
+        num_frames = self.params['means3D'].shape[-1]
+
+        gs_traj_3D = -torch.ones((gauss_ids.shape[0], 3, num_frames), device=self.dev)
+        gs_traj_3D[valid] = get_trajectory(self.params['means3D'], ids, device=self.dev).reshape(-1, 3, num_frames)
+        if not return_all:
+            return gs_traj_3D
+        unnorm_rotations = -torch.ones((gauss_ids.shape[0], 4, num_frames), device=self.dev)
+        unnorm_rotations[valid] = get_trajectory(self.params['unnorm_rotations'], ids, device=self.dev).reshape(-1, 4, num_frames)
+        visibility = torch.zeros((gauss_ids.shape[0], num_frames), device=self.dev)
+        visibility[valid] = get_trajectory(self.params['visibility'], ids, device=self.dev).reshape(-1, num_frames)
+        return gs_traj_3D, unnorm_rotations, visibility
     
     def vis_grid_trajs(
             self,
@@ -24,10 +24,13 @@ from utils.losses import (
     get_l1_losses
 )
 from src.model.renderer import RenderHelper
+from src.utils.active_set import ActiveSet
+from src.utils.image_pyramid import ImagePyramid
 from utils.gaussian_utils import build_rotation, prune_gaussians, densify, normalize_quat, matrix_to_quaternion
-from src.utils.neighbor_search import calculate_neighbors_seg_after_init
+from src.utils.neighbor_search import calculate_neighbors_seg_after_init, knn_recall, refresh_neighbors
 
-from torch_scatter import scatter_add
+from torch_scatter import segment_csr
+from src.utils.trajectory_store import get_frame, set_frame
 import json
 
 # Make deterministic
@@ -70,6 +73,8 @@ class DynOMo():
         if config['data']['start_from_complete_pc']:
             config['data']['load_embeddings'] = False
             config['add_gaussians']['add_new_gaussians'] = False
+        if 'neighbors' not in config.keys():
+            config['neighbors'] = dict()
         self.config = config
 
         # Create Output Directories
@@ -189,18 +194,17 @@ class DynOMo():
         # DYNO LOSSES
         if iter_time_idx > 0:
             # print(variables['timestep'])
-            losses, offset_0 = physics_based_losses(
+            losses = physics_based_losses(
                 self.scene.params,
                 iter_time_idx,
                 transformed_gaussians,
                 self.scene.variables,
-                self.scene.variables['offset_0'],
                 iter,
                 use_iso=True,
                 update_iso=True, 
                 device=self.device,
-                losses=losses)
-            self.scene.variables['offset_0'] = offset_0
+                losses=losses,
+                prev_frame=self.scene.prev_frame)
         
         weighted_losses = {k: v * config['loss_weights'][k] for k, v in losses.items()}
         loss = sum(weighted_losses.values())
@@ -232,13 +236,13 @@ class DynOMo():
         mask = (curr_time_idx - self.scene.variables['timestep'] >= 1).squeeze()
         with torch.no_grad():
             if delta_tran[mask].shape[0]:
-                # Gaussian kNN, point translation
-                weight = self.scene.variables['neighbor_weight_sm'].unsqueeze(1)
-                torch.use_deterministic_algorithms(False)
-                kNN_trans = scatter_add(
-                        weight * delta_tran[self.scene.variables['neighbor_indices']],
-                        self.scene.variables['self_indices'], dim=0)
-                torch.use_deterministic_algorithms(True)
+                # Gaussian kNN, point translation, reduced per CSR row
+                graph = self.scene.variables['neighbor_graph']
+                weight = graph.weight_sm.unsqueeze(1)
+                kNN_trans = torch.zeros_like(delta_tran)
+                kNN_trans[:graph.num_rows] = segment_csr(
+                        weight * delta_tran.index_select(0, graph.indices),
+                        graph.offsets.long())
                 point_trans = delta_tran
 
                 return kNN_trans, point_trans
@@ -309,22 +313,22 @@ class DynOMo():
                 time_2 = curr_time_idx
                 
                 # forward prop rotation
-                rot_2 = normalize_quat(self.scene.variables['unnorm_rotations'][:, :, time_2].detach().clone())                                                                                                                                  
-                rot_1 = normalize_quat(self.scene.variables['unnorm_rotations'][:, :, time_1].detach().clone())
+                rot_2 = normalize_quat(get_frame(self.scene.variables['unnorm_rotations'], time_2).detach().clone())                                                                                                                                  
+                rot_1 = normalize_quat(get_frame(self.scene.variables['unnorm_rotations'], time_1).detach().clone())
                 if not simple_rot:
                     rot_1_inv = rot_1.clone()
                     rot_1_inv[:, 1:] = -1 * rot_1_inv[:, 1:]
                     delta_rot = quat_mult(rot_2, rot_1_inv)
-                    curr_rot = normalize_quat(self.scene.variables['unnorm_rotations'][:, :, curr_time_idx].detach().clone())
+                    curr_rot = normalize_quat(get_frame(self.scene.variables['unnorm_rotations'], curr_time_idx).detach().clone())
                     new_rot = quat_mult(delta_rot, curr_rot)[mask]
                     new_rot = torch.nn.Parameter(new_rot.to(self.device).float().contiguous().requires_grad_(True))
                 else:
                     new_rot = torch.nn.functional.normalize(rot_2 + (rot_2 - rot_1))
                 self.scene.params['unnorm_rotations'][mask, :] = new_rot
 
-                # forward prop translation
-                tran_2 = self.scene.variables['means3D'][:, :, time_2].detach().clone().to(self.device)
-                tran_1 = self.scene.variables['means3D'][:, :, time_1].detach().clone().to(self.device)
+                # forward prop translation, the current frame is cached on the device as previous frame of the next
+                tran_2 = self.scene.prev_frame.get(self.scene.variables, curr_time_idx + 1).means
+                tran_1 = get_frame(self.scene.variables['means3D'], time_1).detach().clone().to(self.device)
                 if not simple_trans:
                     delta_rot_mat = build_rotation(delta_rot).squeeze()
                     new_tran = torch.bmm(delta_rot_mat, tran_2.unsqueeze(2)).squeeze() - \
@@ -332,7 +336,7 @@ class DynOMo():
                 else:
                     delta_tran = tran_2 - tran_1       
                     kNN_trans, point_trans = self.get_kNN_trans(curr_time_idx, delta_tran)
-                    curr_tran = self.scene.variables['means3D'][:, :, curr_time_idx].detach().clone().to(self.device)
+                    curr_tran = tran_2
                     if self.config['mov_init_by'] == 'kNN':
                         new_tran = (curr_tran + kNN_trans)[mask]
                     elif self.config['mov_init_by'] == 'per_point':
@@ -364,6 +368,15 @@ class DynOMo():
         if self.num_frames == -1 or self.num_frames > len(self.dataset):
             self.num_frames = len(self.dataset)
 
+    def load_render_helper(self):
+        # Rendering options shared by tracking and evaluation
+        render_config = self.config.get('render', dict())
+        self.render_helper = RenderHelper(
+            self.device,
+            single_pass=render_config.get('single_pass', False),
+            backend=render_config.get('backend', 'cuda'),
+            cull_frustum=render_config.get('cull_frustum', True))
+
     def init_Gaussian_scne(self):
         # init Gaussian scene 
         self.scene = GaussianScene(self.config, self.render_helper, self.dataset.load_embeddings, self.num_frames, self.device, self.eval_dir)
@@ -404,7 +417,6 @@ class DynOMo():
                 data=self.dataset[0],
                 w2c=self.dataset.first_time_w2c.to(self.device))
             self.scene.variables['first_frame_w2c'] = first_frame_w2c
-            self.scene.variables['offset_0'] = None
             time_idx = 0
 
         return first_frame_w2c, time_idx, final_params
@@ -427,12 +439,15 @@ class DynOMo():
             'w2c': self.first_frame_w2c,
             'bg': bg,
             'instseg': instseg}
+
+        # downsampled targets of the coarse-to-fine schedule
+        curr_data['pyramid'] = self.pyramid.build(curr_data, self.device)
         
         return curr_data
         
     def eval(self, novel_view_mode=None, eval_renderings=True, eval_traj=True, vis_trajs=True, vis_grid=False, vis_fg_only=True, best_x=1, alpha_traj=False, traj_len=10):
         self.load_dataset()
-        self.render_helper = RenderHelper(self.device)
+        self.load_render_helper()
         self.first_frame_w2c, _, _ = self.init_Gaussian_scne()
         self.rendering_evaluator = RenderingEvaluator(
             self.device,
@@ -508,9 +523,14 @@ class DynOMo():
 
     def track(self):
         self.load_dataset()
-        self.render_helper = RenderHelper(self.device)
+        self.load_render_helper()
         self.first_frame_w2c, start_time_idx, final_params = self.init_Gaussian_scne()
-        self.optim_handler = OptimHandler(self.config)
+        self.optim_handler = OptimHandler(self.config, buffers=self.scene.buffers)
+        pyramid_config = self.config['pyramid'] if 'pyramid' in self.config.keys() else dict()
+        self.pyramid = ImagePyramid(
+            scales=pyramid_config.get('scales', []),
+            iter_fracs=pyramid_config.get('iter_fracs', []),
+            phases=pyramid_config.get('phases', ['tracking_obj', 'tracking_cam']))
         self.rendering_evaluator = RenderingEvaluator(
             self.device,
             self.wandb_run,
@@ -557,6 +577,9 @@ class DynOMo():
             save_params_ckpt(self.scene.params, self.scene.variables, ckpt_output_dir, time_idx)
 
         self.logger.log_time_stats()
+        self.logger.log_trajectory_precision({
+            k: self.scene.variables[k].precision_stats()
+            for k in ['visibility', 'rgb_colors', 'log_scales', 'means3D', 'unnorm_rotations']})
 
         # Add Camera Parameters to Save them
         self.scene.update_params_for_saving(
@@ -614,6 +637,14 @@ class DynOMo():
             _ = self.optimize_gaussians(
                 time_idx,
                 curr_data)
+
+        # copy volume of growing / compacting per-Gaussian tensors in this frame
+        copied_bytes, appended_bytes = self.scene.buffers.pop_stats()
+        self.logger.log_param_copies(copied_bytes, appended_bytes, time_idx)
+        self.logger.log_raster_passes(*self.render_helper.pop_pass_stats(), time_idx)
+        self.logger.log_transform_cache(*self.render_helper.pop_transform_stats(), time_idx)
+        self.logger.log_culling(*self.render_helper.pop_cull_stats(), time_idx)
+        self.logger.log_optimizer_setup(*self.optim_handler.pop_stats(), time_idx)
         
         # Increment WandB Time Step
         if self.config['use_wandb']:
@@ -624,13 +655,51 @@ class DynOMo():
         
         if (time_idx < self.num_frames-1):
             with torch.no_grad():
+                # re-query drifted neighborhoods of existing Gaussians
+                refresh = self.config['neighbors'].get('refresh', None)
+                if refresh is not None and time_idx > 0:
+                    refresh_start_time = time.time()
+                    self.scene.variables, num_refreshed, num_drifted = refresh_neighbors(
+                        self.scene.params,
+                        self.scene.variables,
+                        time_idx,
+                        max_drift=refresh['max_drift'],
+                        budget=refresh['budget'],
+                        num_knn=int(self.config['kNN']/self.config['stride']),
+                        dist_to_use=self.config['dist_to_use'],
+                        primary_device=self.device,
+                        neighbor_index=self.scene.neighbor_index,
+                        single_pass=self.config['neighbors'].get('single_pass', False),
+                        backend=self.config['neighbors'].get('backend', 'faiss'),
+                        ann=self.config['neighbors'].get('ann', None),
+                        rerank_chunk_elements=self.config['neighbors'].get('rerank_chunk_elements', 2**24))
+                    self.logger.log_neighbor_refresh(
+                        num_refreshed, num_drifted, time.time() - refresh_start_time, time_idx)
+
                 self.scene.variables, to_remove = calculate_neighbors_seg_after_init(
                     self.scene.params,
                     self.scene.variables,
                     time_idx,
                     num_knn=int(self.config['kNN']/self.config['stride']),
                     dist_to_use=self.config['dist_to_use'],
-                    primary_device=self.device)
+                    primary_device=self.device,
+                    neighbor_index=self.scene.neighbor_index,
+                    single_pass=self.config['neighbors'].get('single_pass', False),
+                    backend=self.config['neighbors'].get('backend', 'faiss'),
+                    ann=self.config['neighbors'].get('ann', None),
+                    rerank_chunk_elements=self.config['neighbors'].get('rerank_chunk_elements', 2**24))
+
+                # recall of approximate kNN search wrt exact search
+                ann = self.config['neighbors'].get('ann', None)
+                recall_every = self.config['neighbors'].get('recall_every', 0)
+                if ann is not None and recall_every and time_idx % recall_every == 0:
+                    recall_stats = knn_recall(
+                        self.scene.params['means3D'].detach().contiguous(),
+                        num_knn=int(self.config['kNN']/self.config['stride']),
+                        ann=ann,
+                        gpu_id=int(self.device.split(':')[-1]),
+                        backend=self.config['neighbors'].get('backend', 'faiss'))
+                    self.logger.log_knn_recall(recall_stats, time_idx)
 
         if (time_idx < self.num_frames-1):
             # Initialize Gaussian poses for the next frame in params
@@ -656,34 +725,62 @@ class DynOMo():
         # get instance segementation mask for Gaussians
         tracking_start_time = time.time()
         
+        # only rows of Gaussians of this frame are trainable for parameters with turned off grads of old Gaussians
+        active_set = None
+        if self.optim_handler.active_set and time_idx > 0 \
+                and (config['disable_rgb_grads_old'] or config['make_grad_bg_smaller']) \
+                and not self.config['prune_densify']['prune_gaussians'] \
+                and not self.config['prune_densify']['use_gaussian_splatting_densification']:
+            active_set = ActiveSet(
+                self.scene.params,
+                [k for k in self.get_turned_off_grads(config, time_idx) if k != 'means3D'],
+                (self.scene.variables['timestep'] == time_idx).squeeze())
+
         # Reset Optimizer & Learning Rates for tracking
         optimizer = self.optim_handler.initialize_optimizer(
-            self.scene.params,
+            active_set.optimizer_params(self.scene.params) if active_set is not None else self.scene.params,
             lrs,
-            tracking=True)
+            tracking=True,
+            phase='tracking_obj',
+            fresh_keys=active_set.keys if active_set is not None else ())
         optimizer.zero_grad(set_to_none=True)
 
+        # early stopping and best candidate on the device, without readback every iteration
+        loss_monitor = self.optim_handler.loss_monitor()
         if config['take_best_candidate']:
             # Keep Track of Best Candidate Rotation & Translation
-            candidate_dyno_rot = self.scene.params['unnorm_rotations'][:, :].detach().clone()
-            candidate_dyno_trans = self.scene.params['means3D'][:, :].detach().clone()
-            current_min_loss = float(1e20)
+            loss_monitor.reset_best(
+                rot=self.scene.params['unnorm_rotations'][:, :],
+                trans=self.scene.params['means3D'][:, :])
 
         # Tracking Optimization
         iter = 0
         num_iters_tracking = config['num_iters'] if time_idx != 0 else config['num_iters_init']
         progress_bar = tqdm(range(num_iters_tracking), desc=f"Object Tracking Time Step: {time_idx}")
 
-        self.get_hooks(config, time_idx)
+        self.get_hooks(config, time_idx, skip=active_set.keys if active_set is not None else ())
+
+        # coarse-to-fine schedule
+        level_starts = self.pyramid.level_starts(num_iters_tracking, 'tracking_obj')
+        level = self.pyramid.get_level(iter, level_starts)
+        level_iters, level_times = [0] * len(level_starts), [0] * len(level_starts)
 
-        last_loss = 1000
-        early_stop_count = 0
         early_stop_eval = False
         while iter <= num_iters_tracking:
             iter_start_time = time.time()
+            if self.pyramid.get_level(iter, level_starts) != level:
+                # losses of different levels are not comparable
+                level = self.pyramid.get_level(iter, level_starts)
+                loss_monitor.reset_early()
+                if config['take_best_candidate'] and level == len(level_starts) - 1:
+                    loss_monitor.reset_best(
+                        rot=self.scene.params['unnorm_rotations'][:, :],
+                        trans=self.scene.params['means3D'][:, :])
+            if active_set is not None:
+                self.scene.params = active_set.assemble(self.scene.params)
             # Loss for current frame
             loss, losses, visible, weight = self.get_loss_gaussians(
-                curr_data,
+                self.pyramid.get_level_data(curr_data, level),
                 time_idx,
                 num_iters=num_iters_tracking,
                 iter=iter,
@@ -711,7 +808,9 @@ class DynOMo():
                         optimizer, 
                         iter,
                         self.config['prune_densify']['pruning_dict'],
-                        time_idx)
+                        time_idx,
+                        neighbor_index=self.scene.neighbor_index,
+                        buffers=self.scene.buffers)
                     if self.config['use_wandb']:
                         self.wandb_run.log({"Tracking Object/Number of Gaussians - Pruning": self.scene.params['means3D'].shape[0],
                                         "Mapping/step": self.wandb_mapping_step})
@@ -723,46 +822,60 @@ class DynOMo():
                         optimizer,
                         iter,
                         self.config['prune_densify']['densify_dict'],
-                        time_idx)
+                        time_idx,
+                        neighbor_index=self.scene.neighbor_index,
+                        buffers=self.scene.buffers)
                     if self.config['use_wandb']:
                         self.wandb_run.log({"Tracking Object/Number of Gaussians - Densification": self.scene.params['means3D'].shape[0],
                                         "Tracking Object/step": self.wandb_mapping_step})
                 if pruned or densified:
+                    self.scene.prev_frame.invalidate()
                     self.get_hooks(config, time_idx)
 
             # Optimizer Update
             optimizer.step()
             optimizer.zero_grad(set_to_none=True)
 
-            if config['take_best_candidate']:
+            if config['take_best_candidate'] and level == len(level_starts) - 1:
                 with torch.no_grad():
                     # Save the best candidate rotation & translation
-                    if loss < current_min_loss:
-                        current_min_loss = loss
-                        candidate_dyno_rot = self.scene.params['unnorm_rotations'][:, :, time_idx].detach().clone()
-                        candidate_dyno_trans = self.scene.params['means3D'][:, :, time_idx].detach().clone()
+                    loss_monitor.update_best(
+                        loss,
+                        rot=self.scene.params['unnorm_rotations'][:, :],
+                        trans=self.scene.params['means3D'][:, :])
             
             # Update the runtime numbers
             iter_end_time = time.time()
             self.logger.tracking_obj_iter_time_sum += iter_end_time - iter_start_time
             self.logger.tracking_obj_iter_time_count += 1
+            level_iters[level] += 1
+            level_times[level] += iter_end_time - iter_start_time
             # Check if we should stop tracking
             iter += 1
             if iter % 50 == 0:
                 progress_bar.update(50)
 
-            # early stopping
-            early_stop_eval, early_stop_count, last_loss = self.optim_handler.early_check(
-                early_stop_count, last_loss, loss, early_stop_eval)
-            if early_stop_eval:
+            # early stopping, continue at the next level if converged at a coarse one
+            early_stop_eval = loss_monitor.early_check(loss)
+            if early_stop_eval and level < len(level_starts) - 1:
+                iter = max(iter, level_starts[level + 1])
+                early_stop_eval = False
+            elif early_stop_eval:
                 break
 
         progress_bar.close()
+        if len(self.pyramid.scales):
+            self.logger.log_pyramid(
+                'tracking_obj', self.pyramid.scales + [1], level_iters, level_times, time_idx)
+        if active_set is not None:
+            self.scene.params = active_set.merge(self.scene.params)
+        if self.config['use_wandb']:
+            self.logger.flush_losses(self.wandb_run)
         if config['take_best_candidate']:
             # Copy over the best candidate rotation & translation
             with torch.no_grad():
-                self.scene.params['unnorm_rotations'] = candidate_dyno_rot
-                self.scene.params['means3D']= candidate_dyno_trans
+                self.scene.params['unnorm_rotations'].copy_(loss_monitor.candidates['rot'])
+                self.scene.params['means3D'].copy_(loss_monitor.candidates['trans'])
         
         # visibility
         with torch.no_grad():
@@ -776,8 +889,10 @@ class DynOMo():
                 last=True)
         
         optimizer.zero_grad(set_to_none=True)
-        self.scene.variables['visibility'][:, time_idx] = \
-            self.render_helper.compute_visibility(visible, weight, num_gauss=self.scene.params['means3D'].shape[0])
+        set_frame(
+            self.scene.variables['visibility'],
+            time_idx,
+            self.render_helper.compute_visibility(visible, weight, num_gauss=self.scene.params['means3D'].shape[0]))
             
         # update params
         for k in ['rgb_colors', 'log_scales', 'means3D', 'unnorm_rotations']:
@@ -796,24 +911,28 @@ class DynOMo():
 
         return optimizer
 
-    def get_hooks(self, config, time_idx):
+    def get_turned_off_grads(self, config, time_idx):
+        # get list to turn of grads
+        to_turn_off = []
+        if not config['loss_weights']['l1_opacity']:
+            to_turn_off.append('logit_opacities')          
+        if not config['loss_weights']['l1_bg']:
+            to_turn_off.append('bg')
+        if not config['loss_weights']['l1_embeddings'] or config['make_grad_bg_smaller']:
+            to_turn_off.append('embeddings')
+        if not config['loss_weights']['l1_scale']:
+            to_turn_off.append('log_scales')
+        if not config['loss_weights']['l1_rgb']:
+            to_turn_off.append('rgb_colors')
+        if config['make_grad_bg_smaller']:
+            to_turn_off.append('means3D')
+        if time_idx == 0:
+            print(f"Turning off {to_turn_off}.")
+        return to_turn_off
+
+    def get_hooks(self, config, time_idx, skip=()):
         if config['disable_rgb_grads_old'] or config['make_grad_bg_smaller']:
-            # get list to turn of grads
-            to_turn_off = []
-            if not config['loss_weights']['l1_opacity']:
-                to_turn_off.append('logit_opacities')          
-            if not config['loss_weights']['l1_bg']:
-                to_turn_off.append('bg')
-            if not config['loss_weights']['l1_embeddings'] or config['make_grad_bg_smaller']:
-                to_turn_off.append('embeddings')
-            if not config['loss_weights']['l1_scale']:
-                to_turn_off.append('log_scales')
-            if not config['loss_weights']['l1_rgb']:
-                to_turn_off.append('rgb_colors')
-            if config['make_grad_bg_smaller']:
-                to_turn_off.append('means3D')
-            if time_idx == 0:
-                print(f"Turning off {to_turn_off}.")
+            to_turn_off = self.get_turned_off_grads(config, time_idx)
             
             # remove old hooks
             if len(self.hook_list):
@@ -825,7 +944,7 @@ class DynOMo():
             for k, p in self.scene.params.items():
                 if 'cam' in k:
                     continue
-                if k not in to_turn_off:
+                if k not in to_turn_off or k in skip:
                     continue
                 if config['make_grad_bg_smaller'] and k in ["means3D"]:
                     self.hook_list.append(p.register_hook(get_hook(
@@ -847,28 +966,42 @@ class DynOMo():
         optimizer = self.optim_handler.initialize_optimizer(
             self.scene.params,
             self.config['tracking_cam']['lrs'],
-            tracking=True)
+            tracking=True,
+            phase='tracking_cam')
 
+        # early stopping and best candidate on the device, without readback every iteration
+        loss_monitor = self.optim_handler.loss_monitor()
         if self.config['tracking_cam']['take_best_candidate']:
             # Keep Track of Best Candidate Rotation & Translation
-            candidate_dyno_rot = self.scene.params['cam_unnorm_rots'][:, :, time_idx].detach().clone()
-            candidate_dyno_trans = self.scene.params['cam_trans'][:, :, time_idx].detach().clone()
-            current_min_loss = float(1e20)
+            loss_monitor.reset_best(
+                rot=self.scene.params['cam_unnorm_rots'][:, :, time_idx],
+                trans=self.scene.params['cam_trans'][:, :, time_idx])
 
         # Tracking Optimization
-        last_loss = 1000
-        early_stop_count = 0
         iter = 0
         num_iters_tracking = self.config['tracking_cam']['num_iters']
         progress_bar = tqdm(range(num_iters_tracking), desc=f"Camera Tracking Time Step: {time_idx}")
         restarted_tracking = False
         early_stop_eval = False
 
+        # coarse-to-fine schedule
+        level_starts = self.pyramid.level_starts(num_iters_tracking, 'tracking_cam')
+        level = self.pyramid.get_level(iter, level_starts)
+        level_iters, level_times = [0] * len(level_starts), [0] * len(level_starts)
+
         while iter <= num_iters_tracking:
             iter_start_time = time.time()
+            if self.pyramid.get_level(iter, level_starts) != level:
+                # losses of different levels are not comparable
+                level = self.pyramid.get_level(iter, level_starts)
+                loss_monitor.reset_early()
+                if self.config['tracking_cam']['take_best_candidate'] and level == len(level_starts) - 1:
+                    loss_monitor.reset_best(
+                        rot=self.scene.params['cam_unnorm_rots'][:, :, time_idx],
+                        trans=self.scene.params['cam_trans'][:, :, time_idx])
             # Loss for current frame
             loss, losses = self.get_loss_cam(
-                curr_data,
+                self.pyramid.get_level_data(curr_data, level),
                 time_idx,
                 config=self.config['tracking_cam'])
 
@@ -886,18 +1019,20 @@ class DynOMo():
             # Optimizer Update
             optimizer.step()
             optimizer.zero_grad(set_to_none=True)
-            if self.config['tracking_cam']['take_best_candidate'] and iter > 40:
+            if self.config['tracking_cam']['take_best_candidate'] and iter > 40 and level == len(level_starts) - 1:
                 with torch.no_grad():
                     # Save the best candidate rotation & translation
-                    if loss < current_min_loss:
-                        current_min_loss = loss
-                        candidate_dyno_rot = self.scene.params['cam_unnorm_rots'][:, :, time_idx].detach().clone()
-                        candidate_dyno_trans = self.scene.params['cam_trans'][:, :, time_idx].detach().clone()
+                    loss_monitor.update_best(
+                        loss,
+                        rot=self.scene.params['cam_unnorm_rots'][:, :, time_idx],
+                        trans=self.scene.params['cam_trans'][:, :, time_idx])
 
             # Update the runtime numbers
             iter_end_time = time.time()
             self.logger.tracking_cam_iter_time_sum += iter_end_time - iter_start_time
             self.logger.tracking_cam_iter_time_count += 1
+            level_iters[level] += 1
+            level_times[level] += iter_end_time - iter_start_time
             # Check if we should stop tracking
             iter += 1
             if iter % 50 == 0:
@@ -914,22 +1049,29 @@ class DynOMo():
                         'cam_trans'][:, :, time_idx-1].detach().clone()
 
                 if self.config['tracking_cam']['take_best_candidate']:
-                    current_min_loss = float(1e20)
-                    candidate_dyno_rot = self.scene.params['cam_unnorm_rots'][:, :, time_idx].detach().clone()
-                    candidate_dyno_trans = self.scene.params['cam_trans'][:, :, time_idx].detach().clone()
+                    loss_monitor.reset_best(
+                        rot=self.scene.params['cam_unnorm_rots'][:, :, time_idx],
+                        trans=self.scene.params['cam_trans'][:, :, time_idx])
             
-            # early stopping
-            early_stop_eval, early_stop_count, last_loss = self.optim_handler.early_check(
-                early_stop_count, last_loss, loss, early_stop_eval)
-            if early_stop_eval:
+            # early stopping, continue at the next level if converged at a coarse one
+            early_stop_eval = loss_monitor.early_check(loss)
+            if early_stop_eval and level < len(level_starts) - 1:
+                iter = max(iter, level_starts[level + 1])
+                early_stop_eval = False
+            elif early_stop_eval:
                 break
 
         progress_bar.close()
+        if len(self.pyramid.scales):
+            self.logger.log_pyramid(
+                'tracking_cam', self.pyramid.scales + [1], level_iters, level_times, time_idx)
+        if self.config['use_wandb']:
+            self.logger.flush_losses(self.wandb_run)
         if self.config['tracking_cam']['take_best_candidate']:
             # Copy over the best candidate rotation & translation
             with torch.no_grad():
-                self.scene.params['cam_unnorm_rots'][:, :, time_idx] = candidate_dyno_rot
-                self.scene.params['cam_trans'][:, :, time_idx] = candidate_dyno_trans
+                self.scene.params['cam_unnorm_rots'][:, :, time_idx] = loss_monitor.candidates['rot']
+                self.scene.params['cam_trans'][:, :, time_idx] = loss_monitor.candidates['trans']
 
         # Update the runtime numbers
         tracking_end_time = time.time()
@@ -948,6 +1090,7 @@ class DynOMo():
                                     time_idx,
                                     self.config['mean_sq_dist_method'],
                                     self.config['gaussian_distribution'])
+            self.scene.prev_frame.invalidate()
 
             post_num_pts = self.scene.params['means3D'].shape[0]
             if self.config['use_wandb']:
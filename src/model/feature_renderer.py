@@ -0,0 +1,319 @@
+import math
+import torch
+import torch.nn.functional as F
+
+
+def composite_features(features, visible, weight):
+    """
+    Function to render a C-channel feature buffer [N, C] from the per-pixel
+    contributors (visible, Gaussian ids [K, H, W]) and their blending weights
+    (weight, [K, H, W]) of one rasterizer pass over the same Gaussians, i.e.,
+    sum_k weight_k * features[visible_k]. Exact up to the number of
+    contributors K kept per pixel. Gradients flow to the features, not to
+    the blending weights.
+    """
+    num_contrib, height, width = visible.shape
+    ids = visible.reshape(num_contrib, -1).long()
+    weight = weight.reshape(num_contrib, -1).to(features.dtype)
+    rendered = torch.zeros((ids.shape[1], features.shape[1]), dtype=features.dtype, device=features.device)
+    for k in range(num_contrib):
+        # advanced indexing, its backward is deterministic
+        rendered = rendered + weight[k].unsqueeze(1) * features[ids[k]]
+    return rendered.T.reshape(features.shape[1], height, width)
+
+
+def accumulate_visibility(visible, weight, num_gauss, out=None, max_elements=2**22):
+    """
+    Function to sum the blending weights of each Gaussian over all pixels
+    from the per-pixel contributors (visible, Gaussian ids [K, H, W]) and
+    their weights ([K, H, W]) of a rasterizer pass. Consumes the contributor
+    slices in tiles of at most max_elements entries without copying the
+    inputs, i.e., peak memory is bounded by the tile. Accumulates into out
+    ([num_gauss]) if given, e.g., over several passes. Id 0 marks empty
+    contributor slots and is skipped (Gaussian 0 is lost as before).
+    """
+    if out is None:
+        out = torch.zeros(num_gauss, dtype=weight.dtype, device=weight.device)
+    num_contrib = visible.shape[0]
+    pixels = max(visible[0].numel(), 1)
+    tile = max(max_elements // pixels, 1)
+    with torch.no_grad():
+        for start in range(0, num_contrib, tile):
+            ids = visible[start:start+tile].reshape(-1)
+            mask = ids != 0
+            # accumulating advanced indexing, deterministic on GPU
+            out.index_put_(
+                (ids[mask].long(),),
+                weight[start:start+tile].reshape(-1)[mask].to(out.dtype),
+                accumulate=True)
+    return out
+
+
+def quat_to_rotmat(q):
+    q = F.normalize(q)
+    r, x, y, z = q[:, 0], q[:, 1], q[:, 2], q[:, 3]
+    return torch.stack([
+        1 - 2 * (y * y + z * z), 2 * (x * y - r * z), 2 * (x * z + r * y),
+        2 * (x * y + r * z), 1 - 2 * (x * x + z * z), 2 * (y * z - r * x),
+        2 * (x * z - r * y), 2 * (y * z + r * x), 1 - 2 * (x * x + y * y)], dim=-1).reshape(-1, 3, 3)
+
+
+def preprocess_gaussians(means3D, means2D, scales, rotations, cam, block_size=16):
+    """
+    Function to project Gaussians to the image as in the CUDA rasterizer,
+    i.e., EWA splatting of the 3D covariance. Returns pixel centers, view
+    depth, conics, radii (0 if culled) and the overlapped tile rectangles.
+    """
+    height, width = int(cam.image_height), int(cam.image_width)
+    viewmatrix = cam.viewmatrix.reshape(4, 4).to(means3D.device).float()
+    projmatrix = cam.projmatrix.reshape(4, 4).to(means3D.device).float()
+
+    # project centers, matrices are transposed as in the rasterizer settings
+    pts4 = torch.cat((means3D, torch.ones_like(means3D[:, :1])), dim=1)
+    pts_view = (pts4 @ viewmatrix)[:, :3]
+    pts_hom = pts4 @ projmatrix
+    pts_proj = pts_hom[:, :3] / (pts_hom[:, 3:] + 1e-7)
+    if means2D is not None:
+        # gradients of means2D are wrt. normalized device coordinates
+        pts_proj = torch.cat((pts_proj[:, :2] + means2D[:, :2], pts_proj[:, 2:]), dim=1)
+    in_frustum = pts_view[:, 2] > 0.2
+
+    # 3D covariance R S S R^T and EWA projection to 2D
+    rot = quat_to_rotmat(rotations)
+    scale_mat = torch.diag_embed(scales * cam.scale_modifier)
+    cov3D = rot @ scale_mat @ scale_mat @ rot.transpose(1, 2)
+    focal_x = width / (2 * cam.tanfovx)
+    focal_y = height / (2 * cam.tanfovy)
+    tz = pts_view[:, 2]
+    tx = (pts_view[:, 0] / tz).clamp(-1.3 * cam.tanfovx, 1.3 * cam.tanfovx) * tz
+    ty = (pts_view[:, 1] / tz).clamp(-1.3 * cam.tanfovy, 1.3 * cam.tanfovy) * tz
+    zeros = torch.zeros_like(tz)
+    jac = torch.stack([
+        focal_x / tz, zeros, -focal_x * tx / tz**2,
+        zeros, focal_y / tz, -focal_y * ty / tz**2], dim=-1).reshape(-1, 2, 3)
+    trans = jac @ viewmatrix[:3, :3].T.unsqueeze(0)
+    cov2D = trans @ cov3D @ trans.transpose(1, 2)
+    a = cov2D[:, 0, 0] + 0.3
+    b = cov2D[:, 0, 1]
+    c = cov2D[:, 1, 1] + 0.3
+    det = a * c - b * b
+    det_inv = torch.where(det != 0, 1 / torch.where(det != 0, det, torch.ones_like(det)), zeros)
+    conic = torch.stack((c * det_inv, -b * det_inv, a * det_inv), dim=-1)
+    mid = 0.5 * (a + c)
+    lambda1 = mid + (mid * mid - det).clamp(min=0.1).sqrt()
+    radii = torch.ceil(3 * lambda1.sqrt()).detach()
+    pix_x = ((pts_proj[:, 0] + 1) * width - 1) * 0.5
+    pix_y = ((pts_proj[:, 1] + 1) * height - 1) * 0.5
+
+    # Gaussians cover all pixels of the tiles overlapped by their radius
+    tiles_x, tiles_y = math.ceil(width / block_size), math.ceil(height / block_size)
+    px, py = pix_x.detach(), pix_y.detach()
+    rect = torch.stack((
+        ((px - radii) / block_size).floor().clamp(0, tiles_x),
+        ((py - radii) / block_size).floor().clamp(0, tiles_y),
+        ((px + radii + block_size - 1) / block_size).floor().clamp(0, tiles_x),
+        ((py + radii + block_size - 1) / block_size).floor().clamp(0, tiles_y)), dim=-1).long()
+    valid = in_frustum & (det != 0) & (rect[:, 2] > rect[:, 0]) & (rect[:, 3] > rect[:, 1])
+    radii = (radii * valid).int()
+
+    return pix_x, pix_y, tz, conic, radii, rect, valid
+
+
+def frustum_mask(means3D, scales, cam, block_size=16):
+    """
+    Function to get the Gaussians the rasterizer can not cull, i.e., in
+    front of the near plane (view depth > 0.2) and with a conservative bound
+    of their screen-space radius overlapping a tile of the image. Bounds the
+    largest eigenvalue of the projected covariance by the Frobenius norm of
+    the EWA Jacobian times the largest scale, s.t. only Gaussians with
+    radius 0 in the rasterizer are removed and renderings stay identical.
+    """
+    with torch.no_grad():
+        height, width = int(cam.image_height), int(cam.image_width)
+        viewmatrix = cam.viewmatrix.reshape(4, 4).to(means3D.device).float()
+        projmatrix = cam.projmatrix.reshape(4, 4).to(means3D.device).float()
+        pts_view = torch.addmm(viewmatrix[3, :3], means3D, viewmatrix[:3, :3])
+        pts_hom = torch.addmm(projmatrix[3], means3D, projmatrix[:3])
+        pts_proj = pts_hom[:, :2] / (pts_hom[:, 3:] + 1e-7)
+
+        focal_x = width / (2 * cam.tanfovx)
+        focal_y = height / (2 * cam.tanfovy)
+        tz = pts_view[:, 2]
+        tx = (pts_view[:, 0] / tz).clamp(-1.3 * cam.tanfovx, 1.3 * cam.tanfovx)
+        ty = (pts_view[:, 1] / tz).clamp(-1.3 * cam.tanfovy, 1.3 * cam.tanfovy)
+        jac_sq = (focal_x**2 * (1 + tx**2) + focal_y**2 * (1 + ty**2)) / tz**2
+        # rotation of the view matrix keeps the norm, 0.3 dilation, >= 0.1 clamp in the rasterizer
+        max_scale = scales.max(dim=1).values * cam.scale_modifier
+        radii = torch.ceil(3 * (jac_sq * max_scale**2 + 0.3 + 0.1**0.5).sqrt()) + 1
+        pix = ((pts_proj + 1) * torch.tensor([width, height], device=means3D.device) - 1) * 0.5
+
+        # same comparisons as the tile rectangle, s.t. nan is kept as in the rasterizer
+        bound = torch.tensor([
+            math.ceil(width / block_size), math.ceil(height / block_size)], device=means3D.device) * block_size
+        culled = (tz <= 0.2) \
+            | (pix + radii.unsqueeze(1) < 1).any(dim=1) \
+            | (pix - radii.unsqueeze(1) >= bound).any(dim=1)
+    return ~culled
+
+
+def rasterize_reference(
+        means3D,
+        scales,
+        rotations,
+        opacities,
+        colors_precomp,
+        cam,
+        means2D=None,
+        num_contrib=None,
+        block_size=16,
+        max_elements=2**24):
+    """
+    Function to rasterize a C-channel feature buffer in one pass, pure torch
+    reference of the CUDA rasterizer (EWA splatting, per-tile depth sorted
+    lists, front-to-back alpha blending with early termination). Vectorized
+    over batches of tiles with at most max_elements Gaussian-pixel pairs and
+    differentiable wrt. all inputs.
+
+    Returns the rendering [C, H, W] (blended onto cam.bg if it has C
+    channels), the radii [N], the blended depth [1, H, W] and the blending
+    weights [K, H, W] and ids [K, H, W] of the first num_contrib
+    contributors per pixel (all if None), e.g., for compute_visibility or
+    composite_features.
+    """
+    device = means3D.device
+    height, width = int(cam.image_height), int(cam.image_width)
+    num_channels = colors_precomp.shape[1]
+    tiles_x, tiles_y = math.ceil(width / block_size), math.ceil(height / block_size)
+    tile_pixels = block_size * block_size
+
+    pix_x, pix_y, depth, conic, radii, rect, valid = preprocess_gaussians(
+        means3D, means2D, scales, rotations, cam, block_size=block_size)
+
+    # duplicate Gaussians per overlapped tile, sorted by tile and depth
+    gauss_ids = torch.nonzero(valid).squeeze(1)
+    gauss_ids = gauss_ids[torch.argsort(depth.detach()[gauss_ids], stable=True)]
+    rect = rect[gauss_ids]
+    span_x, span_y = rect[:, 2] - rect[:, 0], rect[:, 3] - rect[:, 1]
+    num_touched = span_x * span_y
+    pair_gauss = torch.repeat_interleave(torch.arange(gauss_ids.shape[0], device=device), num_touched)
+    offsets = torch.cumsum(num_touched, dim=0) - num_touched
+    local = torch.arange(pair_gauss.shape[0], device=device) - offsets[pair_gauss]
+    pair_tile = (rect[pair_gauss, 1] + local // span_x[pair_gauss]) * tiles_x \
+        + rect[pair_gauss, 0] + local % span_x[pair_gauss]
+    tile_order = torch.argsort(pair_tile, stable=True)
+    pair_tile, pair_gauss = pair_tile[tile_order], gauss_ids[pair_gauss[tile_order]]
+    tile_counts = torch.bincount(pair_tile, minlength=tiles_x * tiles_y)
+    tile_starts = torch.cumsum(tile_counts, dim=0) - tile_counts
+
+    # pixel coordinates per tile
+    local_y, local_x = torch.meshgrid(
+        torch.arange(block_size, device=device), torch.arange(block_size, device=device), indexing='ij')
+    local_x, local_y = local_x.reshape(-1), local_y.reshape(-1)
+
+    opacities = opacities.reshape(-1)
+    features = torch.cat((colors_precomp.float(), depth.unsqueeze(1)), dim=1)
+    rendered = torch.zeros((tiles_x * tiles_y, tile_pixels, num_channels + 1), device=device)
+    final_t = torch.ones((tiles_x * tiles_y, tile_pixels), device=device)
+    tile_weights = list()
+
+    # batches of tiles with similar list length to bound the padded pairs
+    tiles = torch.argsort(tile_counts, stable=True)
+    tiles = tiles[tile_counts[tiles] > 0]
+    counts = tile_counts[tiles].tolist()
+    start = 0
+    while start < len(counts):
+        end = start + 1
+        while end < len(counts) and (end + 1 - start) * counts[end] * tile_pixels <= max_elements:
+            end += 1
+        max_len = counts[end-1]
+        batch = tiles[start:end]
+        start = end
+
+        # padded, depth sorted Gaussian lists of the tiles [B, L]
+        slot = torch.arange(max_len, device=device)
+        in_list = slot.unsqueeze(0) < tile_counts[batch].unsqueeze(1)
+        pair_idx = (tile_starts[batch].unsqueeze(1) + slot.unsqueeze(0)).clamp(max=max(pair_gauss.shape[0] - 1, 0))
+        ids = pair_gauss[pair_idx]
+
+        # pixels of the tiles [B, P]
+        pix_u = ((batch % tiles_x) * block_size).unsqueeze(1) + local_x.unsqueeze(0)
+        pix_v = ((batch // tiles_x) * block_size).unsqueeze(1) + local_y.unsqueeze(0)
+
+        dx = pix_x[ids].unsqueeze(2) - pix_u.unsqueeze(1)
+        dy = pix_y[ids].unsqueeze(2) - pix_v.unsqueeze(1)
+        con = conic[ids]
+        power = -0.5 * (con[..., :1] * dx**2 + con[..., 2:] * dy**2) - con[..., 1:2] * dx * dy
+        alpha = (opacities[ids].unsqueeze(2) * torch.exp(power)).clamp(max=0.99)
+        alpha = alpha * (in_list.unsqueeze(2) & (power <= 0) & (alpha >= 1 / 255))
+        transmittance = torch.cumprod(torch.cat((
+            torch.ones_like(alpha[:, :1]), 1 - alpha[:, :-1]), dim=1), dim=1)
+        # blending stops at the first Gaussian that would drop T below 1e-4
+        done = torch.cumsum((transmittance * (1 - alpha) < 0.0001) & (alpha > 0), dim=1) > 0
+        blend_weight = alpha * transmittance * ~done
+
+        rendered[batch] = torch.einsum('blp,blc->bpc', blend_weight, features[ids])
+        final_t[batch] = 1 - blend_weight.sum(dim=1)
+        tile_weights.append((batch, blend_weight.detach(), ids))
+
+    # contributors per pixel in blending order
+    max_contrib = 0
+    for _, blend_weight, _ in tile_weights:
+        max_contrib = max(max_contrib, int((blend_weight > 0).sum(dim=1).max().item()))
+    num_contrib = max_contrib if num_contrib is None else num_contrib
+    weight = torch.zeros((tiles_x * tiles_y, tile_pixels, max(num_contrib, 1)), device=device)
+    visible = torch.zeros((tiles_x * tiles_y, tile_pixels, max(num_contrib, 1)), dtype=torch.long, device=device)
+    for batch, blend_weight, ids in tile_weights:
+        contributes = blend_weight > 0
+        rank = torch.cumsum(contributes, dim=1) - 1
+        keep = contributes & (rank < num_contrib)
+        b, l, p = torch.nonzero(keep, as_tuple=True)
+        weight[batch[b], p, rank[b, l, p]] = blend_weight[b, l, p]
+        visible[batch[b], p, rank[b, l, p]] = ids[b, l]
+
+    def to_image(tile_values):
+        # [tiles, P, C] -> [C, H, W]
+        tile_values = tile_values.reshape(tiles_y, tiles_x, block_size, block_size, -1)
+        image = tile_values.permute(4, 0, 2, 1, 3).reshape(
+            -1, tiles_y * block_size, tiles_x * block_size)
+        return image[:, :height, :width]
+
+    image = to_image(rendered)
+    final_t = to_image(final_t.unsqueeze(-1))
+    color, depth_map = image[:num_channels], image[num_channels:]
+    bg = getattr(cam, 'bg', None)
+    if bg is not None and bg.numel() == num_channels:
+        color = color + final_t * bg.to(device).float().reshape(-1, 1, 1)
+
+    return color, radii, depth_map, to_image(weight), to_image(visible)
+
+
+class TorchRasterizer():
+    """
+    Pure torch replacement of diff_gaussian_rasterization_w_dwv's
+    GaussianRasterizer, runs on CPU and GPU and returns the same
+    (im, radius, depth, weight, visible) tuple.
+    """
+    def __init__(self, raster_settings, num_contrib=None, max_elements=2**24):
+        self.raster_settings = raster_settings
+        self.num_contrib = num_contrib
+        self.max_elements = max_elements
+
+    def __call__(
+            self,
+            means3D,
+            means2D,
+            opacities,
+            colors_precomp,
+            scales,
+            rotations,
+            **kwargs):
+        return rasterize_reference(
+            means3D,
+            scales,
+            rotations,
+            opacities,
+            colors_precomp,
+            self.raster_settings,
+            means2D=means2D,
+            num_contrib=self.num_contrib,
+            max_elements=self.max_elements)
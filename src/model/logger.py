@@ -13,6 +13,31 @@ class Logger():
         self.tracking_cam_iter_time_count = 0
         self.tracking_cam_frame_time_sum = 0
         self.tracking_cam_frame_time_count = 0
+        self.knn_recall_stats = list()
+        self.neighbor_refresh_count = 0
+        self.neighbor_drift_count = 0
+        self.neighbor_refresh_time_sum = 0
+        self.param_copied_bytes_sum = 0
+        self.param_appended_bytes_sum = 0
+        self.raster_pass_count = 0
+        self.rendering_count = 0
+        self.composited_count = 0
+        self.transform_hit_count = 0
+        self.transform_world_hit_count = 0
+        self.transform_miss_count = 0
+        self.rendered_gaussian_count = 0
+        self.culled_time_count = 0
+        self.culled_frustum_count = 0
+        self.optimizer_created_count = 0
+        self.optimizer_reused_count = 0
+        self.optimizer_setup_time_sum = 0
+        # iterations and time per pyramid scale and tracking phase
+        self.pyramid_iter_counts = dict()
+        self.pyramid_time_sums = dict()
+
+        # per iteration losses are read back from the device every loss_readback_every iterations
+        self.loss_readback_every = 20
+        self.pending_losses = list()
 
         self.config = config
         self.wandb_run = wandb_run
@@ -35,6 +60,131 @@ class Logger():
                         "Final Stats/Average Object Tracking Frame Time (s)": self.tracking_obj_frame_time_sum/self.tracking_obj_frame_time_count,
                         "Final Stats/Average Cam Tracking Frame Time (s)": self.tracking_cam_frame_time_sum/self.tracking_cam_frame_time_count,
                         "Final Stats/step": 1})
+        if len(self.knn_recall_stats):
+            recall = np.mean([stats['recall'] for stats in self.knn_recall_stats])
+            exact_time = np.mean([stats['exact_time'] for stats in self.knn_recall_stats])
+            approx_time = np.mean([stats['approx_time'] for stats in self.knn_recall_stats])
+            print(f"Average kNN Recall: {recall}, exact search {exact_time} s, approximate search {approx_time} s")
+        if self.neighbor_drift_count:
+            print(f"Refreshed Neighborhoods: {self.neighbor_refresh_count} of {self.neighbor_drift_count} drifted in {self.neighbor_refresh_time_sum} s")
+        if self.rendering_count:
+            print(f"Average Rasterizer Passes/Iteration: {self.raster_pass_count/self.rendering_count}")
+            if self.composited_count:
+                print(f"{self.composited_count} of {self.rendering_count} renderings composited depth, silhouette, bg and embeddings " \
+                      f"from the RGB contributors, their pass count is not comparable to separate passes")
+        if self.transform_miss_count:
+            print(f"Transform Cache: {self.transform_hit_count} hits, {self.transform_world_hit_count} world frame hits, {self.transform_miss_count} misses")
+        if self.rendering_count and self.rendered_gaussian_count:
+            print(f"Average Gaussians/Rendering: {self.rendered_gaussian_count/self.rendering_count} rasterized, " \
+                  f"{self.culled_time_count/self.rendering_count} culled by time, {self.culled_frustum_count/self.rendering_count} culled by frustum")
+        if self.optimizer_created_count or self.optimizer_reused_count:
+            print(f"Optimizers: {self.optimizer_created_count} created, {self.optimizer_reused_count} reused, setup {self.optimizer_setup_time_sum} s")
+        for phase, counts in self.pyramid_iter_counts.items():
+            for scale, count in counts.items():
+                print(f"Pyramid {phase} scale {scale}: {count} iterations, " \
+                      f"{self.pyramid_time_sums[phase][scale]/max(count, 1)} s/iteration")
+        if self.param_appended_bytes_sum:
+            print(f"Per-Gaussian Tensors: copied {self.param_copied_bytes_sum/2**20} MB, appended {self.param_appended_bytes_sum/2**20} MB")
+
+    def log_knn_recall(self, stats, time_idx):
+        self.knn_recall_stats.append(stats)
+        print(f"kNN recall at time {time_idx}: {stats['recall']} ({stats['num_queries']} queries), " \
+              f"exact search {stats['exact_time']} s, approximate search {stats['approx_time']} s")
+        if self.config['use_wandb']:
+            self.wandb_run.log({
+                "Neighbors/kNN Recall": stats['recall'],
+                "Neighbors/Exact Search Time (s)": stats['exact_time'],
+                "Neighbors/Approximate Search Time (s)": stats['approx_time'],
+                "Neighbors/step": time_idx})
+
+    def log_neighbor_refresh(self, num_refreshed, num_drifted, refresh_time, time_idx):
+        self.neighbor_refresh_count += num_refreshed
+        self.neighbor_drift_count += num_drifted
+        self.neighbor_refresh_time_sum += refresh_time
+        if num_drifted:
+            print(f"Refreshed {num_refreshed} of {num_drifted} drifted neighborhoods at time {time_idx} in {refresh_time} s")
+        if self.config['use_wandb']:
+            self.wandb_run.log({
+                "Neighbors/Refreshed": num_refreshed,
+                "Neighbors/Drifted": num_drifted,
+                "Neighbors/Refresh Time (s)": refresh_time,
+                "Neighbors/step": time_idx})
+
+    def log_param_copies(self, copied_bytes, appended_bytes, time_idx):
+        self.param_copied_bytes_sum += copied_bytes
+        self.param_appended_bytes_sum += appended_bytes
+        if self.config['use_wandb']:
+            self.wandb_run.log({
+                "Memory/Copied Parameter MB": copied_bytes/2**20,
+                "Memory/Appended Parameter MB": appended_bytes/2**20,
+                "Memory/step": time_idx})
+
+    def log_raster_passes(self, num_passes, num_renderings, num_composited, time_idx):
+        self.raster_pass_count += num_passes
+        self.rendering_count += num_renderings
+        self.composited_count += num_composited
+        if self.config['use_wandb'] and num_renderings:
+            self.wandb_run.log({
+                "Rendering/Rasterizer Passes per Iteration": num_passes/num_renderings,
+                "Rendering/Composited Renderings": num_composited,
+                "Rendering/step": time_idx})
+
+    def log_transform_cache(self, hits, world_hits, misses, time_idx):
+        self.transform_hit_count += hits
+        self.transform_world_hit_count += world_hits
+        self.transform_miss_count += misses
+        if self.config['use_wandb']:
+            self.wandb_run.log({
+                "Rendering/Transform Cache Hits": hits,
+                "Rendering/Transform Cache World Hits": world_hits,
+                "Rendering/Transform Cache Misses": misses,
+                "Rendering/step": time_idx})
+
+    def log_culling(self, rendered, culled_time, culled_frustum, time_idx):
+        self.rendered_gaussian_count += rendered
+        self.culled_time_count += culled_time
+        self.culled_frustum_count += culled_frustum
+        if self.config['use_wandb']:
+            self.wandb_run.log({
+                "Rendering/Rasterized Gaussians": rendered,
+                "Rendering/Culled by Time": culled_time,
+                "Rendering/Culled by Frustum": culled_frustum,
+                "Rendering/step": time_idx})
+
+    def log_optimizer_setup(self, num_created, num_reused, setup_time, time_idx):
+        self.optimizer_created_count += num_created
+        self.optimizer_reused_count += num_reused
+        self.optimizer_setup_time_sum += setup_time
+        if self.config['use_wandb']:
+            self.wandb_run.log({
+                "Optimizer/Created": num_created,
+                "Optimizer/Reused": num_reused,
+                "Optimizer/Setup Time": setup_time,
+                "Optimizer/step": time_idx})
+
+    def log_pyramid(self, phase, scales, level_iters, level_times, time_idx):
+        log_dict = dict()
+        for scale, num_iters, level_time in zip(scales, level_iters, level_times):
+            counts = self.pyramid_iter_counts.setdefault(phase, dict())
+            times = self.pyramid_time_sums.setdefault(phase, dict())
+            counts[scale] = counts.get(scale, 0) + num_iters
+            times[scale] = times.get(scale, 0) + level_time
+            log_dict[f"Pyramid/{phase} Scale {scale} Iterations"] = num_iters
+            log_dict[f"Pyramid/{phase} Scale {scale} Time"] = level_time
+        if self.config['use_wandb']:
+            log_dict["Pyramid/step"] = time_idx
+            self.wandb_run.log(log_dict)
+
+    def log_trajectory_precision(self, stats):
+        for k, v in stats.items():
+            print(f"History {k} ({v['storage']}): {v['nbytes']/2**20} MB of {v['dense_nbytes']/2**20} MB dense float32, " \
+                  f"max error {v['max_error']}, mean error {v['mean_error']}")
+            if self.config['use_wandb']:
+                self.wandb_run.log({
+                    f"Final Stats/History {k} MB": v['nbytes']/2**20,
+                    f"Final Stats/History {k} Max Error": v['max_error'],
+                    f"Final Stats/History {k} Mean Error": v['mean_error'],
+                    "Final Stats/step": 1})
 
     @staticmethod
     def numpy_and_save(save_path, input_list):
@@ -80,30 +230,37 @@ class Logger():
 
         # Update loss dict
         if cam_tracking:
-            tracking_loss_dict = {}
-            for k, v in losses.items():
-                tracking_loss_dict[f"Per Iteration Cam Tracking/{k}"] = v.item()
-            tracking_loss_dict['Per Iteration Cam Tracking/step'] = wandb_step
-            wandb_run.log(tracking_loss_dict)
+            prefix = "Per Iteration Cam Tracking"
         elif obj_tracking:
-            tracking_loss_dict = {}
-            for k, v in losses.items():
-                tracking_loss_dict[f"Per Iteration Object Tracking/{k}"] = v.item()
-            tracking_loss_dict['Per Iteration Object Tracking/step'] = wandb_step
-            wandb_run.log(tracking_loss_dict)
+            prefix = "Per Iteration Object Tracking"
         elif refine:
-            tracking_loss_dict = {}
-            for k, v in losses.items():
-                tracking_loss_dict[f"Per Iteration Refine/{k}"] = v.item()
-            tracking_loss_dict['Per Iteration Refine/step'] = wandb_step
-            wandb_run.log(tracking_loss_dict)
+            prefix = "Per Iteration Refine"
         elif delta_optim:
-            delta_loss_dict = {}
-            for k, v in losses.items():
-                delta_loss_dict[f"Per Iteration Delta Optim/{k}"] = v.item()
-            delta_loss_dict['Per Iteration Delta Optim/step'] = wandb_step
-            wandb_run.log(delta_loss_dict)
+            prefix = "Per Iteration Delta Optim"
+        else:
+            prefix = None
+
+        if prefix is not None:
+            # detached on the device, logged with the next readback
+            self.pending_losses.append((prefix, wandb_step, {k: v.detach() for k, v in losses.items()}))
+            if len(self.pending_losses) >= self.loss_readback_every:
+                self.flush_losses(wandb_run)
         
         # Increment wandb step
         wandb_step += 1
-        return wandb_step
\ No newline at end of file
+        return wandb_step
+
+    def flush_losses(self, wandb_run):
+        """
+        Function to log the pending per iteration losses with one readback
+        """
+        if not len(self.pending_losses):
+            return
+        values = torch.stack([
+            v.float().reshape(()) for _, _, losses in self.pending_losses for v in losses.values()]).cpu().tolist()
+        values = iter(values)
+        for prefix, wandb_step, losses in self.pending_losses:
+            loss_dict = {f"{prefix}/{k}": next(values) for k in losses.keys()}
+            loss_dict[f"{prefix}/step"] = wandb_step
+            wandb_run.log(loss_dict)
+        self.pending_losses = list()
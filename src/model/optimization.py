@@ -1,35 +1,178 @@
+import time
 import torch
+from src.utils.growth_buffers import append_rows
 
 
 class OptimHandler():
-    def __init__(self, config):
+    """
+    Creates the Adam optimizers of the tracking phases. If persistent, the
+    optimizer of a phase is kept across frames and only re-bound to the
+    current parameters, i.e., the learning rates are reset per frame and
+    the moments of surviving Gaussians are kept (warm_start) or zeroed in
+    place, which gives the same updates as a new optimizer. Moments of
+    Gaussians added outside the optimizer (appended rows) start at zero,
+    parameters that shrank outside the optimizer lose their moments.
+    Adding, pruning and densifying during the optimization resize the state
+    in place as before (cat_params_to_optimizer, remove_points). The state of
+    fresh_keys (e.g., the rows of an active set) is always re-initialized.
+    """
+    def __init__(self, config, buffers=None):
         self.config = config
+        optimizer_config = config['optimizer'] if 'optimizer' in config.keys() else dict()
+        self.persistent = optimizer_config.get('persistent', True)
+        self.warm_start = optimizer_config.get('warm_start', False)
+        # optimize only the rows of Gaussians whose gradients are not turned off
+        self.active_set = optimizer_config.get('active_set', False)
+        self.buffers = buffers
+        self.optimizers = dict()
+        self.num_created = 0
+        self.num_reused = 0
+        self.setup_time = 0
     
-    def initialize_optimizer(self, params, lrs_dict, tracking=True):
+    def initialize_optimizer(self, params, lrs_dict, tracking=True, phase=None, fresh_keys=()):
+        start_time = time.time()
         lrs = lrs_dict
-        param_groups = [{'params': [v], 'name': k, 'lr': lrs[k]} for k, v in params.items()]
-
-        if tracking:
-            return torch.optim.Adam(param_groups)
+        optimizer = self.optimizers.get(phase, None) if self.persistent else None
+        if optimizer is not None and set(g['name'] for g in optimizer.param_groups) == set(params.keys()):
+            self.rebind_optimizer(optimizer, params, lrs, phase, fresh_keys)
+            self.num_reused += 1
         else:
-            return torch.optim.Adam(param_groups, lr=0.0, eps=1e-15)
+            param_groups = [{'params': [v], 'name': k, 'lr': lrs[k]} for k, v in params.items()]
+
+            if tracking:
+                optimizer = torch.optim.Adam(param_groups)
+            else:
+                optimizer = torch.optim.Adam(param_groups, lr=0.0, eps=1e-15)
+            if self.persistent and phase is not None:
+                self.optimizers[phase] = optimizer
+            self.num_created += 1
+        self.setup_time += time.time() - start_time
+        return optimizer
+
+    def rebind_optimizer(self, optimizer, params, lrs, phase, fresh_keys=()):
+        # moments of the object tracking share the buffers grown by densification
+        prefix = '' if phase == 'tracking_obj' else f'{phase}.'
+        for group in optimizer.param_groups:
+            k = group['name']
+            group['lr'] = lrs[k]
+            stored_state = optimizer.state.pop(group['params'][0], None)
+            group['params'][0] = params[k]
+            if stored_state is None or 'exp_avg' not in stored_state.keys() or k in fresh_keys:
+                continue
+            num_rows, num_stored = params[k].shape[0], stored_state['exp_avg'].shape[0]
+            if stored_state['exp_avg'].shape[1:] != params[k].shape[1:] or num_stored > num_rows:
+                # rows can not be matched, Adam re-initializes the state
+                continue
+            if num_stored < num_rows:
+                # Gaussians appended outside the optimizer start with zero moments
+                for m in ['exp_avg', 'exp_avg_sq']:
+                    stored_state[m] = append_rows(
+                        self.buffers, f'{prefix}{m}.{k}', stored_state[m],
+                        torch.zeros_like(params[k][num_stored:].detach()))
+            if not self.warm_start:
+                stored_state['exp_avg'].zero_()
+                stored_state['exp_avg_sq'].zero_()
+                stored_state['step'] = torch.zeros_like(stored_state['step']) \
+                    if isinstance(stored_state['step'], torch.Tensor) else 0
+            optimizer.state[params[k]] = stored_state
+
+    def pop_stats(self):
+        """
+        Function to get and reset the created and reused optimizers and the
+        setup time since the last call
+        """
+        stats = self.num_created, self.num_reused, self.setup_time
+        self.num_created, self.num_reused, self.setup_time = 0, 0, 0
+        return stats
+
+    def loss_monitor(self):
+        return LossMonitor(early_stop=self.config['early_stop'])
 
-    def early_check(
+
+class LossMonitor():
+    """
+    Early stopping and best candidate selection of an optimization loop,
+    kept on the device of the loss s.t. iterations do not wait for a scalar
+    readback. The loop stops after early_stop_time_thresh consecutive
+    iterations with a loss change below early_stop_thresh (compared in
+    double precision as with python floats). Since the count of such
+    iterations grows by at most one per iteration, it is only read back at
+    the first iteration it could reach the threshold, i.e., the loop stops
+    at the same iteration as with a readback every iteration.
+    """
+    def __init__(
             self,
-            early_stop_count,
-            last_loss,
-            loss, 
-            early_stop_eval,
+            early_stop=True,
             early_stop_time_thresh=20,
             early_stop_thresh=0.0001):
-         
-        if self.config['early_stop']:
-            if abs(last_loss - loss.detach().clone().item()) < early_stop_thresh:
-                early_stop_count += 1
-                if early_stop_count == early_stop_time_thresh:
-                    early_stop_eval = True
+        self.early_stop = early_stop
+        self.early_stop_time_thresh = early_stop_time_thresh
+        self.early_stop_thresh = early_stop_thresh
+        self.last_loss = None
+        self.early_stop_count = None
+        self.iters_to_readback = early_stop_time_thresh
+        self.num_readbacks = 0
+        self.best_loss = None
+        self.candidates = dict()
+
+    def early_check(self, loss):
+        """
+        Function to update the early stopping state with the loss of an
+        iteration, returns if the optimization should stop
+        """
+        if not self.early_stop:
+            return False
+        loss = loss.detach().double()
+        if self.last_loss is None:
+            self.last_loss = torch.full_like(loss, 1000)
+            self.early_stop_count = torch.zeros_like(loss, dtype=torch.long)
+        small_change = (self.last_loss - loss).abs() < self.early_stop_thresh
+        self.early_stop_count = torch.where(
+            small_change, self.early_stop_count + 1, torch.zeros_like(self.early_stop_count))
+        self.last_loss = loss
+
+        self.iters_to_readback -= 1
+        if self.iters_to_readback > 0:
+            return False
+        self.num_readbacks += 1
+        early_stop_count = int(self.early_stop_count.item())
+        if early_stop_count >= self.early_stop_time_thresh:
+            return True
+        self.iters_to_readback = self.early_stop_time_thresh - early_stop_count
+        return False
+
+    def reset_early(self):
+        """
+        Function to restart early stopping, e.g., if the loss changes its
+        scale with the resolution of a coarse-to-fine schedule
+        """
+        self.last_loss = None
+        self.early_stop_count = None
+        self.iters_to_readback = self.early_stop_time_thresh
+
+    def reset_best(self, **candidates):
+        """
+        Function to (re-)start the best candidate selection from candidates,
+        reusing the tensors of a previous selection if the shapes match
+        """
+        if self.best_loss is not None:
+            self.best_loss.fill_(1e20)
+        for k, v in candidates.items():
+            if k in self.candidates.keys() and self.candidates[k].shape == v.shape:
+                self.candidates[k].copy_(v.detach())
             else:
-                early_stop_count = 0
-            last_loss = loss.detach().clone().item()
+                self.candidates[k] = v.detach().clone()
 
-        return early_stop_eval, early_stop_count, last_loss
\ No newline at end of file
+    def update_best(self, loss, **candidates):
+        """
+        Function to keep the candidates if loss is lower than all previous
+        losses since reset_best, without a readback of the loss, updates the
+        best loss and candidates in place
+        """
+        loss = loss.detach()
+        if self.best_loss is None:
+            self.best_loss = torch.full_like(loss, 1e20)
+        improved = loss < self.best_loss
+        self.best_loss.copy_(torch.where(improved, loss, self.best_loss))
+        for k, v in candidates.items():
+            self.candidates[k].copy_(torch.where(improved, v.detach(), self.candidates[k]))
@@ -1,32 +1,141 @@
 from utils.gaussian_utils import build_rotation
 import torch
 import torch.nn.functional as F
-from torch_scatter import scatter_add
 # from diff_gaussian_rasterization import GaussianRasterizer as Renderer
-from diff_gaussian_rasterization_w_dwv import GaussianRasterizer as Renderer
+# the CUDA rasterizer is only needed for the 'cuda' backend
+try:
+    from diff_gaussian_rasterization_w_dwv import GaussianRasterizer as Renderer
+except ImportError:
+    Renderer = None
 from utils.gaussian_utils import quat_mult
+from src.utils.trajectory_store import TrajectoryStore, get_frame, version_key
+from src.model.feature_renderer import composite_features, accumulate_visibility, frustum_mask, TorchRasterizer
 
 
 class RenderHelper():
-    def __init__(self, device="cuda:0"):
+    def __init__(self, device="cuda:0", single_pass=False, backend='cuda', cull_frustum=True):
         self.device = device
+        # 'cuda' (diff_gaussian_rasterization_w_dwv) or 'torch' (pure torch, CPU or GPU)
+        if backend not in ['cuda', 'torch']:
+            raise ValueError(f"Unknown rasterizer backend {backend}")
+        if backend == 'cuda' and Renderer is None:
+            raise ImportError("The cuda rasterizer backend needs diff_gaussian_rasterization_w_dwv, use backend='torch' without it.")
+        self.backend = backend
+        # depth, silhouette, bg and embeddings with the RGB pass: one C-channel pass
+        # on the torch backend, composited from the contributors of the RGB pass on
+        # the cuda backend (3-channel kernel), which is not equivalent to separate
+        # passes (no gradients through the blending weights, top-K contributors only)
+        self.single_pass = single_pass
+        self.composite = single_pass and backend == 'cuda'
+        self.num_passes = 0
+        self.num_renderings = 0
+        self.num_composited = 0
+        # last detached Gaussians in world frame and last transform without gradients,
+        # keyed by identity and in-place version of the Gaussians, time and camera
+        self.world_cache = None
+        self.transform_cache = None
+        self.transform_hits = 0
+        self.transform_world_hits = 0
+        self.transform_misses = 0
+        # Gaussians sent to the rasterizer once per rendering, culled by birth time and camera frustum
+        self.cull_frustum = cull_frustum
+        self.cull_cache = None
+        self.rendered_count = 0
+        self.culled_time_count = 0
+        self.culled_frustum_count = 0
+        # max contributor entries per tile when accumulating visibility
+        self.visibility_max_elements = 2**22
 
-    def mask_timestamp(
+    @staticmethod
+    def version_key(tensor):
+        # identity and in-place version of a tensor or trajectory store
+        return version_key(tensor)
+
+    def pop_transform_stats(self):
+        """
+        Function to get and reset the transform cache hits (full and world
+        frame only) and misses since the last call
+        """
+        stats = self.transform_hits, self.transform_world_hits, self.transform_misses
+        self.transform_hits, self.transform_world_hits, self.transform_misses = 0, 0, 0
+        return stats
+
+    def rasterize(self, cam, rendervar):
+        self.num_passes += 1
+        if self.backend == 'torch':
+            return TorchRasterizer(raster_settings=cam)(**rendervar)
+        return Renderer(raster_settings=cam)(**rendervar)
+
+    def pop_pass_stats(self):
+        """
+        Function to get and reset the rasterizer passes, renderings and
+        renderings with composited (not rasterized) auxiliary maps since the
+        last call
+        """
+        stats = self.num_passes, self.num_renderings, self.num_composited
+        self.num_passes, self.num_renderings, self.num_composited = 0, 0, 0
+        return stats
+
+    def pop_cull_stats(self):
+        """
+        Function to get and reset the rendered Gaussians and the Gaussians
+        culled by birth time and camera frustum since the last call
+        """
+        stats = self.rendered_count, self.culled_time_count, self.culled_frustum_count
+        self.rendered_count, self.culled_time_count, self.culled_frustum_count = 0, 0, 0
+        return stats
+
+    def cull(
             self,
-            rendervar,
+            params,
+            means3D,
+            log_scales,
             timestamp,
             first_occurance,
+            cam,
             strictly_less=False):
-        
-        if strictly_less:
-            time_mask = first_occurance < timestamp
+        """
+        Function to get the Gaussians to rasterize, i.e., born until
+        timestamp and not culled by the camera frustum. Shared by all passes
+        of a rendering and reused while the transformed Gaussians, their
+        scales, birth times and the camera do not change.
+
+        Returns:
+            time_mask: born Gaussians [N]
+            num_born: number of born Gaussians
+            frustum_idx: rasterized Gaussians within the born ones
+            keep_idx: rasterized Gaussians within all
+        """
+        # the cached tensors are kept alive s.t. their ids are not reused
+        cached = (means3D, params['log_scales'], first_occurance, cam)
+        key = (
+            self.version_key(means3D),
+            self.version_key(params['log_scales']),
+            self.version_key(first_occurance),
+            id(cam),
+            timestamp,
+            strictly_less)
+        if self.cull_cache is not None and self.cull_cache[0] == key:
+            time_mask, num_born, frustum_idx, keep_idx = self.cull_cache[2]
         else:
-            time_mask = first_occurance <= timestamp
+            if strictly_less:
+                time_mask = first_occurance < timestamp
+            else:
+                time_mask = first_occurance <= timestamp
+            num_born = int(time_mask.sum())
+            if self.cull_frustum:
+                in_frustum = frustum_mask(means3D.detach(), torch.exp(log_scales.detach()), cam)
+                frustum_idx = torch.nonzero(in_frustum[time_mask]).squeeze(1)
+                keep_idx = torch.nonzero(time_mask & in_frustum).squeeze(1)
+            else:
+                keep_idx = torch.nonzero(time_mask).squeeze(1)
+                frustum_idx = torch.arange(num_born, device=keep_idx.device)
+            self.cull_cache = (key, cached, (time_mask, num_born, frustum_idx, keep_idx))
 
-        masked_rendervar = dict()
-        for k, v in rendervar.items():
-            masked_rendervar[k] = v[time_mask]
-        return masked_rendervar, time_mask
+        self.rendered_count += keep_idx.shape[0]
+        self.culled_time_count += time_mask.shape[0] - num_born
+        self.culled_frustum_count += num_born - keep_idx.shape[0]
+        return time_mask, num_born, frustum_idx, keep_idx
 
     def transform_to_frame(
             self,
@@ -52,6 +161,21 @@ class RenderHelper():
         if gauss_time_idx is None:
             gauss_time_idx = time_idx
 
+        # the cached tensors are kept alive s.t. their ids are not reused
+        cached = (params['means3D'], params['unnorm_rotations'], params['cam_unnorm_rots'], params['cam_trans'])
+        world_key = (
+            self.version_key(params['means3D']),
+            self.version_key(params['unnorm_rotations']),
+            gauss_time_idx if all_times else None)
+        transform_key = world_key + (
+            self.version_key(params['cam_unnorm_rots']),
+            self.version_key(params['cam_trans']),
+            time_idx)
+        if not gaussians_grad and not camera_grad and self.transform_cache is not None \
+                and self.transform_cache[0] == transform_key:
+            self.transform_hits += 1
+            return dict(self.transform_cache[2])
+
         # Get Frame Camera Pose
         if camera_grad:
             cam_rot = F.normalize(params['cam_unnorm_rots'][..., time_idx])
@@ -60,7 +184,7 @@ class RenderHelper():
             cam_rot = F.normalize(params['cam_unnorm_rots'][..., time_idx].detach())
             cam_tran = params['cam_trans'][..., time_idx].detach()
 
-        rel_w2c = torch.eye(4, device=params['means3D'].device).float()
+        rel_w2c = torch.eye(4, device=params['cam_trans'].device).float()
         rel_w2c[:3, :3] = build_rotation(cam_rot)
         rel_w2c[:3, 3] = cam_tran
 
@@ -71,21 +195,25 @@ class RenderHelper():
             transform_rots = True # Anisotropic Gaussians
         
         # Get Centers and Unnorm Rots of Gaussians in World Frame
-        if all_times:
-            pts = params['means3D'][:, :, gauss_time_idx]
-            unnorm_rots = params['unnorm_rotations'][:, :, gauss_time_idx]
+        if not gaussians_grad and self.world_cache is not None and self.world_cache[0] == world_key:
+            self.transform_world_hits += 1
+            pts, unnorm_rots = self.world_cache[2]
         else:
-            pts = params['means3D']
-            unnorm_rots = params['unnorm_rotations']
-        if not gaussians_grad:
-            pts = pts.detach()
-            unnorm_rots = unnorm_rots.detach()
+            self.transform_misses += 1
+            if all_times:
+                pts = get_frame(params['means3D'], gauss_time_idx, device=rel_w2c.device)
+                unnorm_rots = get_frame(params['unnorm_rotations'], gauss_time_idx, device=rel_w2c.device)
+            else:
+                pts = params['means3D']
+                unnorm_rots = params['unnorm_rotations']
+            if not gaussians_grad:
+                pts = pts.detach()
+                unnorm_rots = unnorm_rots.detach()
+                self.world_cache = (world_key, cached, (pts, unnorm_rots))
 
         transformed_gaussians = {}
         # Transform Centers of Gaussians to Camera Frame
-        pts_ones = torch.ones(pts.shape[0], 1, device=params['means3D'].device).float()
-        pts4 = torch.cat((pts, pts_ones), dim=1)
-        transformed_pts = (rel_w2c @ pts4.T).T[:, :3]
+        transformed_pts = torch.addmm(rel_w2c[:3, 3], pts, rel_w2c[:3, :3].T)
         transformed_gaussians['means3D'] = transformed_pts
 
         # Transform Rots of Gaussians to Camera Frame
@@ -96,6 +224,9 @@ class RenderHelper():
         else:
             transformed_gaussians['unnorm_rotations'] = unnorm_rots
 
+        if not gaussians_grad and not camera_grad:
+            self.transform_cache = (transform_key, cached, dict(transformed_gaussians))
+
         return transformed_gaussians
 
     def get_depth_and_silhouette(
@@ -143,7 +274,10 @@ class RenderHelper():
         """
         Function to get log scales depending on if iso or anisotropic
         """
-        if len(params['log_scales'].squeeze().shape) == 1:
+        if isinstance(params['log_scales'], TrajectoryStore):
+            log_scales = get_frame(params['log_scales'], time_idx, device=params['logit_opacities'].device)
+            log_scales = log_scales.unsqueeze(1) if len(log_scales.shape) == 1 else log_scales
+        elif len(params['log_scales'].squeeze().shape) == 1:
             log_scales = params['log_scales'] 
         elif len(params['log_scales'].squeeze().shape) == 2 and params['log_scales'].squeeze().shape[1] == 3:
             log_scales = params['log_scales']
@@ -185,33 +319,75 @@ class RenderHelper():
                                             gauss_time_idx=iter_time_idx if gauss_time_idx is None else gauss_time_idx)
         
         log_scales = self.get_log_scales(params, iter_time_idx)
+        # one compacted index set of born Gaussians in the camera frustum for all passes
+        time_mask, num_born, frustum_idx, keep_idx = self.cull(
+            params, transformed_gaussians['means3D'], log_scales, iter_time_idx, variables['timestep'], data['cam'])
+        culled = frustum_idx.shape[0] < num_born
+        means3D = transformed_gaussians['means3D'][keep_idx]
+        # means2D of the born Gaussians as before, s.t. its gradient is aligned with time_mask
+        means2D = torch.zeros((num_born, 3), requires_grad=True, device=means3D.device) + 0
         rendervar = {
-            'means3D': transformed_gaussians['means3D'],
-            'rotations': F.normalize(transformed_gaussians['unnorm_rotations']),
-            'opacities': torch.sigmoid(params['logit_opacities']),
-            'scales': torch.exp(log_scales).float(),
-            'means2D': torch.zeros_like(transformed_gaussians['means3D'], requires_grad=True, device=params['means3D'].device) + 0
-        } 
-        rendervar, time_mask =  self.mask_timestamp(rendervar, iter_time_idx, variables['timestep'])
+            'means3D': means3D,
+            'rotations': F.normalize(transformed_gaussians['unnorm_rotations'][keep_idx]),
+            'opacities': torch.sigmoid(params['logit_opacities'][keep_idx]),
+            'scales': torch.exp(log_scales[keep_idx]).float(),
+            'means2D': means2D[frustum_idx] if culled else means2D
+        }
+        self.num_renderings += 1
         if get_rgb:
             # RGB Rendering
-            rgb = params['rgb_colors'] if len(params['rgb_colors'].shape) == 2 else params['rgb_colors'][:, :, iter_time_idx]
-            rendervar['colors_precomp'] = rgb[time_mask].float()
+            rgb = params['rgb_colors'] if len(params['rgb_colors'].shape) == 2 else get_frame(
+                params['rgb_colors'], iter_time_idx, device=params['logit_opacities'].device)
+            rendervar['colors_precomp'] = rgb[keep_idx].float()
+            if self.single_pass:
+                # auxiliary maps rendered with the RGB pass
+                features = list()
+                if get_depth:
+                    features.append(self.get_depth_and_silhouette(means3D, data['w2c']))
+                if get_bg:
+                    features.append(self.get_bg(means3D.shape[0], params['bg'][keep_idx]))
+                if get_embeddings:
+                    features.append(params['embeddings'][keep_idx].float())
+                if not self.composite and len(features):
+                    # one C-channel pass, equivalent to one pass per map
+                    rendervar['colors_precomp'] = torch.cat([rendervar['colors_precomp']] + features, dim=1)
             if not disable_grads and not last:
-                rendervar['means2D'].retain_grad()
-            im, radius, _, weight, visible = Renderer(raster_settings=data['cam'])(**rendervar) 
-            variables['means2D'] = rendervar['means2D']  # Gradient only accum from colour render for densification
+                means2D.retain_grad()
+            im, radius, _, weight, visible = self.rasterize(data['cam'], rendervar)
+            if self.single_pass and not self.composite and len(features):
+                im, *aux_maps = torch.split(im, [3] + [f.shape[1] for f in features])
+                aux_maps = list(aux_maps)
+            variables['means2D'] = means2D  # Gradient only accum from colour render for densification
+            if culled:
+                radius = torch.zeros(num_born, dtype=radius.dtype, device=radius.device).index_put_(
+                    (frustum_idx,), radius)
+        else:
+            im, radius, weight, visible, visibility = None, None, None, None, None
+
+        if self.composite and get_rgb and len(features):
+            # all auxiliary maps in one feature buffer, blended with the weights of the RGB pass
+            self.num_composited += 1
+            aux_maps = list(torch.split(
+                composite_features(torch.cat(features, dim=1), visible, weight),
+                [f.shape[1] for f in features]))
+
+        if get_rgb:
+            if keep_idx.shape[0] and keep_idx[-1] != keep_idx.shape[0] - 1:
+                # Gaussian ids of the compacted set to ids of all Gaussians, empty slots (0) stay 0
+                visible = torch.where(
+                    (visible != 0) | (weight > 0), keep_idx[visible.long()], torch.zeros_like(keep_idx[:1])).to(visible.dtype)
             if do_compute_visibility:
                 visibility = self.compute_visibility(visible, weight, num_gauss=params['means3D'].shape[0])
             else:
                 visibility = None
-        else:
-            im, radius, weight, visible, visibility = None, None, None, None, None
 
         if get_depth:
             # Depth & Silhouette Rendering
-            rendervar['colors_precomp'] = self.get_depth_and_silhouette(transformed_gaussians['means3D'], data['w2c'])[time_mask]
-            depth_sil, _, _, _, _  = Renderer(raster_settings=data['cam'])(**rendervar)
+            if self.single_pass and get_rgb:
+                depth_sil = aux_maps.pop(0)
+            else:
+                rendervar['colors_precomp'] = self.get_depth_and_silhouette(means3D, data['w2c'])
+                depth_sil, _, _, _, _  = self.rasterize(data['cam'], rendervar)
 
             # silouette
             silhouette = depth_sil[1, :, :]
@@ -231,22 +407,27 @@ class RenderHelper():
 
         if get_bg:
             # BG rendering
-            rendervar['colors_precomp'] = self.get_bg(transformed_gaussians['means3D'].shape[0], params['bg'])[time_mask]
-            bg, _, _, _, _ = Renderer(raster_settings=data['cam'])(**rendervar)
+            if self.single_pass and get_rgb:
+                bg = aux_maps.pop(0)
+            else:
+                rendervar['colors_precomp'] = self.get_bg(means3D.shape[0], params['bg'][keep_idx])
+                bg, _, _, _, _ = self.rasterize(data['cam'], rendervar)
             # instseg 
             bg = bg[0, :, :].unsqueeze(0)
         else:
             bg = None
         
-        if get_embeddings:
+        if get_embeddings and self.single_pass and get_rgb:
+            rendered_embeddings = aux_maps.pop(0)
+        elif get_embeddings:
             rendered_embeddings = list()
             for emb_idx in range(0, params['embeddings'].shape[1], 3):
                 max_idx = min(params['embeddings'].shape[1]-emb_idx, 3)
-                embs = params['embeddings'][:, emb_idx:emb_idx+max_idx]
+                embs = params['embeddings'][keep_idx, emb_idx:emb_idx+max_idx]
                 if max_idx < 3:
                     embs = torch.cat((embs, torch.ones((embs.shape[0], 1), device=embs.device)), dim=-1).float()
-                rendervar['colors_precomp'] = embs[time_mask]
-                _embeddings, _, _, _, _ = Renderer(raster_settings=data['cam'])(**rendervar)
+                rendervar['colors_precomp'] = embs
+                _embeddings, _, _, _, _ = self.rasterize(data['cam'], rendervar)
                 rendered_embeddings.append(_embeddings[:max_idx])
             rendered_embeddings = torch.cat(rendered_embeddings, dim=0)
         else:
@@ -263,41 +444,18 @@ class RenderHelper():
         """
         Function to compute visibility needed for trajectory evaluation
         """
-        w, h, contrib = visible.shape[2], visible.shape[1], visible.shape[0]
-
-        # get max visible gauss per pix
-        max_gauss_weight, max_gauss_idx = weight.detach().clone().max(dim=0)
-        x_grid, y_grid = torch.meshgrid(torch.arange(w).to(visible.device).long(), 
-                                        torch.arange(h).to(visible.device).long(),
-                                        indexing='xy')
-        max_gauss_id = visible.detach().clone()[
-            max_gauss_idx.flatten(),
-            y_grid.flatten(),
-            x_grid.flatten()].int().reshape(max_gauss_idx.shape)
-        
         if visibility_modus == 'max':
+            # get max visible gauss per pix
+            max_gauss_idx = weight.detach().max(dim=0)[1]
+            max_gauss_id = visible.detach().gather(0, max_gauss_idx.unsqueeze(0))[0]
             visibility = torch.zeros(num_gauss, dtype=bool)
-            visibility[max_gauss_id.flatten().long()] = True
+            visibility[max_gauss_id.flatten().long().cpu()] = True
             return visibility
 
-        # flattened visibility, weight, and pix id 
-        # (1000 because of #contributers per tile not pix in cuda code)
-        vis_pix_flat = visible.detach().clone().reshape(contrib, -1).permute(1, 0).flatten().long()
-        weight_pix_flat = weight.detach().clone().reshape(contrib, -1).permute(1, 0).flatten()
-        pix_id = torch.arange(w * h).unsqueeze(1).repeat(1, contrib).flatten()
-
-        # filter above tensors where id tensor (visibility) is 0
-        # by this we loos pixel Gaussian with ID 0, but should be fine
-        weight_pix_flat = weight_pix_flat[vis_pix_flat!=0]
-        pix_id = pix_id[vis_pix_flat!=0]
-        vis_pix_flat = vis_pix_flat[vis_pix_flat!=0]
+        # overall sum of weights of one Gaussian for all pixels, streamed over
+        # tiles of contributors (Gaussian ID 0 marks empty slots and is skipped)
+        visibility = accumulate_visibility(
+            visible.detach(), weight.detach(), num_gauss, max_elements=self.visibility_max_elements)
 
-        # get overall sum of weights of one Gaussian for all pixels
-        weight_sum_per_gauss = torch.zeros(num_gauss).to(weight_pix_flat.device)
-        weight_sum_per_gauss[torch.unique(vis_pix_flat)] = \
-            scatter_add(weight_pix_flat, vis_pix_flat)[torch.unique(vis_pix_flat)]
-
-        visibility = weight_sum_per_gauss
-        
         return visibility
     
@@ -3,9 +3,11 @@ import numpy as np
 import os
 from utils.camera_helpers import setup_camera
 from utils.gaussian_utils import build_rotation
-from utils.neighbor_search import torch_3d_knn
-from diff_gaussian_rasterization_w_dwv import GaussianRasterizer as Renderer
+from utils.neighbor_search import torch_3d_knn, NeighborIndex
 from src.utils.viz_utils import make_vid
+from src.utils.trajectory_store import TrajectoryStore
+from src.utils.growth_buffers import GrowthBuffers, append_rows
+from src.utils.prev_frame_cache import PrevFrameCache
 import cv2
 import imageio
 
@@ -19,6 +21,38 @@ class GaussianScene():
         self.device = device
         self.eval_dir = eval_dir
         self.do_store_vis = do_store_vis
+
+        # per-segment memberships and FAISS indices, updated with added / removed / moved Gaussians
+        neighbors_config = config['neighbors'] if 'neighbors' in config.keys() else dict()
+        self.knn_backend = neighbors_config.get('backend', 'faiss')
+        if neighbors_config.get('persistent_index', False):
+            self.neighbor_index = NeighborIndex(
+                gpu_id=torch.device(device).index or 0,
+                backend=self.knn_backend,
+                ann=neighbors_config.get('ann', None))
+        else:
+            self.neighbor_index = None
+
+        # append-only per-frame histories, optionally memory-mapped in the run directory
+        trajectory_config = config['trajectory_store'] if 'trajectory_store' in config.keys() else dict()
+        self.traj_chunk_size = trajectory_config.get('chunk_size', 16)
+        self.traj_precision = trajectory_config.get('precision', dict())
+        if trajectory_config.get('memmap', False):
+            self.traj_storage_dir = os.path.join(os.path.dirname(eval_dir), 'trajectories')
+        else:
+            self.traj_storage_dir = None
+
+        # camera rays of the strided pixel grid per intrinsics, image size and stride
+        self.ray_cache = dict()
+
+        # per-Gaussian parameters, Adam moments and variables grow in reserved capacity
+        buffers_config = config['growth_buffers'] if 'growth_buffers' in config.keys() else dict()
+        self.buffers = GrowthBuffers(
+            in_place=buffers_config.get('in_place', True),
+            growth_factor=buffers_config.get('growth_factor', 2.0))
+
+        # previous frame on the compute device for the iterations of a frame
+        self.prev_frame = PrevFrameCache(device)
     
     def get_pointcloud(
             self,
@@ -34,42 +68,32 @@ class GaussianScene():
             time_idx=0,
             bg=None):
 
+        stride = self.config['stride']
+
         # downscale 
         if mask is None:
             mask = (depth > 0)
         else:
             mask = mask & (depth > 0)
+        # only masked pixels of the strided grid are materialized
+        mask = mask[:, ::stride, ::stride].reshape(-1)
+        pix_ids = torch.nonzero(mask).squeeze(1)
      
         if bg is not None:
-            bg = bg[:, ::self.config['stride'], ::self.config['stride']]
-            bg = bg.reshape(-1, 1)
+            bg = bg[:, ::stride, ::stride]
+            bg = bg.reshape(-1, 1)[pix_ids]
 
-        # Compute indices of pixels
+        # cached camera rays of the strided pixel grid, i.e., pixels at depth 1
         width, height = color.shape[2], color.shape[1]
-        x_grid, y_grid = torch.meshgrid(torch.arange(width).to(self.device).float(), 
-                                        torch.arange(height).to(self.device).float(),
-                                        indexing='xy')
-        xx = (x_grid - intrinsics[0][2])/intrinsics[0][0]
-        yy = (y_grid - intrinsics[1][2])/intrinsics[1][1]
-
-        xx = xx[::self.config['stride'], ::self.config['stride']]
-        yy = yy[::self.config['stride'], ::self.config['stride']]
-        mask = mask[:, ::self.config['stride'], ::self.config['stride']]
-
-        # get pixel grid into 3D
-        mask = mask.reshape(-1)
-        xx = xx.reshape(-1)
-        yy = yy.reshape(-1)
-        depth_z = depth[0][::self.config['stride'], ::self.config['stride']].reshape(-1)
+        rays = self.get_camera_rays(intrinsics, width, height, stride)[pix_ids]
+        depth_z = depth[0][::stride, ::stride].reshape(-1)[pix_ids]
 
         # Initialize point cloud
-        pts_cam = torch.stack((xx * depth_z, yy * depth_z, depth_z), dim=-1)
+        pts_cam = rays * depth_z.unsqueeze(1)
 
         if transform_pts:
-            pix_ones = torch.ones(pts_cam.shape[0], 1).to(self.device).float()
-            pts4 = torch.cat((pts_cam, pix_ones), dim=1)
             c2w = torch.inverse(w2c)
-            pts = (c2w @ pts4.T).T[:, :3]
+            pts = torch.addmm(c2w[:3, 3], pts_cam, c2w[:3, :3].T)
         else:
             pts = pts_cam
 
@@ -83,27 +107,36 @@ class GaussianScene():
 
         # Colorize point cloud
         cols = color.permute(1, 2, 0) # (C, H, W) -> (H, W, C) -> (H * W, C)
-        cols = cols[::self.config['stride'], ::self.config['stride']].reshape(-1, 3)
+        cols = cols[::stride, ::stride].reshape(-1, 3)[pix_ids]
         point_cld = torch.cat((pts, cols), -1)
         if instseg is not None:
             instseg = instseg.permute(1, 2, 0)
-            instseg = instseg[::self.config['stride'], ::self.config['stride']].reshape(-1, 1) # (C, H, W) -> (H, W, C) -> (H * W, C)
+            instseg = instseg[::stride, ::stride].reshape(-1, 1)[pix_ids] # (C, H, W) -> (H, W, C) -> (H * W, C)
             point_cld = torch.cat((point_cld, instseg), -1)
         if embeddings is not None:
             channels = embeddings.shape[0]
             embeddings = torch.permute(embeddings, (1, 2, 0))
-            embeddings = embeddings[::self.config['stride'], ::self.config['stride']].reshape(-1, channels) # (C, H, W) -> (H, W, C) -> (H * W, C)
+            embeddings = embeddings[::stride, ::stride].reshape(-1, channels)[pix_ids] # (C, H, W) -> (H, W, C) -> (H * W, C)
             point_cld = torch.cat((point_cld, embeddings), -1)
 
-        # mask background points and incoming points
-        if mask is not None:
-            point_cld = point_cld[mask]
-            mean3_sq_dist = mean3_sq_dist[mask]
-            if bg is not None:
-                bg = bg[mask]
-
         return point_cld, mean3_sq_dist, bg
 
+    def get_camera_rays(self, intrinsics, width, height, stride):
+        """
+        Function to get the camera rays [H/stride * W/stride, 3] of the strided
+        pixel grid at depth 1, cached per intrinsics, image size and stride.
+        """
+        key = (tuple(intrinsics[:2, :3].flatten().tolist()), width, height, stride)
+        if key not in self.ray_cache.keys():
+            x_grid, y_grid = torch.meshgrid(torch.arange(0, width, stride).to(self.device).float(), 
+                                            torch.arange(0, height, stride).to(self.device).float(),
+                                            indexing='xy')
+            xx = (x_grid - intrinsics[0][2])/intrinsics[0][0]
+            yy = (y_grid - intrinsics[1][2])/intrinsics[1][1]
+            self.ray_cache[key] = torch.stack(
+                (xx.reshape(-1), yy.reshape(-1), torch.ones_like(xx).reshape(-1)), dim=-1)
+        return self.ray_cache[key]
+
     def get_complete_pointcloud(self):
         
         params = np.load(os.path.join(
@@ -116,7 +149,7 @@ class GaussianScene():
         point_cld = torch.cat([point_cld, color, seg_colors], dim=-1)
         transformed_pts = point_cld[:, :3]
         
-        dist, _ = torch_3d_knn(point_cld[:, :3].contiguous().float(), num_knn=4)
+        dist, _ = torch_3d_knn(point_cld[:, :3].contiguous().float(), num_knn=4, backend=self.knn_backend)
         dist = dist[:, 1:]
         mean3_sq_dist = dist.mean(-1).clip(min=0.0000001)
         point_cld = point_cld[mean3_sq_dist<0.01]
@@ -146,15 +179,13 @@ class GaussianScene():
         else:
             raise ValueError(f"Unknown gaussian_distribution {gaussian_distribution}")
 
-        unnorm_rotations = torch.zeros((num_pts, 4, self.num_frames), dtype=torch.float32).to(self.device)
-        unnorm_rotations[:, 0, :] = 1
-        means3D = torch.zeros((num_pts, 3, self.num_frames), dtype=torch.float32).to(self.device)
-        means3D[:, :, 0] = init_pt_cld[:, :3]
+        unnorm_rotations = torch.zeros((num_pts, 4), dtype=torch.float32).to(self.device)
+        unnorm_rotations[:, 0] = 1
 
         params = {
-                'means3D': means3D[:, :, 0],
+                'means3D': init_pt_cld[:, :3],
                 'rgb_colors': init_pt_cld[:, 3:6],
-                'unnorm_rotations': unnorm_rotations[:, :, 0],
+                'unnorm_rotations': unnorm_rotations,
                 'logit_opacities': logit_opacities,
                 'log_scales': log_scales,
                 'instseg': init_pt_cld[:, 6].to(self.device).long()
@@ -180,22 +211,27 @@ class GaussianScene():
             else:
                 params[k] = torch.nn.Parameter(v.to(self.device).float().contiguous().requires_grad_(True))
         
-        all_log_scales = torch.zeros(params['means3D'].shape[0], self.num_frames).to(self.device).float()
-
         variables = {
-            'max_2D_radius': torch.zeros(means3D.shape[0]).to(self.device).float(),
-            'means2D_gradient_accum': torch.zeros(means3D.shape[0], dtype=torch.float32).to(self.device),
+            'max_2D_radius': torch.zeros(num_pts).to(self.device).float(),
+            'means2D_gradient_accum': torch.zeros(num_pts, dtype=torch.float32).to(self.device),
             'denom': torch.zeros(params['means3D'].shape[0]).to(self.device).float(),
             'timestep': torch.zeros(params['means3D'].shape[0]).to(self.device).float(),
-            'visibility': torch.zeros(params['means3D'].shape[0], self.num_frames).to(self.device).float(),
-            'rgb_colors': torch.zeros(params['means3D'].shape[0], 3, self.num_frames).to(self.device).float(),
-            'log_scales': all_log_scales if gaussian_distribution == "isotropic" else torch.tile(all_log_scales[..., None], (1, 1, 3)).permute(0, 2, 1),
-            "means3D": means3D.cpu().float(),
-            "unnorm_rotations": unnorm_rotations.cpu().float()}
+            'visibility': self.init_trajectory_store('visibility', ()),
+            'rgb_colors': self.init_trajectory_store('rgb_colors', (3,)),
+            'log_scales': self.init_trajectory_store('log_scales', () if gaussian_distribution == "isotropic" else (3,)),
+            "means3D": self.init_trajectory_store('means3D', (3,)),
+            "unnorm_rotations": self.init_trajectory_store('unnorm_rotations', (4,), fill_value=[1, 0, 0, 0])}
+        for k in ['visibility', 'rgb_colors', 'log_scales']:
+            variables[k].append(torch.zeros((num_pts,) + variables[k].channels), 0)
+        variables['means3D'].append(params['means3D'], 0)
+        variables['unnorm_rotations'].append(params['unnorm_rotations'], 0)
         
         self.params = params
         self.variables = variables
 
+        if self.neighbor_index is not None:
+            self.neighbor_index.add(params['instseg'])
+
 
     def initialize_timestep(self, scene_radius_depth_ratio, \
             mean_sq_dist_method, gaussian_distribution=None, timestep=0, w2c=None, data=None):
@@ -286,10 +322,10 @@ class GaussianScene():
             else:
                 params[k] = torch.nn.Parameter(v.to(self.device).float().contiguous().requires_grad_(True))
         
+        # birth values, appended to the trajectory stores
         variables = {
-            'means3D': torch.zeros((num_pts, 3, self.num_frames), dtype=torch.float32),
-            'unnorm_rotations': params['unnorm_rotations'].detach().clone().unsqueeze(2).repeat(1, 1, self.num_frames).cpu()}
-        variables['means3D'][:, :, :time_idx+1] = params['means3D'].detach().clone().unsqueeze(2).repeat(1, 1, time_idx+1).cpu()
+            'means3D': params['means3D'].detach().clone(),
+            'unnorm_rotations': params['unnorm_rotations'].detach().clone()}
 
         return params, variables
     
@@ -405,32 +441,41 @@ class GaussianScene():
         
             # cat new and old params
             for k, v in new_params.items():
-                self.params[k] = torch.nn.Parameter(torch.cat((self.params[k], v), dim=0).requires_grad_(True))
+                self.params[k] = torch.nn.Parameter(
+                    append_rows(self.buffers, f'params.{k}', self.params[k], v).requires_grad_(True))
+            if self.neighbor_index is not None:
+                self.neighbor_index.add(new_params['instseg'])
             
             # update variables
             self.init_reset('max_2D_radius', 0, (num_gaussians))
             self.init_reset('denom', 0, (num_gaussians))
             self.init_reset('means2D_gradient_accum', 0, (num_gaussians))
 
-            self.init_new_var('visibility', 0, (num_new_gauss, self.num_frames))
-            self.init_new_var('rgb_colors', 0, (num_new_gauss, 3, self.num_frames))
             self.init_new_var('timestep', time_idx, (num_new_gauss))
-            if gaussian_distribution == "anisotropic":
-                self.init_new_var('log_scales', 0, (num_new_gauss, 3, self.num_frames))
-            else:
-                self.init_new_var('log_scales', 0, (num_new_gauss, self.num_frames))
-
-            self.cat_old_new('means3D', new_variables)
-            self.cat_old_new('unnorm_rotations', new_variables)
+            for k in ['visibility', 'rgb_colors', 'log_scales']:
+                self.variables[k].append(torch.zeros(
+                    (num_new_gauss,) + self.variables[k].channels), time_idx)
+            self.variables['means3D'].append(new_variables['means3D'], time_idx)
+            self.variables['unnorm_rotations'].append(new_variables['unnorm_rotations'], time_idx)
 
     def init_reset(self, k, val, shape):
-        self.variables[k] = val*torch.ones(shape, device=self.device).float().contiguous()
+        self.variables[k] = self.buffers.reset(f'variables.{k}', shape, val, self.device)
 
     def init_new_var(self, k, val, shape):
-        self.variables[k] = torch.cat((self.variables[k], val*torch.ones(shape, device=self.device, dtype=float)), dim=0).contiguous()
+        self.variables[k] = append_rows(
+            self.buffers, f'variables.{k}', self.variables[k], val*torch.ones(shape, device=self.device).float())
 
     def cat_old_new(self, k, new_variables):
-        self.variables[k] = torch.cat((self.variables[k], new_variables[k]), dim=0).contiguous()
+        self.variables[k] = append_rows(self.buffers, f'variables.{k}', self.variables[k], new_variables[k])
+
+    def init_trajectory_store(self, k, channels, fill_value=None):
+        return TrajectoryStore(
+            channels,
+            self.num_frames,
+            chunk_size=self.traj_chunk_size,
+            fill_value=fill_value,
+            storage_dir=os.path.join(self.traj_storage_dir, k) if self.traj_storage_dir is not None else None,
+            storage=self.traj_precision.get(k, 'float32'))
 
     def update_params_for_saving(self, duration, sec_per_frame, first_frame_w2c, orig_width, orig_height, desired_width, desired_height):
         # Add Camera Parameters to Save them
@@ -451,15 +496,15 @@ class GaussianScene():
             else:
                 self.params['gauss_ids_to_track'] = self.variables['gauss_ids_to_track']
 
-        self.params['visibility'] = self.variables['visibility']
-        self.params['rgb_colors'] = self.variables['rgb_colors'].float()
-        self.params['log_scales'] = self.variables['log_scales'].float()
-        self.params['means3D'] = self.variables['means3D'].float()
-        self.params['unnorm_rotations'] = self.variables['unnorm_rotations'].float()
+        # histories stay stores, memory-mapped ones are saved as they are, the others
+        # as dense [N, C, T] in the numpy dtype closest to their storage precision
+        for k in ['visibility', 'rgb_colors', 'log_scales', 'means3D', 'unnorm_rotations']:
+            self.params[k] = self.variables[k]
         self.params['logit_opacities'] = self.params['logit_opacities'].detach().clone().float()
         
-        self.params['self_indices'] = self.variables['self_indices']
-        self.params['neighbor_indices'] = self.variables['neighbor_indices']
+        # expand the CSR neighbor graph to the saved self / neighbor index format
+        self.params['self_indices'] = self.variables['neighbor_graph'].rows.long()
+        self.params['neighbor_indices'] = self.variables['neighbor_graph'].indices.long()
         self.params['scene_radius'] = self.variables['scene_radius']
         self.params['duration'] = np.array([sec_per_frame])
         self.params['overall_duration'] = np.array([duration])
@@ -470,7 +515,9 @@ class GaussianScene():
 
     def update_params(self, k, time_idx):
         if k in self.variables.keys():
-            if len(self.variables[k].shape) == 3:
+            if isinstance(self.variables[k], TrajectoryStore):
+                self.variables[k].set_frame(time_idx, self.params[k].detach())
+            elif len(self.variables[k].shape) == 3:
                 self.variables[k][:, :, time_idx] = self.params[k].detach().clone().squeeze()
             else:
                 self.variables[k][:, time_idx] = self.params[k].detach().clone().squeeze()
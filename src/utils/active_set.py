@@ -0,0 +1,63 @@
+import torch
+
+
+class ActiveSet():
+    """
+    Per-Gaussian parameters split into a frozen buffer of all Gaussians and
+    a trainable Parameter of the active rows (e.g., the Gaussians born in
+    the current frame). The optimizer only holds the active rows, s.t. the
+    gradients of the parameter leaves, the Adam state and the Adam steps
+    scale with the active subset. Before every forward pass the full tensors
+    are assembled from the frozen buffer and the active rows (a
+    concatenation if the active rows are the last ones). Equivalent to
+    zeroing the gradients of the frozen rows with hooks, as long as their
+    Adam moments are zero. The frozen buffers share the storage of the
+    original Parameters, merge writes the active rows back in place and
+    puts the original Parameters back, s.t. no full copy is made and the
+    growth buffers still hold the parameters.
+    """
+    def __init__(self, params, keys, active):
+        self.keys = [k for k in keys if k in params.keys()]
+        self.idx = torch.nonzero(active).squeeze(1)
+        num_rows = active.shape[0]
+        num_active = self.idx.shape[0]
+        # active rows are the tail, e.g., Gaussians appended in this frame
+        self.tail_start = num_rows - num_active \
+            if bool(active[num_rows - num_active:].all()) else None
+        self.params = dict()
+        self.frozen = dict()
+        self.active = dict()
+        for k in self.keys:
+            self.params[k] = params[k]
+            self.frozen[k] = params[k].detach()
+            self.active[k] = torch.nn.Parameter(
+                params[k].detach()[self.idx].clone().contiguous().requires_grad_(True))
+
+    def optimizer_params(self, params):
+        """
+        Function to get the parameters to optimize, active rows for the keys
+        of the active set
+        """
+        return {k: self.active[k] if k in self.keys else v for k, v in params.items()}
+
+    def assemble(self, params):
+        """
+        Function to set the full tensors of the active set keys in params
+        """
+        for k in self.keys:
+            if self.tail_start is not None:
+                params[k] = torch.cat((self.frozen[k][:self.tail_start], self.active[k]), dim=0)
+            else:
+                params[k] = self.frozen[k].index_put((self.idx,), self.active[k])
+        return params
+
+    def merge(self, params):
+        """
+        Function to write the active rows back in place and set the original
+        Parameters in params
+        """
+        for k in self.keys:
+            with torch.no_grad():
+                self.frozen[k][self.idx] = self.active[k].detach()
+            params[k] = self.params[k]
+        return params
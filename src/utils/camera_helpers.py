@@ -1,6 +1,13 @@
 import torch
-from diff_gaussian_rasterization_w_dwv import GaussianRasterizationSettings as Camera
+from collections import namedtuple
 import numpy as np
+try:
+    from diff_gaussian_rasterization_w_dwv import GaussianRasterizationSettings as Camera
+except ImportError:
+    # same fields as the CUDA rasterizer settings, e.g., for the torch rasterizer backend
+    Camera = namedtuple('GaussianRasterizationSettings', [
+        'image_height', 'image_width', 'tanfovx', 'tanfovy', 'bg', 'scale_modifier',
+        'viewmatrix', 'projmatrix', 'sh_degree', 'campos', 'prefiltered'])
 
 
 def as_intrinsics_matrix(intrinsics):
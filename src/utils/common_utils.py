@@ -3,6 +3,8 @@ import os
 import numpy as np
 import random
 import torch
+from src.utils.neighbor_graph import load_neighbor_graph
+from src.utils.trajectory_store import TrajectoryStore, load_trajectory_stores
 
 
 def seed_everything(seed=42):
@@ -28,6 +30,16 @@ def params2cpu(params):
             res[k] = v.detach().cpu().contiguous().numpy()
         elif isinstance(v, list):
             res[k] = torch.stack(v).detach().cpu().contiguous().numpy()
+        elif isinstance(v, TrajectoryStore) and v.storage_dir is not None:
+            # memory-mapped chunks are kept in place, only their directory is stored
+            res[k] = np.array(os.path.abspath(v.save()))
+        elif isinstance(v, TrajectoryStore):
+            # saved dense [N, C, T] as before, half precision for reduced storage
+            res[k] = v.to_dense(compact=True).contiguous().numpy()
+        elif hasattr(v, 'state_dict'):
+            # e.g., neighbor graph, stored flat as key.name
+            for name, t in v.state_dict().items():
+                res[f"{k}.{name}"] = t.detach().cpu().contiguous().numpy()
         else:
             res[k] = v
     return res
@@ -83,13 +95,17 @@ def load_params_ckpt(output_dir, device):
         else:
             _params = dict()
             for k, v in params.items():
-                if (v != np.array(None)).all():
+                if v.dtype.kind == 'U':
+                    # directory of a saved trajectory store
+                    _params[k] = str(v)
+                elif (v != np.array(None)).all():
                     _params[k] = torch.from_numpy(v).to(device)
                     if k == 'gt_w2c_all_frames':
                         _params[k] = [w2c_time for w2c_time in v]
                 else:
                     _params[k] = v
-            params = _params
+            params = load_neighbor_graph(_params, device)
+            params = load_trajectory_stores(params)
             # params = {k: torch.from_numpy(v).to(device) for k, v in params.items() if v is not None}
         loaded_params.append(params)
     return loaded_params
@@ -17,14 +17,16 @@
 
 import numpy as np
 import torch
-from torch_scatter import scatter_add
+from torch_scatter import segment_csr
+from src.utils.trajectory_store import TrajectoryStore
+from src.utils.growth_buffers import append_rows, keep_rows
 import torch.nn.functional as F
 
 
 def build_rotation(q):
     norm = torch.sqrt(q[:, 0] * q[:, 0] + q[:, 1] * q[:, 1] + q[:, 2] * q[:, 2] + q[:, 3] * q[:, 3]) + 1e-20
     q = q / norm[:, None]
-    rot = torch.zeros((q.size(0), 3, 3), device='cuda')
+    rot = torch.zeros((q.size(0), 3, 3), device=q.device)
     r = q[:, 0]
     x = q[:, 1]
     y = q[:, 2]
@@ -81,19 +83,23 @@ def update_params_and_optimizer(new_params, params, optimizer):
     return params
 
 
-def cat_params_to_optimizer(new_params, params, optimizer):
+def cat_params_to_optimizer(new_params, params, optimizer, buffers=None):
     for k, v in new_params.items():
         group = [g for g in optimizer.param_groups if g['name'] == k][0]
         stored_state = optimizer.state.get(group['params'][0], None)
         if stored_state is not None:
-            stored_state["exp_avg"] = torch.cat((stored_state["exp_avg"], torch.zeros_like(v)), dim=0)
-            stored_state["exp_avg_sq"] = torch.cat((stored_state["exp_avg_sq"], torch.zeros_like(v)), dim=0)
+            stored_state["exp_avg"] = append_rows(
+                buffers, f'exp_avg.{k}', stored_state["exp_avg"], torch.zeros_like(v))
+            stored_state["exp_avg_sq"] = append_rows(
+                buffers, f'exp_avg_sq.{k}', stored_state["exp_avg_sq"], torch.zeros_like(v))
             del optimizer.state[group['params'][0]]
-            group["params"][0] = torch.nn.Parameter(torch.cat((group["params"][0], v), dim=0).requires_grad_(True))
+            group["params"][0] = torch.nn.Parameter(append_rows(
+                buffers, f'params.{k}', group["params"][0], v).requires_grad_(True))
             optimizer.state[group['params'][0]] = stored_state
             params[k] = group["params"][0]
         else:
-            group["params"][0] = torch.nn.Parameter(torch.cat((group["params"][0], v), dim=0).requires_grad_(True))
+            group["params"][0] = torch.nn.Parameter(append_rows(
+                buffers, f'params.{k}', group["params"][0], v).requires_grad_(True))
             params[k] = group["params"][0]
     return params
 
@@ -103,13 +109,11 @@ def remove_points(
         params,
         variables,
         optimizer=None,
-        time_idx=0):
+        time_idx=0,
+        neighbor_index=None,
+        buffers=None):
 
     to_keep = ~to_remove
-    idxs_to_keep = torch.arange(params['means3D'].shape[0])[to_keep].to(
-        variables['self_indices'].device)
-    to_keep_idx_mask = torch.isin(variables['self_indices'], idxs_to_keep) 
-    to_keep_idx_mask = to_keep_idx_mask & torch.isin(variables['neighbor_indices'], idxs_to_keep)
     prev_time = variables['timestep'] < time_idx
 
     num_gaussians = params['means3D'].shape[0]
@@ -121,37 +125,39 @@ def remove_points(
         stored_state = optimizer.state.get(group['params'][0], None)
 
         if stored_state is not None:
-            stored_state["exp_avg"] = stored_state["exp_avg"][to_keep]
-            stored_state["exp_avg_sq"] = stored_state["exp_avg_sq"][to_keep]
+            stored_state["exp_avg"] = keep_rows(
+                buffers, f'exp_avg.{k}', stored_state["exp_avg"], to_keep)
+            stored_state["exp_avg_sq"] = keep_rows(
+                buffers, f'exp_avg_sq.{k}', stored_state["exp_avg_sq"], to_keep)
             del optimizer.state[group['params'][0]]
-            group["params"][0] = torch.nn.Parameter((group["params"][0][to_keep].requires_grad_(True)))
+            group["params"][0] = torch.nn.Parameter(keep_rows(
+                buffers, f'params.{k}', group["params"][0], to_keep).requires_grad_(True))
             optimizer.state[group['params'][0]] = stored_state
             params[k] = group["params"][0]
         else:
-            group["params"][0] = torch.nn.Parameter(group["params"][0][to_keep].requires_grad_(True))
+            group["params"][0] = torch.nn.Parameter(keep_rows(
+                buffers, f'params.{k}', group["params"][0], to_keep).requires_grad_(True))
             params[k] = group["params"][0]
 
     for k, v in variables.items():
-        if k in ['scene_radius', 'last_time_idx'] or v is None:
+        if k in ['scene_radius', 'last_time_idx', 'neighbor_graph'] or v is None:
             continue
         # mask variables
-        if k == 'offset_0' and variables['offset_0'] is not None:
-            variables['offset_0'] = variables['offset_0'][to_keep_idx_mask]
-            variables[k] = v[to_keep_idx_mask].contiguous()
-        elif type(v) == list:
+        if type(v) == list:
             continue
+        elif isinstance(v, TrajectoryStore):
+            v.keep(to_keep)
         elif v.shape[0] == num_gaussians:
-            variables[k] = v[to_keep].contiguous()
+            variables[k] = keep_rows(buffers, f'variables.{k}', v, to_keep).contiguous()
         elif v.shape[0] == num_gaussians_prev:
-            variables[k] = v[to_keep[prev_time]].contiguous()
-        elif v.shape[0] == to_keep_idx_mask.shape[0]:
-            variables[k] = v[to_keep_idx_mask].contiguous()
+            variables[k] = keep_rows(buffers, f'variables.{k}', v, to_keep[prev_time]).contiguous()
 
-    mapping_tensor = torch.zeros(idxs_to_keep.max().item() + 1).long().to(idxs_to_keep.device)
-    mapping_tensor[idxs_to_keep] = torch.arange(idxs_to_keep.shape[0]).long().to(idxs_to_keep.device)
+    # compact neighbor graph (rows, edges and offset_0) and remap indices
+    if 'neighbor_graph' in variables.keys():
+        variables['neighbor_graph'].remove(to_remove)
 
-    variables['neighbor_indices'] = mapping_tensor[variables['neighbor_indices']]
-    variables['self_indices'] = mapping_tensor[variables['self_indices']]
+    if neighbor_index is not None:
+        neighbor_index.remove(to_remove)
 
     return params, variables
 
@@ -173,7 +179,9 @@ def prune_gaussians(
         optimizer,
         iter,
         prune_dict,
-        curr_time_idx):
+        curr_time_idx,
+        neighbor_index=None,
+        buffers=None):
     
     pruned = False
     if iter <= prune_dict['stop_after']:
@@ -190,16 +198,7 @@ def prune_gaussians(
             # Remove Gaussians with large kNN dist
             # recompute kNN distance
             with torch.no_grad():
-                pdist = torch.nn.PairwiseDistance(p=2)
-                offset_t_mag = pdist(
-                    params['means3D'][variables["self_indices"]],
-                    params['means3D'][variables["neighbor_indices"]])
-                offset_t_mag = scatter_add(offset_t_mag, variables["self_indices"], dim=0)
-                
-                offset_0_mag = torch.linalg.norm(variables['offset_0'], dim=1)
-                offset_0_mag = scatter_add(offset_0_mag, variables["self_indices"], dim=0)
-
-                rel_drift = torch.abs(offset_t_mag-offset_0_mag) / offset_0_mag
+                rel_drift = variables['neighbor_graph'].relative_drift(params['means3D'])
                 drift = rel_drift * 100 > prune_dict['kNN_rel_drift']
                 to_remove[variables['timestep']<curr_time_idx] = torch.logical_or(
                     to_remove[variables['timestep']<curr_time_idx],
@@ -216,7 +215,8 @@ def prune_gaussians(
                     variables,
                     optimizer,
                     time_idx=curr_time_idx,
-                    )
+                    neighbor_index=neighbor_index,
+                    buffers=buffers)
             torch.cuda.empty_cache()
             print(f'Removed {to_remove.sum()} Gaussians during pruning at Iteration {iter} - {opa_remove_sum} by opacity, {drift.sum()} because of drift, {big_points_ws.sum()} because of scale!')
         
@@ -227,10 +227,9 @@ def prune_gaussians(
     
     return params, variables, pruned
 
-def clone_vars(params, variables, to_clone, time_idx):
-    device = variables['self_indices'].device
+def clone_vars(params, variables, to_clone, time_idx, buffers=None):
+    device = variables['timestep'].device
     idxs_to_clone = torch.arange(params['means3D'].shape[0])[to_clone].to(device)
-    to_clone_self_idx = torch.isin(variables['self_indices'], idxs_to_clone)
     to_clone = to_clone.to(device)
     prev_mask = variables['timestep'] < time_idx
 
@@ -238,28 +237,25 @@ def clone_vars(params, variables, to_clone, time_idx):
         if type(v)==torch.Tensor:
             if len(v.shape) == 0:
                 continue
-            if v.shape[0] == to_clone_self_idx.shape[0] and k != 'self_indices':
-                variables[k] = torch.cat(
-                    (variables[k], variables[k][to_clone_self_idx].clone()), dim=0)
-            elif v.shape[0] == params['means3D'].shape[0]:
-                variables[k] = torch.cat((variables[k], variables[k][to_clone].clone()), dim=0)
+            if v.shape[0] == params['means3D'].shape[0]:
+                variables[k] = append_rows(
+                    buffers, f'variables.{k}', variables[k], variables[k][to_clone].clone())
             elif v.shape[0] == prev_mask.sum():
-                variables[k] = torch.cat((variables[k], variables[k][to_clone[prev_mask]].clone()), dim=0)
+                variables[k] = append_rows(
+                    buffers, f'variables.{k}', variables[k], variables[k][to_clone[prev_mask]].clone())
+        elif isinstance(v, TrajectoryStore):
+            v.duplicate(idxs_to_clone)
 
-    self_idxs = variables['self_indices'][to_clone_self_idx]
-    mapping_tensor = torch.zeros(to_clone.shape[0]).long().to(to_clone.device)
-    mapping_tensor[idxs_to_clone] = to_clone.shape[0] + torch.arange(
-        idxs_to_clone.shape[0]).long().to(idxs_to_clone.device)
-    variables['self_indices'] = torch.cat(
-        (variables['self_indices'], mapping_tensor[self_idxs]), dim=0)
+    # cloned Gaussians get the edges of their source
+    if 'neighbor_graph' in variables.keys():
+        variables['neighbor_graph'].clone_rows(idxs_to_clone, to_clone.shape[0])
 
     return variables
 
 
-def split_vars(params, variables, to_split, n, time_idx):
-    device = variables['self_indices'].device
+def split_vars(params, variables, to_split, n, time_idx, buffers=None):
+    device = variables['timestep'].device
     idxs_to_split = torch.arange(params['means3D'].shape[0])[to_split].to(device)
-    to_split_self_idx = torch.isin(variables['self_indices'], idxs_to_split)
     to_split = to_split.to(device)
     prev_mask = variables['timestep'] < time_idx
 
@@ -274,26 +270,26 @@ def split_vars(params, variables, to_split, n, time_idx):
             elif len(v.shape) == 3:
                 rep = (n, 1, 1)
 
-            if v.shape[0] == to_split_self_idx.shape[0] and k != 'self_indices':
-                variables[k] = torch.cat(
-                    (variables[k], variables[k][to_split_self_idx].repeat(rep).clone()), dim=0)
-            elif v.shape[0] == params['means3D'].shape[0]:
-                variables[k] = torch.cat((variables[k], variables[k][to_split].repeat(rep).clone()), dim=0)
+            if v.shape[0] == params['means3D'].shape[0]:
+                variables[k] = append_rows(
+                    buffers, f'variables.{k}', variables[k], variables[k][to_split].repeat(rep).clone())
             elif v.shape[0] == prev_mask.sum():
-                variables[k] = torch.cat((variables[k], variables[k][to_split[prev_mask]].repeat(rep).clone()), dim=0)
-
-    # update new self-indices
-    self_idxs = variables['self_indices'][to_split_self_idx]
-    mapping_tensor = torch.zeros(to_split.shape[0]).long().to(to_split.device)
-    mapping_tensor[idxs_to_split] = to_split.shape[0] + torch.arange(
-        idxs_to_split.shape[0]).long().to(idxs_to_split.device)
-    variables['self_indices'] = torch.cat(
-        (variables['self_indices'], mapping_tensor[self_idxs]), dim=0)
+                variables[k] = append_rows(
+                    buffers, f'variables.{k}', variables[k], variables[k][to_split[prev_mask]].repeat(rep).clone())
+        elif isinstance(v, TrajectoryStore):
+            for _ in range(n):
+                v.duplicate(idxs_to_split)
+
+    # every split Gaussian gets the edges of its source
+    if 'neighbor_graph' in variables.keys():
+        for i in range(n):
+            variables['neighbor_graph'].clone_rows(
+                idxs_to_split, to_split.shape[0] + i * idxs_to_split.shape[0])
 
     return variables
 
 
-def densify(params, variables, optimizer, iter, densify_dict, time_idx, do_remove=False):
+def densify(params, variables, optimizer, iter, densify_dict, time_idx, do_remove=False, neighbor_index=None, buffers=None):
     device = params['means3D'].device
     densified = False
 
@@ -316,8 +312,10 @@ def densify(params, variables, optimizer, iter, densify_dict, time_idx, do_remov
 
             if to_clone.sum():
                 new_params = {k: v[to_clone].clone() for k, v in params.items() if k not in ['cam_unnorm_rots', 'cam_trans']}
-                variables = clone_vars(params, variables, to_clone, time_idx)
-                params = cat_params_to_optimizer(new_params, params, optimizer)
+                variables = clone_vars(params, variables, to_clone, time_idx, buffers=buffers)
+                params = cat_params_to_optimizer(new_params, params, optimizer, buffers=buffers)
+                if neighbor_index is not None:
+                    neighbor_index.add(new_params['instseg'])
 
             # split
             num_pts = params['means3D'].shape[0]
@@ -343,7 +341,7 @@ def densify(params, variables, optimizer, iter, densify_dict, time_idx, do_remov
                             new_params[k] = v[to_split].repeat(n).clone()
 
                 # split variables
-                variables = split_vars(params, variables, to_split, n, time_idx)
+                variables = split_vars(params, variables, to_split, n, time_idx, buffers=buffers)
                 # update means and scales of new
                 if params['log_scales'].shape[-1] == 1:
                     stds = torch.exp(params['log_scales'])[to_split].repeat(n, 3)
@@ -366,12 +364,16 @@ def densify(params, variables, optimizer, iter, densify_dict, time_idx, do_remov
                 params['means3D'][to_split] += torch.bmm(rots, samples.unsqueeze(-1)).squeeze(-1)
                 params['log_scales'][to_split] = torch.log(torch.exp(params['log_scales'][to_split]) / (0.8 * n+1))
                 # cat new and prev
-                params = cat_params_to_optimizer(new_params, params, optimizer)
+                params = cat_params_to_optimizer(new_params, params, optimizer, buffers=buffers)
+                if neighbor_index is not None:
+                    neighbor_index.add(new_params['instseg'])
 
             num_pts = params['means3D'].shape[0]
-            variables['means2D_gradient_accum'] = torch.zeros(num_pts, device="cuda")
-            variables['denom'] = torch.zeros(num_pts, device="cuda")
-            variables['max_2D_radius'] = torch.zeros(num_pts, device="cuda")
+            for k in ['means2D_gradient_accum', 'denom', 'max_2D_radius']:
+                if buffers is not None:
+                    variables[k] = buffers.reset(f'variables.{k}', num_pts, 0, device=device)
+                else:
+                    variables[k] = torch.zeros(num_pts, device="cuda")
             
             # if to_split.sum():
             #     to_remove = torch.cat((to_split, torch.zeros(n * to_split.sum(), dtype=torch.bool, device="cuda")))
@@ -383,11 +385,12 @@ def densify(params, variables, optimizer, iter, densify_dict, time_idx, do_remov
                 # Remove Gaussians with large kNN dist
                 # recompute kNN distance
                 with torch.no_grad():
+                    graph = variables['neighbor_graph']
                     pdist = torch.nn.PairwiseDistance(p=2)
                     dist = pdist(
-                        params['means3D'][variables["self_indices"], :],
-                        params['means3D'][variables["neighbor_indices"], :])
-                    dist = scatter_add(dist, variables["self_indices"], dim=0) 
+                        params['means3D'].index_select(0, graph.rows),
+                        params['means3D'].index_select(0, graph.indices))
+                    dist = segment_csr(dist, graph.offsets.long())
                     far_away = torch.logical_and(dist < densify_dict['kNN_dist_thresh_max'] * variables['scene_radius'],
                             dist > densify_dict['kNN_dist_thresh_min'] * variables['scene_radius'])
                 # opacity
@@ -401,7 +404,9 @@ def densify(params, variables, optimizer, iter, densify_dict, time_idx, do_remov
                     big_points_ws = torch.exp(params['log_scales']).max(dim=1).values > 10000000000 # 0.1 * variables['scene_radius']
                     to_remove = torch.logical_or(to_remove_opa, big_points_ws)
                 if to_remove.sum():
-                    params, variables = remove_points(to_remove, params, variables, optimizer, time_idx=time_idx)
+                    params, variables = remove_points(
+                        to_remove, params, variables, optimizer, time_idx=time_idx, neighbor_index=neighbor_index,
+                        buffers=buffers)
                 torch.cuda.empty_cache()
                 print(f'Removed {to_remove.sum()} big Gaussians during densification at Iteration {iter}, {to_remove_opa.sum()} due to opacity and {big_points_ws.sum()} due to size!')
 
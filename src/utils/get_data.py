@@ -17,6 +17,7 @@ import json
 from itertools import product
 import cv2
 from src.utils.gaussian_utils import normalize_points
+from src.utils.trajectory_store import TrajectoryStore
 import copy
 
 
@@ -262,7 +263,10 @@ def load_scene_data(config=None, results_dir=None, device="cuda:0", file=None):
         
     _params = dict()
     for k, v in params.items():
-        if (v != np.array(None)).all():
+        if v.dtype.kind == 'U':
+            # memory-mapped trajectory store
+            _params[k] = TrajectoryStore.load(str(v))
+        elif (v != np.array(None)).all():
             _params[k] = torch.tensor(v).to(device).float()
         else:
             _params[k] = None
@@ -0,0 +1,125 @@
+import torch
+
+
+class GrowthBuffers():
+    """
+    Per-Gaussian tensors (parameters, Adam moments, variables) backed by
+    buffers with reserved capacity. The tensors handed out are views of the
+    first num_rows rows of their buffer, s.t. appending only writes the new
+    rows and the buffer is re-allocated by growth_factor once it is full,
+    i.e., appends are amortized O(new). Removing Gaussians compacts the live
+    rows in place.
+
+    Tensors that are not backed by a buffer yet (e.g., the Adam moments of a
+    freshly initialized optimizer) are copied into one on their first append.
+    copied_bytes counts all copies of existing rows, appended_bytes the
+    written new rows. If in_place is False, tensors are concatenated as
+    before and only the copy volume is counted.
+    """
+    def __init__(self, in_place=True, growth_factor=2.0):
+        self.in_place = in_place
+        self.growth_factor = max(growth_factor, 1.0)
+        self.buffers = dict()
+        self.copied_bytes = 0
+        self.appended_bytes = 0
+
+    @staticmethod
+    def _num_bytes(tensor):
+        return tensor.numel() * tensor.element_size()
+
+    def holds(self, key, tensor):
+        """
+        Function to check if tensor is the live view of the buffer of key
+        """
+        buffer = self.buffers.get(key, None)
+        return buffer is not None \
+            and tensor.data_ptr() == buffer.data_ptr() \
+            and tensor.shape[1:] == buffer.shape[1:] \
+            and tensor.dtype == buffer.dtype \
+            and tensor.device == buffer.device \
+            and tensor.shape[0] <= buffer.shape[0] \
+            and tensor.is_contiguous()
+
+    def _allocate(self, key, tensor, num_rows):
+        # reserve capacity and copy over the live rows
+        capacity = max(int(num_rows * self.growth_factor), num_rows, 1)
+        buffer = torch.empty(
+            (capacity,) + tuple(tensor.shape[1:]), dtype=tensor.dtype, device=tensor.device)
+        buffer[:tensor.shape[0]] = tensor.detach()
+        self.copied_bytes += self._num_bytes(tensor)
+        self.buffers[key] = buffer
+        return buffer
+
+    def append(self, key, tensor, new_rows):
+        """
+        Function to append new_rows to tensor, returns the view of all rows
+        """
+        new_rows = new_rows.to(tensor.device).type(tensor.dtype)
+        self.appended_bytes += self._num_bytes(new_rows)
+        if not self.in_place:
+            self.copied_bytes += self._num_bytes(tensor)
+            return torch.cat((tensor.detach(), new_rows.detach()), dim=0).contiguous()
+
+        num_rows = tensor.shape[0]
+        total = num_rows + new_rows.shape[0]
+        if self.holds(key, tensor) and total <= self.buffers[key].shape[0]:
+            buffer = self.buffers[key]
+        else:
+            buffer = self._allocate(key, tensor, total)
+        buffer[num_rows:total] = new_rows.detach()
+        return buffer[:total]
+
+    def keep(self, key, tensor, to_keep):
+        """
+        Function to keep the rows of tensor in to_keep, in place if tensor is
+        backed by a buffer
+        """
+        kept = tensor.detach()[to_keep]
+        self.copied_bytes += self._num_bytes(kept)
+        if not self.in_place or not self.holds(key, tensor):
+            return kept.contiguous()
+        buffer = self.buffers[key]
+        buffer[:kept.shape[0]] = kept
+        return buffer[:kept.shape[0]]
+
+    def reset(self, key, num_rows, val, device, dtype=torch.float32):
+        """
+        Function to get num_rows rows of key set to val, reusing the buffer
+        """
+        buffer = self.buffers.get(key, None)
+        if not self.in_place or buffer is None or buffer.shape[0] < num_rows \
+                or buffer.dtype != dtype or buffer.device != torch.device(device) \
+                or len(buffer.shape) != 1:
+            if not self.in_place:
+                return val * torch.ones(num_rows, dtype=dtype, device=device)
+            buffer = torch.empty(
+                max(int(num_rows * self.growth_factor), num_rows, 1), dtype=dtype, device=device)
+            self.buffers[key] = buffer
+        buffer[:num_rows] = val
+        return buffer[:num_rows]
+
+    def pop_stats(self):
+        """
+        Function to get and reset the copy volume since the last call
+        """
+        copied_bytes, appended_bytes = self.copied_bytes, self.appended_bytes
+        self.copied_bytes, self.appended_bytes = 0, 0
+        return copied_bytes, appended_bytes
+
+
+def append_rows(buffers, key, tensor, new_rows):
+    """
+    Function to append new_rows to tensor via buffers if given
+    """
+    if buffers is None:
+        return torch.cat((tensor, new_rows), dim=0)
+    return buffers.append(key, tensor, new_rows)
+
+
+def keep_rows(buffers, key, tensor, to_keep):
+    """
+    Function to keep the rows of tensor in to_keep via buffers if given
+    """
+    if buffers is None:
+        return tensor[to_keep]
+    return buffers.keep(key, tensor, to_keep)
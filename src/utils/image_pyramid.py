@@ -0,0 +1,104 @@
+import torch
+import torch.nn.functional as F
+from src.utils.camera_helpers import setup_camera
+
+
+def downsample(x, scale, mode='area'):
+    """
+    Function to downsample the last two (image) dimensions of x by an
+    integer scale, averaging scale x scale blocks ('area') or taking the
+    center sample of every block ('nearest'), e.g., for depth with invalid
+    zeros or instance ids
+    """
+    if x is None or not torch.is_tensor(x) or x.dim() < 2 or scale == 1:
+        return x
+    height, width = x.shape[-2] // scale, x.shape[-1] // scale
+    if mode == 'area' and x.is_floating_point():
+        shape = x.shape
+        x = F.avg_pool2d(x.reshape(1, -1, shape[-2], shape[-1]), kernel_size=scale, stride=scale)
+        return x.reshape(*shape[:-2], height, width)
+    offset = scale // 2
+    return x[..., offset::scale, offset::scale][..., :height, :width].contiguous()
+
+
+def scale_intrinsics(k, scale):
+    """
+    Function to get the intrinsics of an image downsampled by scale, pixel
+    centers are at +0.5 of the projection, i.e., every pixel of the coarse
+    level is centered on its block of scale x scale pixels
+    """
+    k = k.clone()
+    k[:2, :3] = k[:2, :3] / scale
+    return k
+
+
+class ImagePyramid():
+    """
+    Coarse-to-fine schedule of a tracking phase. The first iterations
+    optimize against downsampled rgb, depth, embedding and bg targets
+    rendered with a scaled camera, the remaining ones at full resolution.
+    The coarse levels of a frame are built once in make_data_dict, the
+    cameras of the levels once per sequence from the full resolution one.
+    Level i of a phase with num_iters iterations starts at
+    int(sum(iter_fracs[:i]) * num_iters), level len(scales) is the full
+    resolution.
+    """
+    def __init__(self, scales=(), iter_fracs=(), phases=('tracking_obj', 'tracking_cam')):
+        assert len(scales) == len(iter_fracs), "Need a fraction of iterations per coarse level."
+        assert sum(iter_fracs) < 1, "Need iterations at full resolution."
+        self.scales = [int(s) for s in scales]
+        self.iter_fracs = list(iter_fracs)
+        self.phases = list(phases)
+        self.cams = None
+
+    def get_cameras(self, cam, intrinsics, device):
+        if self.cams is None:
+            w2c = cam.viewmatrix.squeeze(0).transpose(0, 1)
+            k = intrinsics[:3, :3].float()
+            self.cams = [
+                setup_camera(
+                    int(cam.image_width) // s,
+                    int(cam.image_height) // s,
+                    scale_intrinsics(k, s).cpu().numpy(),
+                    w2c.detach().cpu().numpy(),
+                    device=device)
+                for s in self.scales]
+        return self.cams
+
+    def build(self, curr_data, device):
+        """
+        Function to get the data of the coarse levels of a frame, coarsest
+        first
+        """
+        levels = list()
+        for s, cam in zip(self.scales, self.get_cameras(curr_data['cam'], curr_data['intrinsics'], device)):
+            level = dict(curr_data)
+            level['im'] = downsample(curr_data['im'], s)
+            level['depth'] = downsample(curr_data['depth'], s, mode='nearest')
+            level['embeddings'] = downsample(curr_data['embeddings'], s)
+            level['bg'] = downsample(curr_data['bg'], s)
+            level['instseg'] = downsample(curr_data['instseg'], s, mode='nearest')
+            level['intrinsics'] = scale_intrinsics(curr_data['intrinsics'], s)
+            level['cam'] = cam
+            levels.append(level)
+        return levels
+
+    def level_starts(self, num_iters, phase):
+        """
+        Function to get the first iteration of every level of a phase
+        """
+        if phase not in self.phases:
+            return [0] * (len(self.scales) + 1)
+        starts, frac = list(), 0
+        for f in self.iter_fracs:
+            starts.append(int(frac * num_iters))
+            frac += f
+        return starts + [int(frac * num_iters)]
+
+    def get_level(self, iter, starts):
+        return max(i for i, s in enumerate(starts) if s <= iter)
+
+    def get_level_data(self, curr_data, level):
+        if level == len(self.scales):
+            return curr_data
+        return curr_data['pyramid'][level]
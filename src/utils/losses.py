@@ -2,6 +2,7 @@ import torch
 import torch.nn.functional as F
 from utils.gaussian_utils import build_rotation
 from utils.gaussian_utils import quat_mult, build_rotation
+from src.utils.trajectory_store import get_frame
 import torch.nn.functional as func
 from torch.autograd import Variable
 from math import exp
@@ -108,15 +109,18 @@ def physics_based_losses(
         iter_time_idx,
         transformed_gaussians,
         variables,
-        offset_0,
         iter,
         use_iso,
         update_iso=False,
         post_init=True,
         device="cuda:0",
-        losses=None):
+        losses=None,
+        prev_frame=None):
 
-    weight = variables["neighbor_weight"].unsqueeze(1)
+    # CSR neighbor graph, rows and indices are int32 and used with index_select
+    graph = variables["neighbor_graph"]
+    self_indices, neighbor_indices = graph.rows, graph.indices
+    weight = graph.weight.unsqueeze(1)
     
     all_times = len(params["unnorm_rotations"].shape) == 3
     if all_times:
@@ -127,18 +131,26 @@ def physics_based_losses(
         curr_params = params
 
     # get relative rotation
-    other_rot = prev_params["unnorm_rotations"][:, :, iter_time_idx - 1].detach().clone().to(device)
-    other_rot[:, 1:] = -1 * other_rot[:, 1:]
-    other_means = prev_params["means3D"][:, :, iter_time_idx - 1].detach().clone().to(device)
+    if prev_frame is not None:
+        # previous frame materialized once per frame on the compute device
+        prev_frame = prev_frame.get(prev_params, iter_time_idx, graph=graph)
+        other_rot = prev_frame.inv_rots
+    else:
+        other_rot = get_frame(prev_params["unnorm_rotations"], iter_time_idx - 1).detach().clone().to(device)
+        other_rot[:, 1:] = -1 * other_rot[:, 1:]
+        other_means = get_frame(prev_params["means3D"], iter_time_idx - 1).detach().clone().to(device)
     curr_rot = curr_params["unnorm_rotations"]
     rel_rot = quat_mult(curr_rot, other_rot)
     rel_rot_mat = build_rotation(rel_rot)
 
     # rigid body
     curr_means = curr_params["means3D"]
-    offset = curr_means[variables["self_indices"]] - curr_means[variables["neighbor_indices"]]
-    offset_other_coord = (rel_rot_mat[variables["self_indices"]].transpose(2, 1) @ offset.unsqueeze(-1)).squeeze(-1)
-    other_offset = other_means[variables["self_indices"]] - other_means[variables["neighbor_indices"]]
+    offset = curr_means.index_select(0, self_indices) - curr_means.index_select(0, neighbor_indices)
+    offset_other_coord = (rel_rot_mat.index_select(0, self_indices).transpose(2, 1) @ offset.unsqueeze(-1)).squeeze(-1)
+    if prev_frame is not None:
+        other_offset = prev_frame.rest_offsets
+    else:
+        other_offset = other_means.index_select(0, self_indices) - other_means.index_select(0, neighbor_indices)
     loss_rigid = l2_loss_v2(
         offset_other_coord,
         other_offset,
@@ -146,27 +158,25 @@ def physics_based_losses(
 
     losses['rigid'] = loss_rigid
     losses['rot'] = l2_loss_v2(
-        rel_rot[variables["neighbor_indices"]],
-        rel_rot[variables["self_indices"]],
+        rel_rot.index_select(0, neighbor_indices),
+        rel_rot.index_select(0, self_indices),
         weight=weight)
 
     # store offset_0 and compute isometry
     if use_iso:
-        offset = curr_means[variables["self_indices"]] - curr_means[variables["neighbor_indices"]]
         if iter == 0 and update_iso:
             if iter_time_idx == 1:
-                offset_0 = offset.detach().clone()
+                graph.set_offset_0(offset.detach())
             else:
-                offset_0 = torch.cat(
-                    [offset_0,
-                    offset[variables['timestep'][
-                        variables["self_indices"]] == iter_time_idx-1].detach().clone()])
+                graph.set_offset_0(
+                    offset.detach(),
+                    variables['timestep'].index_select(0, self_indices) == iter_time_idx-1)
         losses['iso'] = l2_loss_v2(
             torch.sqrt((offset ** 2).sum(-1) + 1e-20),
-            torch.sqrt((offset_0 ** 2).sum(-1) + 1e-20),
+            torch.sqrt((graph.offset_0 ** 2).sum(-1) + 1e-20),
             weight=weight.squeeze())
 
-    return losses, offset_0
+    return losses
 
 
 def get_rendered_losses(config, losses, curr_data, im, depth, mask, embeddings, bg=None, load_embeddings=False, iter_time_idx=0, scene=None, device="cuda:0", l2_emb=True):
@@ -209,9 +219,13 @@ def get_rendered_losses(config, losses, curr_data, im, depth, mask, embeddings,
         # hard foce bg
         if iter_time_idx > 0:
             is_bg = scene.params['bg'].detach().clone().squeeze() > 0.5
+            if scene.prev_frame is not None:
+                prev_means = scene.prev_frame.get(scene.variables, iter_time_idx).means[is_bg]
+            else:
+                prev_means = get_frame(scene.variables['means3D'], iter_time_idx-1, ids=is_bg).to(device)
             losses['bg_reg'] = l1_loss_v1(
                 scene.params['means3D'][is_bg],
-                scene.variables['means3D'][:, :, iter_time_idx-1][is_bg].to(device))
+                prev_means)
 
         # bg loss with mask    
         losses['bg_loss'] = l1_loss_v1(
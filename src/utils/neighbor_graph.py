@@ -0,0 +1,246 @@
+import torch
+from torch_scatter import segment_csr
+
+
+def grow_buffer(buffer, size):
+    # grow buffer to at least size rows, doubling the capacity
+    new_buffer = torch.zeros(
+        (max(size, 2 * buffer.shape[0]),) + tuple(buffer.shape[1:]), dtype=buffer.dtype, device=buffer.device)
+    new_buffer[:buffer.shape[0]] = buffer
+    return new_buffer
+
+
+class NeighborGraph():
+    """
+    Compact CSR neighbor graph of the Gaussians. The neighbors of Gaussian i
+    are indices[offsets[i]:offsets[i+1]] with the weights at the same
+    positions. Offsets and indices are stored as int32, the rest offsets
+    (offset_0) of the isometry loss are stored per edge, too, so they stay
+    aligned with the edges on appends and compaction. All buffers keep spare
+    capacity, i.e., adding the edges of new Gaussians is amortized O(new).
+    """
+    edge_keys = ['rows', 'indices', 'weight', 'weight_sm', 'offset_0']
+
+    def __init__(self, device, row_capacity=1024, edge_capacity=16384):
+        self.device = device
+        self.num_rows = 0
+        self.num_edges = 0
+        # incremented on every change of the edges, like the in-place version of a tensor
+        self.version = 0
+        self._offsets = torch.zeros(row_capacity + 1, dtype=torch.int32, device=device)
+        self._rows = torch.zeros(edge_capacity, dtype=torch.int32, device=device)
+        self._indices = torch.zeros(edge_capacity, dtype=torch.int32, device=device)
+        self._weight = torch.zeros(edge_capacity, dtype=torch.float32, device=device)
+        self._weight_sm = torch.zeros(edge_capacity, dtype=torch.float32, device=device)
+        self._offset_0 = torch.zeros(edge_capacity, 3, dtype=torch.float32, device=device)
+
+    @property
+    def offsets(self):
+        return self._offsets[:self.num_rows + 1]
+
+    @property
+    def rows(self):
+        # row (self index) of every edge
+        return self._rows[:self.num_edges]
+
+    @property
+    def indices(self):
+        return self._indices[:self.num_edges]
+
+    @property
+    def weight(self):
+        return self._weight[:self.num_edges]
+
+    @property
+    def weight_sm(self):
+        return self._weight_sm[:self.num_edges]
+
+    @property
+    def offset_0(self):
+        return self._offset_0[:self.num_edges]
+
+    def set_offset_0(self, offset, mask=None):
+        if mask is None:
+            self._offset_0[:self.num_edges] = offset
+        else:
+            self.offset_0[mask] = offset[mask]
+
+    def reserve(self, num_rows, num_edges):
+        if num_rows + 1 > self._offsets.shape[0]:
+            self._offsets = grow_buffer(self._offsets, num_rows + 1)
+        if num_edges > self._indices.shape[0]:
+            for k in self.edge_keys:
+                setattr(self, f"_{k}", grow_buffer(getattr(self, f"_{k}"), num_edges))
+
+    def add_edges(self, self_indices, neighbor_indices, weight, weight_sm, offset_0=None, num_rows=None):
+        """
+        Function to add the edges of new rows, self_indices have to be sorted.
+        Rows up to num_rows without edges are added as empty rows. Appending
+        behind the last row is O(new), adding to existing rows rebuilds the
+        graph.
+        """
+        self.version += 1
+        if num_rows is None:
+            num_rows = self.num_rows if not self_indices.shape[0] else max(
+                self.num_rows, int(self_indices[-1].item()) + 1)
+        if offset_0 is None:
+            offset_0 = torch.zeros(self_indices.shape[0], 3, device=self.device)
+        if self_indices.shape[0] and int(self_indices[0].item()) < self.num_rows:
+            self._merge_edges(self_indices, neighbor_indices, weight, weight_sm, offset_0, num_rows)
+            return
+
+        num_new = self_indices.shape[0]
+        first_row = self.num_rows
+        self.reserve(num_rows, self.num_edges + num_new)
+        counts = torch.bincount(self_indices.long() - first_row, minlength=num_rows - first_row)
+        self._offsets[first_row + 1:num_rows + 1] = self.num_edges + torch.cumsum(counts, dim=0).int()
+        new_edges = slice(self.num_edges, self.num_edges + num_new)
+        self._rows[new_edges] = self_indices.int()
+        self._indices[new_edges] = neighbor_indices.int()
+        self._weight[new_edges] = weight.float()
+        self._weight_sm[new_edges] = weight_sm.float()
+        self._offset_0[new_edges] = offset_0.float()
+        self.num_rows = num_rows
+        self.num_edges += num_new
+
+    def _merge_edges(self, self_indices, neighbor_indices, weight, weight_sm, offset_0, num_rows):
+        rows = torch.cat((self.rows.long(), self_indices.long()))
+        order = torch.sort(rows, stable=True).indices
+        edges = {
+            'indices': torch.cat((self.indices, neighbor_indices.int())),
+            'weight': torch.cat((self.weight, weight.float())),
+            'weight_sm': torch.cat((self.weight_sm, weight_sm.float())),
+            'offset_0': torch.cat((self.offset_0, offset_0.float()))}
+        self.num_rows = 0
+        self.num_edges = 0
+        self.add_edges(
+            rows[order],
+            edges['indices'][order],
+            edges['weight'][order],
+            edges['weight_sm'][order],
+            edges['offset_0'][order],
+            num_rows=num_rows)
+
+    def clone_rows(self, src_rows, first_new_row):
+        """
+        Function to give Gaussians first_new_row, first_new_row+1, ... copies
+        of the edges of src_rows (sorted), e.g., for cloned Gaussians.
+        """
+        num_new = src_rows.shape[0]
+        src_rows = src_rows.long()
+        mapping_tensor = -torch.ones(self.num_rows, dtype=torch.long, device=self.device)
+        has_row = src_rows < self.num_rows
+        mapping_tensor[src_rows[has_row]] = first_new_row + torch.arange(num_new, device=self.device)[has_row]
+        new_rows = mapping_tensor[self.rows.long()]
+        edge_mask = new_rows != -1
+        self.add_edges(
+            new_rows[edge_mask],
+            self.indices[edge_mask],
+            self.weight[edge_mask],
+            self.weight_sm[edge_mask],
+            self.offset_0[edge_mask],
+            num_rows=first_new_row + num_new)
+
+    def remove(self, to_remove):
+        """
+        Function to remove Gaussians (rows) and all edges pointing to them in
+        one pass over the edges. Returns the mask of kept edges.
+        """
+        to_keep = ~to_remove
+        edge_mask = to_keep[:self.num_rows][self.rows.long()] & to_keep[self.indices.long()]
+        mapping_tensor = torch.cumsum(to_keep.long(), dim=0) - 1
+        self._compact(edge_mask, int(to_keep[:self.num_rows].sum().item()), mapping_tensor)
+        return edge_mask
+
+    def replace_rows(self, row_mask, self_indices, neighbor_indices, weight, weight_sm, offset_0=None):
+        """
+        Function to replace all edges of the rows in row_mask by new edges, 
+        self_indices have to be sorted.
+        """
+        self._compact(~row_mask[:self.num_rows][self.rows.long()], self.num_rows)
+        self.add_edges(self_indices, neighbor_indices, weight, weight_sm, offset_0, num_rows=self.num_rows)
+
+    def _compact(self, edge_mask, num_rows, mapping_tensor=None):
+        # keep edges in edge_mask and optionally remap row / neighbor indices
+        self.version += 1
+        new_rows = self.rows.long()[edge_mask]
+        new_indices = self.indices.long()[edge_mask]
+        if mapping_tensor is not None:
+            new_rows = mapping_tensor[new_rows]
+            new_indices = mapping_tensor[new_indices]
+        num_edges = new_rows.shape[0]
+        self._indices[:num_edges] = new_indices.int()
+        self._weight[:num_edges] = self.weight[edge_mask]
+        self._weight_sm[:num_edges] = self.weight_sm[edge_mask]
+        self._offset_0[:num_edges] = self.offset_0[edge_mask]
+        self._rows[:num_edges] = new_rows.int()
+        self._offsets[0] = 0
+        self._offsets[1:num_rows + 1] = torch.cumsum(
+            torch.bincount(new_rows, minlength=num_rows), dim=0).int()
+        self.num_rows = num_rows
+        self.num_edges = num_edges
+
+    def relative_drift(self, means):
+        """
+        Function to compute the relative change of the summed neighbor 
+        distances of every row wrt. the rest offsets (offset_0).
+        """
+        offsets = self.offsets.long()
+        pdist = torch.nn.PairwiseDistance(p=2)
+        offset_t_mag = pdist(
+            means.index_select(0, self.rows),
+            means.index_select(0, self.indices))
+        offset_t_mag = segment_csr(offset_t_mag, offsets)
+        offset_0_mag = torch.linalg.norm(self.offset_0, dim=1)
+        offset_0_mag = segment_csr(offset_0_mag, offsets)
+        return torch.abs(offset_t_mag-offset_0_mag) / offset_0_mag
+
+    def state_dict(self):
+        return {
+            'offsets': self.offsets,
+            'indices': self.indices,
+            'weight': self.weight,
+            'weight_sm': self.weight_sm,
+            'offset_0': self.offset_0}
+
+    @classmethod
+    def from_state_dict(cls, state_dict, device):
+        offsets = state_dict['offsets'].to(device).long()
+        graph = cls(device)
+        self_indices = torch.repeat_interleave(
+            torch.arange(offsets.shape[0] - 1, device=device), offsets[1:] - offsets[:-1])
+        graph.add_edges(
+            self_indices,
+            state_dict['indices'].to(device),
+            state_dict['weight'].to(device),
+            state_dict['weight_sm'].to(device),
+            state_dict['offset_0'].to(device),
+            num_rows=offsets.shape[0] - 1)
+        return graph
+
+
+def load_neighbor_graph(variables, device, key='neighbor_graph'):
+    """
+    Function to restore the neighbor graph from the flattened checkpoint
+    variables (key.offsets, key.indices, ...). Checkpoints with flat
+    self_indices / neighbor_indices / neighbor_weight(_sm) / offset_0
+    tensors are converted.
+    """
+    state_dict = {k[len(key)+1:]: variables.pop(k) for k in list(variables.keys()) if k.startswith(f"{key}.")}
+    if len(state_dict):
+        variables[key] = NeighborGraph.from_state_dict(state_dict, device)
+    elif 'self_indices' in variables.keys():
+        graph = NeighborGraph(device)
+        offset_0 = variables.pop('offset_0', None)
+        if offset_0 is not None and not isinstance(offset_0, torch.Tensor):
+            offset_0 = None
+        graph.add_edges(
+            variables.pop('self_indices').to(device),
+            variables.pop('neighbor_indices').to(device),
+            variables.pop('neighbor_weight').to(device),
+            variables.pop('neighbor_weight_sm').to(device),
+            offset_0.to(device) if offset_0 is not None else None,
+            num_rows=variables['timestep'].shape[0])
+        variables.pop('neighbor_dist', None)
+        variables[key] = graph
+    return variables
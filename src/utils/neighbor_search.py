@@ -1,48 +1,671 @@
-import faiss
-import faiss.contrib.torch_utils
+import time
+import math
 import torch
-import open3d as o3d
 import numpy as np
-import networkx as nx
-import matplotlib.pyplot as plt
+from scipy.spatial import cKDTree
+from src.utils.neighbor_graph import NeighborGraph
+# FAISS is only needed for the 'faiss' backend and approximate search
+try:
+    import faiss
+    import faiss.contrib.torch_utils
+except ImportError:
+    faiss = None
+
+
+FLT_MAX = float(np.finfo(np.float32).max)
 
 
 def o3d_knn(pts, num_knn):
-    indices = []
-    sq_dists = []
-    pcd = o3d.geometry.PointCloud()
-    pcd.points = o3d.utility.Vector3dVector(np.ascontiguousarray(pts, np.float64))
-    pcd_tree = o3d.geometry.KDTreeFlann(pcd)
-    for p in pcd.points:
-        [_, i, d] = pcd_tree.search_knn_vector_3d(p, num_knn + 1)
-        indices.append(i[1:])
-        sq_dists.append(d[1:])
-    return np.array(sq_dists), np.array(indices)
-
-
-def torch_3d_knn(q_pts, k_pts=None, num_knn=20, method="l2", gpu_id=0):
-    # If query and key points are the same set
+    # one bulk KD-tree query for all points instead of a search per point
+    pts = np.ascontiguousarray(pts, np.float64)
+    sq_dists, indices = kdtree_query(pts, pts, num_knn + 1)
+    return sq_dists[:, 1:], indices[:, 1:]
+
+
+def kdtree_query(q_pts, k_pts, num_knn, workers=-1):
+    """
+    Function to query the num_knn nearest neighbors of all query points with
+    a single batched KD-tree query on the CPU. Returns squared distances and
+    indices, missing neighbors are returned as FLT_MAX / -1 like in FAISS.
+    """
+    tree = cKDTree(k_pts)
+    dist, indices = tree.query(q_pts, k=num_knn, workers=workers)
+    dist = dist.reshape(q_pts.shape[0], num_knn)
+    indices = indices.reshape(q_pts.shape[0], num_knn).astype(np.int64)
+    missing = indices == k_pts.shape[0]
+    sq_dists = np.square(dist)
+    sq_dists[missing] = FLT_MAX
+    indices[missing] = -1
+    return sq_dists, indices
+
+
+def kdtree_knn(q_pts, k_pts=None, num_knn=20):
+    # torch interface of kdtree_query with the same output as torch_3d_knn
     if k_pts is None:
         k_pts = q_pts
+    sq_dists, indices = kdtree_query(
+        q_pts.detach().cpu().double().numpy(),
+        k_pts.detach().cpu().double().numpy(),
+        num_knn)
+    sq_dists = torch.from_numpy(sq_dists).float().to(q_pts.device)
+    indices = torch.from_numpy(indices).to(q_pts.device)
+    return sq_dists, indices
+
+
+def voxel_keys(coords, dims):
+    # linear index of integer voxel coordinates
+    return (coords[:, 0] * dims[1] + coords[:, 1]) * dims[2] + coords[:, 2]
+
+
+def voxel_grid_search(q_coords, keys, order, dims, q_pts, k_pts, num_knn, max_chunk_elements=2**24):
+    """
+    Function to find the num_knn closest key points among the key points in
+    the 3x3x3 voxel neighborhood of every query point. keys are the sorted 
+    voxel keys of the key points and order maps them back to key indices.
+    The neighbor cells are looked up per chunk of queries, s.t. only the
+    number of candidates per query is kept for all queries.
+    """
+    device = q_pts.device
+    offsets = torch.stack(torch.meshgrid(
+        *[torch.arange(-1, 2, device=device)]*3, indexing='ij'), dim=-1).reshape(-1, 3)
+    distances = torch.full((q_pts.shape[0], num_knn), float('inf'), device=device)
+    indices = -torch.ones((q_pts.shape[0], num_knn), dtype=torch.long, device=device)
+
+    def lookup(q):
+        # first position in the sorted keys and number of key points of the neighbor cells
+        cells = voxel_keys((q_coords[q].unsqueeze(1) + offsets).reshape(-1, 3), dims)
+        starts = torch.searchsorted(keys, cells)
+        return starts, torch.searchsorted(keys, cells, right=True) - starts
 
+    # number of candidates in the voxel neighborhood of every query point
+    lookup_chunk = max(1, max_chunk_elements // offsets.shape[0])
+    num_cand = torch.zeros(q_pts.shape[0], dtype=torch.long, device=device)
+    for start in range(0, q_pts.shape[0], lookup_chunk):
+        q = torch.arange(start, min(start + lookup_chunk, q_pts.shape[0]), device=device)
+        num_cand[q] = lookup(q)[1].reshape(-1, offsets.shape[0]).sum(dim=1)
+
+    # queries sorted by their number of candidates s.t. the padded distance
+    # matrix of a chunk (at most max_chunk_elements) contains little padding
+    num_cand, q_order = num_cand.sort()
+    start_q = 0
+    while start_q < q_order.shape[0]:
+        end_q = min(start_q + max(1, min(lookup_chunk, max_chunk_elements // max(int(num_cand[start_q].item()), num_knn))), q_order.shape[0])
+        while end_q - start_q > 1 and (end_q - start_q) * max(int(num_cand[end_q - 1].item()), num_knn) > max_chunk_elements:
+            end_q = start_q + (end_q - start_q) // 2
+        chunk_size = end_q - start_q
+        q_slice = slice(start_q, end_q)
+        start_q = end_q
+        chunk_num_cand = num_cand[q_slice]
+        total = int(chunk_num_cand.sum().item())
+        if total == 0:
+            continue
+        chunk_q = q_order[q_slice]
+        chunk_starts, chunk_counts = lookup(chunk_q)
+
+        # ragged list of candidates: position in sorted keys, query and slot
+        ar = torch.arange(total, device=device)
+        cell_first = torch.cumsum(chunk_counts, dim=0) - chunk_counts
+        pos = torch.repeat_interleave(chunk_starts - cell_first, chunk_counts) + ar
+        q_idx = torch.repeat_interleave(torch.arange(chunk_size, device=device), chunk_num_cand)
+        slot = ar - torch.repeat_interleave(torch.cumsum(chunk_num_cand, dim=0) - chunk_num_cand, chunk_num_cand)
+        cand = order[pos]
+        sq_dist = (q_pts[chunk_q][q_idx] - k_pts[cand]).square().sum(dim=1)
+
+        max_cand = max(int(chunk_num_cand[-1].item()), num_knn)
+        dist_mat = torch.full((chunk_size, max_cand), float('inf'), device=device)
+        cand_mat = -torch.ones((chunk_size, max_cand), dtype=torch.long, device=device)
+        dist_mat[q_idx, slot] = sq_dist
+        cand_mat[q_idx, slot] = cand
+        dist_mat, idx = dist_mat.topk(num_knn, dim=1, largest=False, sorted=True)
+        distances[chunk_q] = dist_mat
+        indices[chunk_q] = cand_mat.gather(1, idx)
+
+    return distances, indices
+
+
+def estimate_voxel_size(k_pts, min_bound, extent, num_knn, iters=2):
+    """
+    Function to estimate a voxel size with about num_knn/4 key points per 
+    occupied voxel, s.t. the 3x3x3 neighborhood usually holds num_knn points.
+    Points are assumed to lie on surfaces, i.e., the occupancy scales with
+    the squared voxel size.
+    """
+    min_voxel_size = max(extent / 2**20, 1e-6)
+    voxel_size = max(extent * math.sqrt(num_knn / k_pts.shape[0]), min_voxel_size)
+    for _ in range(iters):
+        coords = torch.floor((k_pts - min_bound) / voxel_size).long()
+        num_occupied = voxel_keys(coords, coords.max(dim=0).values + 1).unique().shape[0]
+        points_per_voxel = k_pts.shape[0] / num_occupied
+        voxel_size = max(voxel_size * math.sqrt(max(num_knn / 4, 1) / points_per_voxel), min_voxel_size)
+    return voxel_size
+
+
+def voxel_knn(q_pts, k_pts=None, num_knn=20, radius=None, voxel_size=None, max_chunk_elements=2**24):
+    """
+    Function for an exact L2 kNN search on a uniform voxel grid in pure 
+    torch, i.e., without FAISS / open3d and on CPU or GPU tensors. Query 
+    points are compared to the key points in their 3x3x3 voxel neighborhood.
+    If radius is given, the voxel size is the radius and only neighbors within
+    radius are returned. Otherwise, queries whose k-th neighbor is farther 
+    than one voxel are searched again on a grid with twice the voxel size.
+    Returns squared distances and indices, missing neighbors are returned as 
+    FLT_MAX / -1 like in FAISS.
+    """
+    if k_pts is None:
+        k_pts = q_pts
+    device = q_pts.device
+    q_pts = q_pts.detach().float()
+    k_pts = k_pts.detach().float().to(device)
+    distances = torch.full((q_pts.shape[0], num_knn), FLT_MAX, device=device)
+    indices = -torch.ones((q_pts.shape[0], num_knn), dtype=torch.long, device=device)
+    if q_pts.shape[0] == 0 or k_pts.shape[0] == 0:
+        return distances, indices
+
+    min_bound = torch.minimum(q_pts.min(dim=0).values, k_pts.min(dim=0).values)
+    extent = (torch.maximum(q_pts.max(dim=0).values, k_pts.max(dim=0).values) - min_bound).max().item()
+    if radius is not None:
+        voxel_size = radius
+    elif voxel_size is None:
+        voxel_size = estimate_voxel_size(k_pts, min_bound, extent, num_knn)
+    # at most 2**20 voxels per axis, s.t. the linear voxel keys fit into int64
+    voxel_size = max(voxel_size, extent / 2**20, 1e-6)
+
+    remaining = torch.arange(q_pts.shape[0], device=device)
+    while remaining.shape[0]:
+        # voxel coordinates shifted by one s.t. all neighbor voxels are valid
+        q_coords = torch.floor((q_pts[remaining] - min_bound) / voxel_size).long() + 1
+        k_coords = torch.floor((k_pts - min_bound) / voxel_size).long() + 1
+        dims = torch.maximum(q_coords.max(dim=0).values, k_coords.max(dim=0).values) + 2
+        keys, order = voxel_keys(k_coords, dims).sort()
+
+        dist, idx = voxel_grid_search(
+            q_coords, keys, order, dims, q_pts[remaining], k_pts, num_knn, max_chunk_elements)
+
+        # k-th neighbor within one voxel or the neighborhood covers all points
+        if radius is not None or voxel_size >= extent:
+            done = torch.ones_like(remaining, dtype=torch.bool)
+        else:
+            done = dist[:, -1] <= voxel_size ** 2
+        missing = torch.isinf(dist)
+        if radius is not None:
+            missing = missing | (dist > radius ** 2)
+        dist[missing] = FLT_MAX
+        idx[missing] = -1
+        distances[remaining[done]] = dist[done]
+        indices[remaining[done]] = idx[done]
+        remaining = remaining[~done]
+        voxel_size = voxel_size * 2
+
+    return distances, indices
+
+
+def require_faiss():
+    if faiss is None:
+        raise ImportError("FAISS is not installed, use neighbors backend 'voxel' or 'kdtree'.")
+
+
+# FAISS GPU resources are expensive to create, keep one per device
+_gpu_resources = dict()
+
+
+def get_gpu_resources(gpu_id=0):
+    require_faiss()
+    if gpu_id not in _gpu_resources.keys():
+        _gpu_resources[gpu_id] = faiss.StandardGpuResources()
+    return _gpu_resources[gpu_id]
+
+
+def get_flat_index(dim, method="l2", gpu_id=0, on_gpu=True):
+    require_faiss()
     # Initialize FAISS index
     if method == "l2":
-        index = faiss.IndexFlatL2(q_pts.shape[1])
+        index = faiss.IndexFlatL2(dim)
     elif method == "cosine":
-        index = faiss.IndexFlatIP(q_pts.shape[1])
+        index = faiss.IndexFlatIP(dim)
     else:
         raise NotImplementedError(f"Method: {method}")
 
     # Convert FAISS index to GPU
-    if q_pts.get_device() != -1:
-        res = faiss.StandardGpuResources()
-        index = faiss.index_cpu_to_gpu(res, gpu_id, index)
+    if on_gpu:
+        index = faiss.index_cpu_to_gpu(get_gpu_resources(gpu_id), gpu_id, index)
+    return index
+
+
+def get_ann_index(k_pts, ann, gpu_id=0):
+    """
+    Function to build an approximate FAISS index on the key points. ann is a
+    dict with 'type' either 'hnsw' (graph based, CPU only) or 'ivf' (inverted
+    file, CPU or GPU depending on the key points) and the index parameters
+    M / ef_construction / ef_search resp. nlist / nprobe.
+    """
+    require_faiss()
+    dim = k_pts.shape[1]
+    if ann['type'] == 'hnsw':
+        index = faiss.IndexHNSWFlat(dim, ann.get('M', 32))
+        index.hnsw.efConstruction = ann.get('ef_construction', 40)
+        index.hnsw.efSearch = ann.get('ef_search', 64)
+        index.add(k_pts.cpu())
+    elif ann['type'] == 'ivf':
+        # at least 39 training points per centroid
+        nlist = max(1, min(ann.get('nlist', 1024), k_pts.shape[0] // 39))
+        quantizer = faiss.IndexFlatL2(dim)
+        index = faiss.IndexIVFFlat(quantizer, dim, nlist)
+        index.nprobe = min(ann.get('nprobe', 16), nlist)
+        if k_pts.get_device() != -1:
+            index = faiss.index_cpu_to_gpu(get_gpu_resources(gpu_id), gpu_id, index)
+        index.train(k_pts)
+        index.add(k_pts)
+    else:
+        raise NotImplementedError(f"ANN type: {ann['type']}")
+    return index
+
+
+def ann_knn(q_pts, k_pts, num_knn, ann, gpu_id=0):
+    index = get_ann_index(k_pts, ann, gpu_id=gpu_id)
+    if ann['type'] == 'hnsw':
+        distances, indices = index.search(q_pts.cpu(), num_knn)
+    else:
+        distances, indices = index.search(q_pts.to(k_pts.device), num_knn)
+    return distances.to(q_pts.device), indices.to(q_pts.device)
+
+
+def knn_recall(q_pts, k_pts=None, num_knn=20, ann=None, gpu_id=0, max_queries=10000, backend="faiss"):
+    """
+    Function to measure recall@k of the approximate search against the exact
+    search on (a random subset of) the query points. Returns recall and the 
+    run times of the exact and the approximate search.
+    """
+    if k_pts is None:
+        k_pts = q_pts
+    if q_pts.shape[0] > max_queries:
+        q_pts = q_pts[torch.randperm(q_pts.shape[0], device=q_pts.device)[:max_queries]]
+    q_pts = q_pts.contiguous()
+
+    start = time.time()
+    _, exact = torch_3d_knn(q_pts, k_pts, num_knn=num_knn, gpu_id=gpu_id, backend=backend)
+    exact_time = time.time() - start
+    start = time.time()
+    _, approx = ann_knn(q_pts, k_pts, num_knn, ann, gpu_id=gpu_id)
+    approx_time = time.time() - start
+
+    valid = exact != -1
+    hits = ((approx.unsqueeze(2) == exact.unsqueeze(1)) & valid.unsqueeze(1)).any(dim=1)
+    recall = hits.sum(dim=1).float() / valid.sum(dim=1).clamp(min=1)
+    return {
+        'recall': recall.mean().item(),
+        'exact_time': exact_time,
+        'approx_time': approx_time,
+        'num_queries': q_pts.shape[0]}
+
+
+def torch_3d_knn(q_pts, k_pts=None, num_knn=20, method="l2", gpu_id=0, backend="faiss", ann=None):
+    # If query and key points are the same set
+    if k_pts is None:
+        k_pts = q_pts
+
+    # approximate search only pays off for larger key sets
+    if ann is not None and method == "l2" and k_pts.shape[0] >= ann.get('min_points', 10000):
+        return ann_knn(q_pts, k_pts, num_knn, ann, gpu_id=gpu_id)
+
+    if backend == "kdtree":
+        if method != "l2":
+            raise NotImplementedError(f"Method {method} for backend {backend}")
+        return kdtree_knn(q_pts, k_pts, num_knn=num_knn)
+    elif backend == "voxel":
+        if method != "l2":
+            raise NotImplementedError(f"Method {method} for backend {backend}")
+        return voxel_knn(q_pts, k_pts, num_knn=num_knn)
+    elif backend != "faiss":
+        raise NotImplementedError(f"Backend: {backend}")
+
+    index = get_flat_index(
+        q_pts.shape[1], method=method, gpu_id=gpu_id, on_gpu=q_pts.get_device() != -1)
 
     # Add points to index and compute distances
     index.add(k_pts)
     distances, indices = index.search(q_pts, num_knn)
     return distances, indices
-    
+
+
+class NeighborIndex():
+    """
+    Incremental per-segment neighbor index owned by the GaussianScene.
+
+    Every Gaussian gets a stable id when it is added (add_new_gaussians,
+    densification) that is kept until it is removed (remove_points), ids
+    increase with the row in params s.t. rows are found by a sorted search.
+    Per segment, the member rows and a FAISS IndexIDMap2 on the key points
+    are kept. Added Gaussians are inserted with add_with_ids at the next
+    sync, removed ones are deleted with remove_ids and sync only re-inserts
+    the rows that moved since the last sync, i.e., the index maintenance
+    scales with the number of added, removed and moved Gaussians instead of
+    the scene size. The FAISS index lives on the CPU since the GPU flat
+    indices do not support remove_ids. Searches of other backends, of
+    segments above the ann size and of subsets of the members (key_mask)
+    fall back to torch_3d_knn on the member points.
+    """
+    def __init__(self, method="l2", gpu_id=0, backend="faiss", ann=None):
+        self.method = method
+        self.gpu_id = gpu_id
+        self.backend = backend
+        self.ann = ann
+        self.members = dict()
+        self.indices = dict()
+        self.num_points = 0
+        self.next_id = 0
+        self.device = None
+        self.ids = None
+        self.instseg = None
+        self.pts = None
+
+    @property
+    def incremental(self):
+        return self.backend == "faiss" and faiss is not None
+
+    def reset(self):
+        self.members = dict()
+        self.indices = dict()
+        self.num_points = 0
+        self.ids = None
+        self.instseg = None
+        self.pts = None
+
+    def add(self, instseg):
+        # Gaussians are always appended at the end of params
+        instseg = instseg.detach().flatten().long()
+        self.device = instseg.device
+        rows = torch.arange(
+            self.num_points, self.num_points + instseg.shape[0], device=instseg.device)
+        for inst in instseg.unique():
+            new_members = rows[instseg == inst]
+            inst = int(inst.item())
+            if inst in self.members.keys():
+                self.members[inst] = torch.cat((self.members[inst], new_members))
+            else:
+                self.members[inst] = new_members
+        self.num_points += instseg.shape[0]
+
+        # key points are inserted at the next sync, positions of new rows
+        # are unknown (nan) until then
+        ids = torch.arange(self.next_id, self.next_id + instseg.shape[0], device=instseg.device)
+        pts = torch.full((instseg.shape[0], 3), float('nan'), device=instseg.device)
+        self.next_id += instseg.shape[0]
+        if self.ids is None:
+            self.ids, self.instseg, self.pts = ids, instseg, pts
+        else:
+            self.ids = torch.cat((self.ids, ids))
+            self.instseg = torch.cat((self.instseg, instseg))
+            self.pts = torch.cat((self.pts, pts))
+
+    def remove(self, to_remove):
+        to_keep = ~to_remove
+        mapping_tensor = torch.cumsum(to_keep.long(), dim=0) - 1
+        for inst in list(self.members.keys()):
+            members = self.members[inst]
+            members = mapping_tensor[members[to_keep[members]]]
+            if members.shape[0]:
+                self.members[inst] = members
+            else:
+                del self.members[inst]
+        self.num_points = int(to_keep.sum().item())
+
+        if self.ids is None:
+            return
+        # delete removed key points from the segment indices
+        removed_ids, removed_instseg = self.ids[to_remove], self.instseg[to_remove]
+        for inst in removed_instseg.unique().tolist():
+            if inst in self.indices.keys():
+                self.indices[inst].remove_ids(
+                    removed_ids[removed_instseg == inst].cpu().numpy().astype(np.int64))
+        self.ids, self.instseg, self.pts = self.ids[to_keep], self.instseg[to_keep], self.pts[to_keep]
+
+    def sync(self, instseg, means=None):
+        """
+        Function to rebuild the memberships if params were changed without
+        informing the index, e.g., after loading a checkpoint or reordering,
+        and to re-insert the key points of rows that moved since the last
+        sync into the segment indices
+        """
+        instseg = instseg.detach().flatten().long()
+        if self.instseg is None or instseg.shape[0] != self.num_points or not torch.equal(instseg, self.instseg):
+            self.reset()
+            self.add(instseg)
+        if means is None or not self.incremental:
+            return
+
+        means = means.detach().float()
+        moved = torch.nonzero((means != self.pts).any(dim=1)).squeeze(1)
+        if moved.shape[0] == 0:
+            return
+        moved_ids, moved_instseg = self.ids[moved], self.instseg[moved]
+        moved_pts = means[moved].cpu().contiguous()
+        for inst in moved_instseg.unique().tolist():
+            inst_mask = moved_instseg == inst
+            ids = moved_ids[inst_mask].cpu()
+            if inst not in self.indices.keys():
+                self.indices[inst] = faiss.IndexIDMap2(
+                    get_flat_index(means.shape[1], method=self.method, on_gpu=False))
+            else:
+                self.indices[inst].remove_ids(ids.numpy().astype(np.int64))
+            self.indices[inst].add_with_ids(moved_pts[inst_mask.cpu()], ids)
+        self.pts[moved] = means[moved]
+
+    def get_members(self, inst, key_mask=None):
+        if int(inst) not in self.members.keys():
+            # segment without key points, like the empty key set without index
+            device = key_mask.device if key_mask is not None else self.device
+            return torch.zeros(0, dtype=torch.long, device=device)
+        members = self.members[int(inst)]
+        if key_mask is not None:
+            members = members[key_mask[members]]
+        return members
+
+    def groups(self, key_mask=None):
+        # key points grouped by segment in the format of group_by_segment
+        segs = sorted(self.members.keys())
+        members = [self.get_members(inst, key_mask) for inst in segs]
+        device = members[0].device if len(members) else None
+        counts = torch.tensor([m.shape[0] for m in members], dtype=torch.long, device=device)
+        segs = torch.tensor(segs, dtype=torch.long, device=device)
+        if len(members):
+            members = torch.cat(members)
+        else:
+            members = torch.zeros(0, dtype=torch.long)
+        return members, segs[counts > 0], counts[counts > 0]
+
+    def search(self, q_pts, k_pts, num_knn, inst, key_mask=None):
+        """
+        Function to search the num_knn closest key points of the query points
+        among the members of segment inst. k_pts are the member points in the
+        order of get_members(inst, key_mask), they are only used if the
+        segment index cannot answer the search. Returns squared distances and
+        indices into the members like torch_3d_knn on k_pts.
+        """
+        inst = int(inst)
+        if not self.incremental or key_mask is not None or inst not in self.indices.keys() or \
+                inst not in self.members.keys() or \
+                (self.ann is not None and k_pts.shape[0] >= self.ann.get('min_points', 10000)):
+            return torch_3d_knn(
+                q_pts, k_pts, num_knn, method=self.method, gpu_id=self.gpu_id, backend=self.backend, ann=self.ann)
+        distances, ids = self.indices[inst].search(q_pts.detach().float().cpu().contiguous(), num_knn)
+        distances, ids = distances.to(q_pts.device), ids.to(q_pts.device)
+
+        # stable ids to rows to positions in the members
+        members = self.members[inst]
+        missing = ids == -1
+        rows = torch.searchsorted(self.ids, ids.clamp(min=0))
+        indices = torch.searchsorted(members, rows)
+        indices[missing] = -1
+        return distances, indices
+
+
+def group_by_segment(seg, ids=None):
+    """
+    Function to sort (key) points by their segment id. Returns the point 
+    indices ordered by segment, the sorted segment ids and the number of
+    points per segment.
+    """
+    seg = seg.detach().flatten().long()
+    if ids is None:
+        ids = torch.arange(seg.shape[0], device=seg.device)
+    seg, order = torch.sort(seg, stable=True)
+    segs, counts = torch.unique_consecutive(seg, return_counts=True)
+    return ids[order], segs, counts
+
+
+def _select_knn(dist, cand, num_knn):
+    k = min(num_knn, dist.shape[1])
+    dist, loc = torch.topk(dist.clamp(min=0), k, dim=1, largest=False, sorted=True)
+    if len(cand.shape) == 2:
+        idx = torch.gather(cand, 1, loc)
+    else:
+        idx = cand[loc]
+    missing = torch.isinf(dist)
+    dist[missing] = FLT_MAX
+    idx[missing] = -1
+    return dist, idx
+
+
+def segmented_knn(
+        q_pts,
+        q_seg,
+        k_pts,
+        num_knn=20,
+        k_seg=None,
+        k_groups=None,
+        large_segment_size=4096,
+        max_chunk_elements=2**24,
+        fill_missing_with_last=False,
+        ann=None,
+        gpu_id=0):
+    """
+    Exact L2 kNN search restricted to key points of the same segment, for all
+    segments in a single call. Key points are grouped by segment, small 
+    segments are padded to the next power of two and searched together in
+    batches, large segments are searched one after the other. 
+
+    Returns squared distances and indices into k_pts like torch_3d_knn,
+    missing neighbors are returned as FLT_MAX / -1 or, if 
+    fill_missing_with_last, as the last key point of the segment (which is 
+    what indexing the segment members with -1 gives in the per segment path).
+    k_groups can be given instead of k_seg as returned by group_by_segment.
+    If ann is given, large segments are searched approximately (see 
+    torch_3d_knn).
+    """
+    device = q_pts.device
+    if k_groups is None:
+        k_groups = group_by_segment(k_seg)
+    k_order, segs, counts = k_groups
+    starts = torch.cumsum(counts, dim=0) - counts
+
+    distances = torch.full((q_pts.shape[0], num_knn), FLT_MAX, dtype=q_pts.dtype, device=device)
+    indices = -torch.ones((q_pts.shape[0], num_knn), dtype=torch.long, device=device)
+    if q_pts.shape[0] == 0 or segs.shape[0] == 0:
+        return distances, indices
+
+    # position of query segments among the key segments
+    q_seg = q_seg.detach().flatten().long()
+    q_pos = torch.searchsorted(segs, q_seg).clamp(max=segs.shape[0]-1)
+    q_valid = segs[q_pos] == q_seg
+
+    q_sq = (q_pts ** 2).sum(dim=1)
+    k_sq = (k_pts ** 2).sum(dim=1)
+    padded = torch.pow(2, torch.ceil(torch.log2(counts.float()))).long()
+    large = counts > large_segment_size
+
+    # small segments with the same padded size are searched together
+    for pad in padded[~large].unique().tolist():
+        seg_ids = ((padded == pad) & ~large).nonzero().squeeze(1)
+        seg_rows = -torch.ones(segs.shape[0], dtype=torch.long, device=device)
+        seg_rows[seg_ids] = torch.arange(seg_ids.shape[0], device=device)
+        local = torch.arange(pad, device=device).unsqueeze(0)
+        key_valid = local < counts[seg_ids].unsqueeze(1)
+        key_idx = k_order[(starts[seg_ids].unsqueeze(1) + local).clamp(max=k_order.shape[0]-1)]
+
+        q_rows = seg_rows[q_pos]
+        q_ids = ((q_rows >= 0) & q_valid).nonzero().squeeze(1)
+        chunk_size = max(1, max_chunk_elements // pad)
+        for start in range(0, q_ids.shape[0], chunk_size):
+            ids = q_ids[start:start+chunk_size]
+            rows = q_rows[ids]
+            cand = key_idx[rows]
+            dist = q_sq[ids].unsqueeze(1) + k_sq[cand] - 2 * torch.bmm(
+                k_pts[cand], q_pts[ids].unsqueeze(2)).squeeze(2)
+            dist[~key_valid[rows]] = float('inf')
+            dist, idx = _select_knn(dist, cand, num_knn)
+            distances[ids, :dist.shape[1]] = dist
+            indices[ids, :idx.shape[1]] = idx
+
+    # large segments one by one
+    for seg_id in large.nonzero().squeeze(1).tolist():
+        cand = k_order[starts[seg_id]:starts[seg_id]+counts[seg_id]]
+        q_ids = ((q_pos == seg_id) & q_valid).nonzero().squeeze(1)
+        if ann is not None and cand.shape[0] >= ann.get('min_points', 10000):
+            dist, idx = ann_knn(q_pts[q_ids].contiguous(), k_pts[cand].contiguous(), num_knn, ann, gpu_id=gpu_id)
+            indices[q_ids] = torch.where(idx == -1, idx, cand[idx])
+            distances[q_ids] = dist.to(distances.dtype)
+            continue
+        chunk_size = max(1, max_chunk_elements // cand.shape[0])
+        for start in range(0, q_ids.shape[0], chunk_size):
+            ids = q_ids[start:start+chunk_size]
+            dist = q_sq[ids].unsqueeze(1) + k_sq[cand].unsqueeze(0) - 2 * q_pts[ids] @ k_pts[cand].T
+            dist, idx = _select_knn(dist, cand, num_knn)
+            distances[ids, :dist.shape[1]] = dist
+            indices[ids, :idx.shape[1]] = idx
+
+    if fill_missing_with_last:
+        last = k_order[starts + counts - 1][q_pos].unsqueeze(1).expand_as(indices)
+        indices = torch.where((indices == -1) & q_valid.unsqueeze(1), last, indices)
+
+    return distances, indices
+
+
+def rerank_neighbors(
+        neighbor_indices,
+        q_feats,
+        k_feats,
+        num_knn,
+        inflate,
+        dist_to_use,
+        max_chunk_elements=2**24,
+        metric=None):
+    """
+    Function to select the num_knn closest neighbors wrt color / embedding 
+    distance out of the inflate*num_knn(+1) closest neighbors in l2. The 
+    feature distances are computed for chunks of query points, the gathered 
+    candidate features are bounded by max_chunk_elements.
+    """
+    # cosine distance for embeddings, l2 for colors
+    if metric is None:
+        metric = 'l2' if dist_to_use == 'rgb' else 'cosine'
+    q_feats = q_feats.float()
+    k_feats = k_feats.float()
+
+    # drop farthest candidate of the inflate*num_knn+1 closest points in l2
+    neighbor_indices = neighbor_indices[:, :int(inflate*num_knn)]
+    num_q, num_cand = neighbor_indices.shape
+    chunk_size = max(1, max_chunk_elements // max(1, num_cand * k_feats.shape[1]))
+
+    indices = torch.zeros(num_q, num_knn, dtype=neighbor_indices.dtype, device=neighbor_indices.device)
+    distances = torch.zeros(num_q, num_knn, dtype=k_feats.dtype, device=k_feats.device)
+    for start in range(0, num_q, chunk_size):
+        cand = neighbor_indices[start:start+chunk_size]
+        cand_feats = k_feats[cand.flatten()].reshape(cand.shape[0], num_cand, -1)
+        chunk_q_feats = q_feats[start:start+chunk_size].unsqueeze(1)
+        if metric == 'l2':
+            neighbor_dist = torch.linalg.norm(cand_feats - chunk_q_feats, dim=2)
+        else:
+            neighbor_dist = torch.nn.functional.cosine_similarity(
+                chunk_q_feats, cand_feats, dim=2)
+            neighbor_dist = 1 - (neighbor_dist + 1)/2
+
+        # closest points wrt rgb / embeddings within closest points in l2
+        neighbor_dist, idx = neighbor_dist.topk(num_knn, dim=1, largest=False, sorted=True)
+        indices[start:start+chunk_size] = cand.gather(1, idx)
+        distances[start:start+chunk_size] = neighbor_dist
+
+    return indices, distances
+
 
 def calculate_neighbors(params, variables, time_idx, num_knn=20):
     if time_idx is None:
@@ -67,11 +690,17 @@ def calculate_neighbors_seg_after_init(
         inflate=2,
         l2_thresh=0.5,
         primary_device="cuda:0",
-        exp_weight=2000):
+        exp_weight=2000,
+        neighbor_index=None,
+        single_pass=False,
+        backend="faiss",
+        ann=None,
+        rerank_chunk_elements=2**24):
     
     time_mask = variables['timestep'] < time_idx
     new_variables = dict()
-    new_variables, to_remove = calculate_neighbors_seg(
+    neighbor_func = calculate_neighbors_seg_single_pass if single_pass else calculate_neighbors_seg
+    new_variables, to_remove = neighbor_func(
             params,
             variables,
             time_mask,
@@ -82,20 +711,90 @@ def calculate_neighbors_seg_after_init(
             inflate=inflate,
             l2_thresh=l2_thresh,
             primary_device=primary_device,
-            exp_weight=exp_weight)
-
-    if time_idx != 0:
-        variables['self_indices'] = torch.cat((variables['self_indices'], new_variables['self_indices']), dim=0)
-        variables['neighbor_indices'] = torch.cat((variables['neighbor_indices'], new_variables['neighbor_indices']), dim=0)
-        variables['neighbor_weight'] = torch.cat((variables['neighbor_weight'], new_variables['neighbor_weight']), dim=0)
-        variables['neighbor_weight_sm'] = torch.cat((variables['neighbor_weight_sm'], new_variables['neighbor_weight_sm']), dim=0)
-        variables['neighbor_dist'] = torch.cat((variables['neighbor_dist'], new_variables['neighbor_dist']), dim=0)
-    else:
-        variables.update(new_variables)
+            exp_weight=exp_weight,
+            neighbor_index=neighbor_index,
+            backend=backend,
+            ann=ann,
+            rerank_chunk_elements=rerank_chunk_elements)
+
+    if time_idx == 0 or 'neighbor_graph' not in variables.keys():
+        variables['neighbor_graph'] = NeighborGraph(params['means3D'].device)
+    variables['neighbor_graph'].add_edges(
+        new_variables['self_indices'],
+        new_variables['neighbor_indices'],
+        new_variables['neighbor_weight'],
+        new_variables['neighbor_weight_sm'],
+        num_rows=params['means3D'].shape[0])
 
     return variables, to_remove          
 
 
+def refresh_neighbors(
+        params,
+        variables,
+        time_idx,
+        max_drift,
+        budget,
+        num_knn=20,
+        dist_to_use='rgb',
+        inflate=2,
+        primary_device="cuda:0",
+        neighbor_index=None,
+        single_pass=False,
+        backend="faiss",
+        ann=None,
+        rerank_chunk_elements=2**24):
+    """
+    Function to re-query the neighbors of Gaussians whose relative neighbor 
+    drift (in percent, as in prune_gaussians) exceeds max_drift. At most 
+    budget neighborhoods with the largest drift are refreshed and their rest 
+    offsets are reset to the current offsets. Returns the variables, the 
+    number of refreshed and the number of drifted neighborhoods.
+    """
+    graph = variables['neighbor_graph']
+    means = params['means3D'].detach()
+    # rows without rest offsets yet have no drift
+    rel_drift = torch.nan_to_num(graph.relative_drift(means), nan=0.0, posinf=0.0)
+    drifted = rel_drift * 100 > max_drift
+    num_drifted = int(drifted.sum().item())
+    if num_drifted == 0:
+        return variables, 0, 0
+    if num_drifted > budget:
+        selected = rel_drift.topk(budget).indices
+    else:
+        selected = torch.nonzero(drifted).squeeze(1)
+
+    # query selected Gaussians, keys are all Gaussians
+    query_mask = torch.zeros(means.shape[0], dtype=torch.bool, device=means.device)
+    query_mask[selected] = True
+    neighbor_func = calculate_neighbors_seg_single_pass if single_pass else calculate_neighbors_seg
+    new_variables, _ = neighbor_func(
+            params,
+            variables,
+            ~query_mask,
+            time_idx,
+            num_knn=num_knn,
+            dist_to_use=dist_to_use,
+            use_old_and_new=True,
+            inflate=inflate,
+            primary_device=primary_device,
+            neighbor_index=neighbor_index,
+            backend=backend,
+            ann=ann,
+            rerank_chunk_elements=rerank_chunk_elements)
+
+    offset_0 = means[new_variables['self_indices']] - means[new_variables['neighbor_indices']]
+    graph.replace_rows(
+        query_mask,
+        new_variables['self_indices'],
+        new_variables['neighbor_indices'],
+        new_variables['neighbor_weight'],
+        new_variables['neighbor_weight_sm'],
+        offset_0)
+
+    return variables, selected.shape[0], num_drifted
+
+
 def calculate_neighbors_seg(
         params,
         variables,
@@ -107,11 +806,20 @@ def calculate_neighbors_seg(
         inflate=2,
         l2_thresh=0.5,
         primary_device="cuda:0",
-        exp_weight=2000):
+        exp_weight=2000,
+        neighbor_index=None,
+        backend="faiss",
+        ann=None,
+        rerank_chunk_elements=2**24):
     
     new_variables = dict()
     embeddings_in_params = 'embeddings' in params.keys()
     device = params['means3D'].device
+    if neighbor_index is not None:
+        if len(params['means3D'].shape) == 3:
+            neighbor_index.sync(params['instseg'], params['means3D'][:, :, time_idx])
+        else:
+            neighbor_index.sync(params['instseg'], params['means3D'])
 
     # initalize matrices
     indices = torch.zeros((~time_mask).sum(), num_knn).long().to(device)
@@ -120,28 +828,23 @@ def calculate_neighbors_seg(
     dist = torch.zeros((~time_mask).sum(), num_knn).to(device)
     to_remove = torch.zeros((~time_mask).sum(), dtype=bool).to(device)
 
-    # get existing Gaussians and neighbor arranged indices
+    # get existing Gaussians and neighbor arranged indices, key points are
+    # gathered from the unmasked tensors by their global indices
     if time_mask.sum() != 0:
-        if use_old_and_new:
-            if embeddings_in_params:
-                existing_embeddings = params['embeddings']
-            existing_colors = params['rgb_colors'].detach()
-            if len(params['means3D'].shape) == 3:
-                existing_means = params['means3D'][:, :, time_idx].detach().contiguous()
-            else:
-                existing_means = params['means3D'].detach().contiguous()
-            aranged_idx = torch.arange(existing_means.shape[0]).to(device)
-            existing_instseg_mask = params['instseg'].detach().contiguous()
+        if embeddings_in_params:
+            existing_embeddings = params['embeddings'].detach()
+        existing_colors = params['rgb_colors'].detach()
+        if len(params['means3D'].shape) == 3:
+            existing_means = params['means3D'][:, :, time_idx].detach().contiguous()
         else:
-            existing_colors = params['rgb_colors'].detach()[time_mask]
-            if embeddings_in_params:
-                existing_embeddings = params['embeddings'].detach()[time_mask]
-            if len(params['means3D'].shape) == 3:
-                existing_means = params['means3D'][:, :, time_idx].detach().contiguous()[time_mask]
-            else:
-                existing_means = params['means3D'].detach().contiguous()[time_mask]
-            aranged_idx = torch.arange(params['means3D'].shape[0]).to(device)[time_mask]
-            existing_instseg_mask = params['instseg'].detach().contiguous()[time_mask]
+            existing_means = params['means3D'].detach().contiguous()
+        key_mask = None if use_old_and_new else time_mask
+        if neighbor_index is None:
+            aranged_idx = torch.arange(params['means3D'].shape[0]).to(device)
+            existing_instseg_mask = params['instseg'].detach().contiguous()
+            if not use_old_and_new:
+                aranged_idx = aranged_idx[time_mask]
+                existing_instseg_mask = existing_instseg_mask[time_mask]
     else:
         existing_means = None
         aranged_idx = torch.arange(params['means3D'].shape[0]).to(device)
@@ -163,11 +866,14 @@ def calculate_neighbors_seg(
 
         # mask key points
         if time_mask.sum()!= 0:
-            k_bin_mask = existing_instseg_mask == inst
-            k_pts = existing_means[k_bin_mask].contiguous()
-            k_colors = torch.nn.functional.normalize(existing_colors[k_bin_mask], p=2, dim=1)
+            if neighbor_index is not None:
+                k_idx = neighbor_index.get_members(inst, key_mask)
+            else:
+                k_idx = aranged_idx[existing_instseg_mask == inst]
+            k_pts = existing_means[k_idx].contiguous()
+            k_colors = torch.nn.functional.normalize(existing_colors[k_idx], p=2, dim=1)
             if embeddings_in_params:
-                k_embeddings = torch.nn.functional.normalize(existing_embeddings[k_bin_mask], p=2, dim=1)
+                k_embeddings = torch.nn.functional.normalize(existing_embeddings[k_idx], p=2, dim=1)
         else:
             k_pts = q_pts
             k_colors = q_colors
@@ -175,51 +881,32 @@ def calculate_neighbors_seg(
                 k_embeddings = q_embeddings
 
         # get distances and indices
-        neighbor_dist, neighbor_indices = torch_3d_knn(
-            q_pts.contiguous(), k_pts, num_knn=int(inflate*num_knn)+1, gpu_id=int(primary_device.split(':')[-1]))
+        if neighbor_index is not None:
+            neighbor_dist, neighbor_indices = neighbor_index.search(
+                q_pts.contiguous(), k_pts.contiguous(), int(inflate*num_knn)+1, inst,
+                key_mask=key_mask if time_mask.sum() != 0 else None)
+        else:
+            neighbor_dist, neighbor_indices = torch_3d_knn(
+                q_pts.contiguous(), k_pts, num_knn=int(inflate*num_knn)+1, gpu_id=int(primary_device.split(':')[-1]),
+                backend=backend, ann=ann)
         to_remove_seg = neighbor_dist[:, 1:num_knn+1].min(dim=1).values > l2_thresh
 
-        l2_neighbor_dists = neighbor_dist[:, 1:num_knn+1]
-
         # calculate weight of neighbors
         if dist_to_use == 'l2':
             neighbor_dist = neighbor_dist[:, 1:num_knn+1]
             neighbor_indices = neighbor_indices[:, 1:num_knn+1]
-            neighbor_weight = torch.exp(-exp_weight * torch.square(neighbor_dist))
-        elif dist_to_use == 'rgb' or dist_to_use == 'embeddings':
-            # get rbg distance from nearest neighbors in l2
-            neighbor_indices = neighbor_indices[:, :-1]
-            q_idx = torch.tile(
-                torch.arange(neighbor_indices.shape[0]).unsqueeze(1),
-                (1, int(inflate*num_knn))).flatten()
-            if dist_to_use == 'rgb':
-                neighbor_dist = torch.cdist(
-                        q_colors.float()[q_idx, :].unsqueeze(1),
-                        k_colors.float()[neighbor_indices.flatten(), :].unsqueeze(1)
-                    ).squeeze()
-            else:
-                # cosine
-                neighbor_dist = torch.nn.functional.cosine_similarity(
-                    q_embeddings.float()[q_idx, :],
-                    k_embeddings.float()[neighbor_indices.flatten(), :],
-                    dim=1)
-                neighbor_dist = (neighbor_dist + 1)/2
-                neighbor_dist = 1 - neighbor_dist
-                neighbor_dist = neighbor_dist.reshape(neighbor_indices.shape[0], -1)
-
-            # sort rgb neighbot distance and re-index to get closest points in 
-            # wrt rgb within closest points in l2
-            neighbor_dist = neighbor_dist.sort(dim=1, descending=False)
-            idx = neighbor_dist.indices[:, :num_knn]
-            q_idx = torch.tile(torch.arange(neighbor_indices.shape[0]).unsqueeze(1), (1, num_knn)).flatten()
-            neighbor_indices = neighbor_indices[
-                q_idx, idx.flatten()].squeeze().reshape(q_colors.shape[0], num_knn)
-            neighbor_dist = neighbor_dist.values[:, :num_knn]
-            neighbor_weight = 1 - neighbor_dist
+        elif dist_to_use == 'rgb':
+            neighbor_indices, neighbor_dist = rerank_neighbors(
+                neighbor_indices, q_colors, k_colors, num_knn, inflate, dist_to_use,
+                max_chunk_elements=rerank_chunk_elements)
+        elif dist_to_use == 'embeddings':
+            neighbor_indices, neighbor_dist = rerank_neighbors(
+                neighbor_indices, q_embeddings, k_embeddings, num_knn, inflate, dist_to_use,
+                max_chunk_elements=rerank_chunk_elements)
 
         if time_mask.sum() != 0:
             num_samps = neighbor_indices.shape[0]
-            neighbor_indices = aranged_idx[k_bin_mask][neighbor_indices.flatten()]
+            neighbor_indices = k_idx[neighbor_indices.flatten()]
             neighbor_indices = neighbor_indices.reshape((num_samps, num_knn))
         else:
             neighbor_indices = aranged_idx[bin_mask][neighbor_indices]
@@ -248,8 +935,93 @@ def calculate_neighbors_seg(
     return new_variables, to_remove
 
 
+def calculate_neighbors_seg_single_pass(
+        params,
+        variables,
+        time_mask,
+        time_idx,
+        num_knn=20,
+        dist_to_use='rgb',
+        use_old_and_new=True,
+        inflate=2,
+        l2_thresh=0.5,
+        primary_device="cuda:0",
+        exp_weight=2000,
+        neighbor_index=None,
+        backend="faiss",
+        ann=None,
+        rerank_chunk_elements=2**24):
+    """
+    Same as calculate_neighbors_seg but answers the kNN queries of all
+    segments with a single segmented_knn call and selects the neighbors of
+    all query Gaussians at once instead of looping over segment ids.
+    """
+    new_variables = dict()
+    device = params['means3D'].device
+    num_gaussians = params['means3D'].shape[0]
+
+    if len(params['means3D'].shape) == 3:
+        means = params['means3D'][:, :, time_idx].detach().contiguous()
+    else:
+        means = params['means3D'].detach().contiguous()
+    instseg = params['instseg'].detach().flatten()
+
+    # query Gaussians are the new ones, keys either old and new or only old
+    q_aranged_idx = torch.arange(num_gaussians).to(device)[~time_mask]
+    if time_mask.sum() != 0 and not use_old_and_new:
+        key_mask = time_mask
+    else:
+        key_mask = None
+
+    if neighbor_index is not None:
+        neighbor_index.sync(params['instseg'])
+        k_groups = neighbor_index.groups(key_mask)
+    elif key_mask is not None:
+        k_groups = group_by_segment(instseg[key_mask], torch.arange(num_gaussians).to(device)[key_mask])
+    else:
+        k_groups = group_by_segment(instseg)
+
+    # get distances and indices
+    neighbor_dist, neighbor_indices = segmented_knn(
+        means[q_aranged_idx],
+        instseg[q_aranged_idx],
+        means,
+        num_knn=int(inflate*num_knn)+1,
+        k_groups=k_groups,
+        fill_missing_with_last=True,
+        ann=ann,
+        gpu_id=int(primary_device.split(':')[-1]))
+    to_remove = neighbor_dist[:, 1:num_knn+1].min(dim=1).values > l2_thresh
+
+    # calculate weight of neighbors
+    if dist_to_use == 'l2':
+        neighbor_dist = neighbor_dist[:, 1:num_knn+1]
+        neighbor_indices = neighbor_indices[:, 1:num_knn+1]
+    elif dist_to_use == 'rgb' or dist_to_use == 'embeddings':
+        feats = params['rgb_colors'] if dist_to_use == 'rgb' else params['embeddings']
+        feats = torch.nn.functional.normalize(feats.detach(), p=2, dim=1)
+        neighbor_indices, neighbor_dist = rerank_neighbors(
+            neighbor_indices, feats[q_aranged_idx], feats, num_knn, inflate, dist_to_use,
+            max_chunk_elements=rerank_chunk_elements)
+
+    neighbor_weight_sm = torch.nn.functional.softmax(-neighbor_dist, dim=1)
+    neighbor_weight = torch.exp(-2000 * torch.square(neighbor_dist))
+    dist = torch.zeros_like(neighbor_weight)
+
+    new_variables["self_indices"] = q_aranged_idx.unsqueeze(1).tile(num_knn).flatten().to(device)
+    non_neighbor_mask = neighbor_indices.flatten() != -1
+    new_variables["neighbor_indices"] = neighbor_indices.flatten().long().contiguous()[non_neighbor_mask]
+    new_variables["neighbor_weight"] = neighbor_weight.flatten().float().contiguous()[non_neighbor_mask]
+    new_variables["neighbor_weight_sm"] = neighbor_weight_sm.flatten().float().contiguous()[non_neighbor_mask]
+    new_variables["neighbor_dist"] = dist.flatten().float().contiguous()[non_neighbor_mask]
+    new_variables["self_indices"] = new_variables["self_indices"][non_neighbor_mask]
+
+    return new_variables, to_remove
+
+
 def calculate_neighbors_between_pc(
-        params, time_idx, other_params=None, other_time_idx=None, num_knn=20, dist_to_use='rgb', inflate=2, primary_device="cuda:0"):
+        params, time_idx, other_params=None, other_time_idx=None, num_knn=20, dist_to_use='rgb', inflate=2, primary_device="cuda:0",
+        backend="faiss", ann=None, rerank_chunk_elements=2**24):
     embeddings_in_params = 'embeddings' in other_params.keys()
     device = params['means3D'].device
     print(int(primary_device.split(':')[-1]))
@@ -296,35 +1068,20 @@ def calculate_neighbors_between_pc(
 
     # get distances and indices
     neighbor_dist, neighbor_indices = torch_3d_knn(
-        q_pts.contiguous(), k_pts, num_knn=int(inflate*num_knn), gpu_id=int(primary_device.split(':')[-1]))
+        q_pts.contiguous(), k_pts, num_knn=int(inflate*num_knn), gpu_id=int(primary_device.split(':')[-1]),
+        backend=backend, ann=ann)
     # calculate weight of neighbors
     if dist_to_use == 'l2':
         neighbor_dist = neighbor_dist[:, :num_knn]
         neighbor_indices = neighbor_indices[:, :num_knn]
-    elif dist_to_use == 'rgb' or dist_to_use == 'embeddings':
-        # get rbg distance from nearest neighbors in l2
-        q_idx = torch.tile(
-            torch.arange(neighbor_indices.shape[0]).unsqueeze(1),
-            (1, int(inflate*num_knn))).flatten()
-        if dist_to_use == 'rgb':
-            neighbor_dist = torch.cdist(
-                    q_colors.float()[q_idx, :].unsqueeze(1),
-                    k_colors.float()[neighbor_indices.flatten(), :].unsqueeze(1)
-                ).squeeze()
-        else:
-            neighbor_dist = torch.cdist(
-                    q_embeddings.float()[q_idx, :].unsqueeze(1),
-                    k_embeddings.float()[neighbor_indices.flatten(), :].unsqueeze(1)
-                ).squeeze()
-        neighbor_dist = neighbor_dist.reshape(neighbor_indices.shape[0], -1)
-        # sort rgb neighbot distance and re-index to get closest points in 
-        # wrt rgb within closest points in l2
-        neighbor_dist = neighbor_dist.sort(dim=1, descending=False)
-        idx = neighbor_dist.indices[:, :num_knn]
-        q_idx = torch.tile(torch.arange(neighbor_indices.shape[0]).unsqueeze(1), (1, num_knn)).flatten()
-        neighbor_indices = neighbor_indices[
-            q_idx, idx.flatten()].squeeze().reshape(q_colors.shape[0], num_knn)
-        neighbor_dist = neighbor_dist.values[:, :num_knn]
+    elif dist_to_use == 'rgb':
+        neighbor_indices, neighbor_dist = rerank_neighbors(
+            neighbor_indices, q_colors, k_colors, num_knn, inflate, dist_to_use,
+            max_chunk_elements=rerank_chunk_elements, metric='l2')
+    elif dist_to_use == 'embeddings':
+        neighbor_indices, neighbor_dist = rerank_neighbors(
+            neighbor_indices, q_embeddings, k_embeddings, num_knn, inflate, dist_to_use,
+            max_chunk_elements=rerank_chunk_elements, metric='l2')
 
     neighbor_weight_sm = torch.nn.functional.softmax(-torch.atleast_2d(neighbor_dist), dim=1).squeeze()
     neighbor_weight = torch.exp(-2000 * torch.square(neighbor_dist))
@@ -0,0 +1,65 @@
+import torch
+from src.utils.trajectory_store import get_frame, version_key
+
+
+class PrevFrameCache():
+    """
+    State of the previous frame used by every optimizer iteration of a frame
+    (physics based losses, bg regularization, forward propagation), i.e., the
+    means, the inverse (conjugate, not normalized) rotations and the rest
+    offsets along the edges of the neighbor graph. Materialized once on the
+    compute device from the per-frame histories, which may live on the CPU,
+    and reused while the histories, the graph and the time do not change.
+    Has to be invalidated if Gaussians are pruned, densified or added.
+    """
+    def __init__(self, device):
+        self.device = device
+        self.key = None
+        self.offsets_key = None
+        self.cached = None
+        self.means = None
+        self.inv_rots = None
+        self.rest_offsets = None
+        self.num_fills = 0
+        self.num_hits = 0
+
+    def invalidate(self):
+        self.key = None
+        self.offsets_key = None
+        self.cached = None
+        self.means = None
+        self.inv_rots = None
+        self.rest_offsets = None
+
+    def get(self, prev_params, time_idx, graph=None):
+        """
+        Function to get the cache for time_idx holding the previous frame
+        (time_idx - 1) of prev_params, with the rest offsets if graph is given
+        """
+        key = (
+            version_key(prev_params['means3D']),
+            version_key(prev_params['unnorm_rotations']),
+            time_idx)
+        if self.key != key:
+            self.invalidate()
+            with torch.no_grad():
+                self.means = get_frame(
+                    prev_params['means3D'], time_idx - 1).detach().to(self.device).float().contiguous()
+                inv_rots = get_frame(
+                    prev_params['unnorm_rotations'], time_idx - 1).detach().to(self.device).float().clone()
+                inv_rots[:, 1:] = -1 * inv_rots[:, 1:]
+                self.inv_rots = inv_rots
+            # the cached histories are kept alive s.t. their ids are not reused
+            self.cached = (prev_params['means3D'], prev_params['unnorm_rotations'])
+            self.key = key
+            self.num_fills += 1
+        else:
+            self.num_hits += 1
+
+        if graph is not None and self.offsets_key != version_key(graph):
+            with torch.no_grad():
+                self.rest_offsets = self.means.index_select(0, graph.rows) \
+                    - self.means.index_select(0, graph.indices)
+            self.offsets_key = version_key(graph)
+            self.cached = self.cached[:2] + (graph,)
+        return self
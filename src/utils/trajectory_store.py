@@ -0,0 +1,524 @@
+import os
+import numpy as np
+import torch
+
+
+# storage dtypes of closed chunks, uint8 is quantized with a per-frame scale
+STORAGE_DTYPES = {
+    'float32': torch.float32,
+    'float16': torch.float16,
+    'bfloat16': torch.bfloat16,
+    'uint8': torch.uint8}
+
+
+class TrajectoryStore():
+    """
+    Append-only per-frame history of a per-Gaussian quantity, e.g., means3D
+    or unnorm_rotations, split into chunks of chunk_size frames. A chunk
+    only holds the Gaussians that existed while it was written, i.e.,
+    Gaussians born late do not occupy memory for their past. Chunks are laid
+    out as [chunk_size, rows, *channels] s.t. frame slices are contiguous,
+    row_index maps Gaussians to chunk rows (-1 if not in the chunk).
+
+    Reads before the birth of a Gaussian return its birth value, frames that
+    were not written yet return fill_value.
+
+    A chunk is closed, i.e., compacted and read-only, once all of its
+    frames are more than lookback frames older than the last written frame,
+    s.t. the frames the optimization still reads (t-1 and t-2 in the
+    physics based losses and the forward propagation) stay in dtype. If
+    storage_dir is given, closed chunks are written to memory-mapped .npy
+    files, s.t. only the open chunks stay resident.
+
+    Closed chunks are converted to the storage precision (float32, float16,
+    bfloat16 or uint8 for non-negative quantities like visibility) and
+    upcast to dtype on read. The conversion error is accumulated in
+    error_max / error_sum.
+    """
+    def __init__(
+            self,
+            channels,
+            num_frames,
+            chunk_size=16,
+            fill_value=None,
+            storage_dir=None,
+            device='cpu',
+            dtype=torch.float32,
+            storage='float32',
+            lookback=2):
+        if storage not in STORAGE_DTYPES.keys():
+            raise ValueError(f"Unknown trajectory storage precision {storage}, use one of {list(STORAGE_DTYPES.keys())}")
+        self.channels = tuple(channels)
+        self.num_frames = num_frames
+        self.chunk_size = chunk_size
+        self.storage_dir = storage_dir
+        self.device = device
+        self.dtype = dtype
+        self.storage = storage
+        self.lookback = lookback
+        if fill_value is None:
+            fill_value = torch.zeros(self.channels, dtype=dtype)
+        self.fill_value = torch.as_tensor(fill_value, dtype=dtype).to(device)
+
+        self.num_rows = 0
+        self.birth_time = torch.zeros(0, dtype=torch.long, device=device)
+        self.birth_values = torch.zeros((0,) + self.channels, dtype=dtype, device=device)
+        # per chunk the storage, the number of used rows and the row index
+        self.chunks = dict()
+        self.chunk_rows = dict()
+        self.row_index = dict()
+        self.chunk_scales = dict()
+        self.closed = set()
+        self.open_chunk = -1
+        # incremented on every write, like the in-place version of a tensor
+        self.version = 0
+        self.error_max = 0.0
+        self.error_sum = 0.0
+        self.error_count = 0
+
+    @property
+    def shape(self):
+        return (self.num_rows,) + self.channels + (self.num_frames,)
+
+    def __len__(self):
+        return self.num_rows
+
+    @property
+    def nbytes(self):
+        return sum(c.numel() * c.element_size() for c in self.chunks.values()) \
+            + self.birth_values.numel() * self.birth_values.element_size()
+
+    def _encode(self, chunk_idx, chunk):
+        # convert a chunk to the storage precision
+        if self.storage == 'uint8':
+            # per-frame scale s.t. the largest value maps to 255
+            flat = chunk.reshape(chunk.shape[0], -1)
+            if flat.shape[1]:
+                scale = flat.max(dim=1).values.clamp(min=1e-12) / 255
+            else:
+                scale = torch.ones(chunk.shape[0], dtype=self.dtype, device=chunk.device)
+            self.chunk_scales[chunk_idx] = scale
+            scale = scale.view((-1,) + (1,) * (chunk.dim() - 1))
+            return (chunk / scale).round().clamp(0, 255).to(torch.uint8)
+        return chunk.to(STORAGE_DTYPES[self.storage])
+
+    def _decode(self, chunk_idx, values, frame_idx=None):
+        # upcast values of a chunk (all frames or frame_idx) to dtype
+        if values.dtype == self.dtype:
+            return values
+        if self.storage == 'uint8':
+            scale = self.chunk_scales[chunk_idx]
+            if frame_idx is None:
+                scale = scale.view((-1,) + (1,) * (values.dim() - 1))
+            else:
+                scale = scale[frame_idx]
+            return values.to(self.dtype) * scale
+        return values.to(self.dtype)
+
+    @staticmethod
+    def _to_numpy(chunk):
+        # numpy has no bfloat16, bfloat16 chunks are stored bit-wise as int16
+        if chunk.dtype == torch.bfloat16:
+            return chunk.view(torch.int16).numpy()
+        return chunk.numpy()
+
+    def _from_numpy(self, array):
+        chunk = torch.from_numpy(array)
+        if self.storage == 'bfloat16' and chunk.dtype == torch.int16:
+            return chunk.view(torch.bfloat16)
+        return chunk
+
+    def _chunk_path(self, chunk_idx, storage_dir=None, closed=True):
+        storage_dir = self.storage_dir if storage_dir is None else storage_dir
+        return os.path.join(storage_dir, f"{'chunk' if closed else 'open'}_{chunk_idx:05d}.npy")
+
+    def _physical_rows(self, chunk_idx, ids):
+        # chunk rows of the Gaussians ids, -1 if not in the chunk
+        index = self.row_index[chunk_idx]
+        rows = -torch.ones(ids.shape[0], dtype=torch.long, device=self.device)
+        in_index = ids < index.shape[0]
+        rows[in_index] = index[ids[in_index]].long()
+        return rows
+
+    def _grow_chunk(self, chunk_idx, num_rows):
+        # grow chunk to at least num_rows rows, doubling the capacity
+        chunk = self.chunks[chunk_idx]
+        if chunk.shape[1] < num_rows:
+            new_chunk = self.fill_value.expand(
+                (self.chunk_size, max(num_rows, 2 * chunk.shape[1])) + self.channels).clone()
+            new_chunk[:, :chunk.shape[1]] = chunk
+            self.chunks[chunk_idx] = new_chunk
+        return self.chunks[chunk_idx]
+
+    def _get_chunk(self, chunk_idx, num_rows):
+        """
+        Function to get a chunk holding the first num_rows Gaussians. Added
+        Gaussians hold their birth value up to their birth and fill_value
+        afterwards.
+        """
+        if chunk_idx not in self.chunks.keys():
+            self.chunks[chunk_idx] = self.fill_value.expand(
+                (self.chunk_size, max(num_rows, 1)) + self.channels).clone()
+            self.chunk_rows[chunk_idx] = 0
+            self.row_index[chunk_idx] = torch.zeros(0, dtype=torch.int32, device=self.device)
+
+        index = self.row_index[chunk_idx]
+        if index.shape[0] < num_rows:
+            index = torch.cat((index, -torch.ones(
+                num_rows - index.shape[0], dtype=torch.int32, device=self.device)))
+        missing = torch.nonzero(index[:num_rows] < 0).squeeze(1)
+        if missing.shape[0]:
+            first_row = self.chunk_rows[chunk_idx]
+            last_row = first_row + missing.shape[0]
+            chunk = self._grow_chunk(chunk_idx, last_row)
+            frames = torch.arange(self.chunk_size, device=self.device) + chunk_idx * self.chunk_size
+            up_to_birth = frames.unsqueeze(1) <= self.birth_time[missing].unsqueeze(0)
+            chunk[:, first_row:last_row] = torch.where(
+                up_to_birth.view(up_to_birth.shape + (1,) * len(self.channels)),
+                self.birth_values[missing].unsqueeze(0),
+                self.fill_value)
+            index[missing] = torch.arange(first_row, last_row, dtype=torch.int32, device=self.device)
+            self.chunk_rows[chunk_idx] = last_row
+        self.row_index[chunk_idx] = index
+        return self.chunks[chunk_idx]
+
+    def _close_chunk(self, chunk_idx):
+        # compact to the rows of remaining Gaussians and move to disk
+        index = self.row_index[chunk_idx]
+        in_chunk = index >= 0
+        chunk = self.chunks[chunk_idx].index_select(1, index[in_chunk].long())
+        index[in_chunk] = torch.arange(chunk.shape[1], dtype=torch.int32, device=self.device)
+        if self.storage != 'float32':
+            encoded = self._encode(chunk_idx, chunk)
+            error = (self._decode(chunk_idx, encoded) - chunk).abs()
+            if error.numel():
+                self.error_max = max(self.error_max, error.max().item())
+                self.error_sum += error.sum().item()
+                self.error_count += error.numel()
+            chunk = encoded
+        if self.storage_dir is not None:
+            os.makedirs(self.storage_dir, exist_ok=True)
+            array = self._to_numpy(chunk.cpu())
+            mapped = np.lib.format.open_memmap(
+                self._chunk_path(chunk_idx),
+                mode='w+',
+                dtype=array.dtype,
+                shape=tuple(chunk.shape))
+            mapped[:] = array
+            mapped.flush()
+            chunk = self._from_numpy(mapped)
+        self.chunks[chunk_idx] = chunk
+        self.chunk_rows[chunk_idx] = chunk.shape[1]
+        self.closed.add(chunk_idx)
+
+    def _open(self, time_idx):
+        # frames are written in order, chunks whose frames are all older than
+        # the lookback window are closed
+        chunk_idx = time_idx // self.chunk_size
+        if chunk_idx in self.closed:
+            raise ValueError(f"Chunk {chunk_idx} of the trajectory store is closed and read-only.")
+        for c in sorted(self.chunks.keys()):
+            if (c + 1) * self.chunk_size - 1 < time_idx - self.lookback and c not in self.closed:
+                self._close_chunk(c)
+        self.open_chunk = max(self.open_chunk, chunk_idx)
+
+    def append(self, values, time_idx):
+        """
+        Function to add new Gaussians born at time_idx with their birth
+        values. Amortized O(new).
+        """
+        values = values.detach().to(self.device, self.dtype).reshape((-1,) + self.channels)
+        chunk_idx = time_idx // self.chunk_size
+        self._open(time_idx)
+
+        self.birth_time = torch.cat((self.birth_time, torch.full(
+            (values.shape[0],), time_idx, dtype=torch.long, device=self.device)))
+        self.birth_values = torch.cat((self.birth_values, values))
+        self.num_rows += values.shape[0]
+        self._get_chunk(chunk_idx, self.num_rows)
+        self.version += 1
+
+    def set_frame(self, time_idx, values, ids=None):
+        chunk_idx = time_idx // self.chunk_size
+        self._open(time_idx)
+        chunk = self._get_chunk(chunk_idx, self.num_rows)
+        if ids is None:
+            ids = torch.arange(self.num_rows, device=self.device)
+        else:
+            ids = ids.to(self.device)
+            if ids.dtype == torch.bool:
+                ids = torch.nonzero(ids).squeeze(1)
+        rows = self.row_index[chunk_idx][ids].long()
+        chunk[time_idx % self.chunk_size, rows] = \
+            values.detach().to(self.device, self.dtype).reshape((-1,) + self.channels)
+        self.version += 1
+
+    def frame(self, time_idx, ids=None, device=None):
+        """
+        Function to read the values of all or the given Gaussians at time_idx.
+        """
+        chunk_idx = time_idx // self.chunk_size
+        if ids is None:
+            ids = torch.arange(self.num_rows, device=self.device)
+        else:
+            ids = ids.to(self.device)
+            if ids.dtype == torch.bool:
+                ids = torch.nonzero(ids).squeeze(1)
+        values = self.fill_value.expand((ids.shape[0],) + self.channels).clone()
+        pre_birth = self.birth_time[ids] > time_idx
+        values[pre_birth] = self.birth_values[ids[pre_birth]]
+        if chunk_idx in self.chunks.keys():
+            rows = self._physical_rows(chunk_idx, ids)
+            in_chunk = rows >= 0
+            # only touches the pages of the requested rows of mapped chunks
+            values[in_chunk] = self._decode(
+                chunk_idx,
+                self.chunks[chunk_idx][time_idx % self.chunk_size].index_select(0, rows[in_chunk]),
+                time_idx % self.chunk_size)
+        return values if device is None else values.to(device)
+
+    def trajectory(self, ids=None, time_ids=None):
+        """
+        Function to read the trajectories [n, *channels, t] of all or the
+        given Gaussians at all or the given time steps.
+        """
+        if time_ids is None:
+            time_ids = range(self.num_frames)
+        return torch.stack([self.frame(t, ids) for t in time_ids], dim=-1)
+
+    def to_dense(self, compact=False):
+        """
+        Function to get the dense [N, *channels, T] history. If compact, it is
+        returned in the smallest numpy compatible dtype of the storage
+        precision, i.e., float16 for float16 and uint8, e.g., for saving.
+        """
+        dense = self.trajectory()
+        if compact and self.storage in ['float16', 'uint8']:
+            return dense.half()
+        return dense
+
+    def precision_stats(self):
+        """
+        Function to get the error of the storage precision and the memory of
+        the store wrt. a dense float32 history.
+        """
+        return {
+            'storage': self.storage,
+            'max_error': self.error_max,
+            'mean_error': self.error_sum / max(self.error_count, 1),
+            'nbytes': self.nbytes,
+            'dense_nbytes': self.num_rows * int(np.prod(self.channels)) * self.num_frames * 4}
+
+    def keep(self, to_keep):
+        """
+        Function to remove Gaussians, to_keep is a mask over all rows. Only
+        the row indices change, chunk rows of removed Gaussians are dropped
+        when the chunk is closed.
+        """
+        to_keep = to_keep.to(self.device)
+        for c in self.chunks.keys():
+            index = self.row_index[c]
+            self.row_index[c] = index[to_keep[:index.shape[0]]]
+        self.birth_time = self.birth_time[to_keep]
+        self.birth_values = self.birth_values[to_keep]
+        self.num_rows = self.birth_time.shape[0]
+        self.version += 1
+
+    def duplicate(self, ids):
+        """
+        Function to append copies of the given Gaussians including their
+        history, e.g., for cloned Gaussians. Closed chunks share the rows of
+        the source, open chunks get a copy.
+        """
+        ids = ids.to(self.device)
+        for c in self.chunks.keys():
+            index = self.row_index[c]
+            if index.shape[0] < self.num_rows:
+                index = torch.cat((index, -torch.ones(
+                    self.num_rows - index.shape[0], dtype=torch.int32, device=self.device)))
+            new_index = index[ids]
+            if c not in self.closed:
+                in_chunk = new_index >= 0
+                first_row = self.chunk_rows[c]
+                last_row = first_row + int(in_chunk.sum().item())
+                chunk = self._grow_chunk(c, last_row)
+                chunk[:, first_row:last_row] = chunk[:, new_index[in_chunk].long()]
+                new_index[in_chunk] = torch.arange(first_row, last_row, dtype=torch.int32, device=self.device)
+                self.chunk_rows[c] = last_row
+            self.row_index[c] = torch.cat((index, new_index))
+        self.birth_time = torch.cat((self.birth_time, self.birth_time[ids]))
+        self.birth_values = torch.cat((self.birth_values, self.birth_values[ids]))
+        self.num_rows += ids.shape[0]
+        self.version += 1
+
+    def save(self, storage_dir=None):
+        """
+        Function to write the store to storage_dir (default: its own
+        storage_dir). Mapped closed chunks are not copied, open chunks and
+        the row bookkeeping are written next to them. Returns the directory.
+        """
+        storage_dir = self.storage_dir if storage_dir is None else storage_dir
+        os.makedirs(storage_dir, exist_ok=True)
+        chunk_ids = sorted(self.chunks.keys())
+        for c in chunk_ids:
+            closed = c in self.closed
+            if closed and storage_dir == self.storage_dir:
+                continue
+            np.save(
+                self._chunk_path(c, storage_dir, closed),
+                self._to_numpy(self.chunks[c][:, :self.chunk_rows[c]].cpu()))
+        meta = {
+            'channels': np.array(self.channels, dtype=np.int64),
+            'num_frames': np.array(self.num_frames),
+            'chunk_size': np.array(self.chunk_size),
+            'fill_value': self.fill_value.cpu().numpy(),
+            'birth_time': self.birth_time.cpu().numpy(),
+            'birth_values': self.birth_values.cpu().numpy(),
+            'chunk_ids': np.array(chunk_ids, dtype=np.int64),
+            'closed': np.array(sorted(self.closed), dtype=np.int64),
+            'open_chunk': np.array(self.open_chunk),
+            'storage': np.array(self.storage)}
+        for c in chunk_ids:
+            meta[f"row_index_{c}"] = self.row_index[c].cpu().numpy()
+        for c in self.chunk_scales.keys():
+            meta[f"scale_{c}"] = self.chunk_scales[c].cpu().numpy()
+        # replaced at once, s.t. an interrupted save keeps the previous state
+        np.savez(os.path.join(storage_dir, 'meta_tmp.npz'), **meta)
+        os.replace(os.path.join(storage_dir, 'meta_tmp.npz'), os.path.join(storage_dir, 'meta.npz'))
+        return storage_dir
+
+    @classmethod
+    def load(cls, storage_dir):
+        """
+        Function to open a saved store, closed chunks stay memory-mapped.
+        """
+        meta = np.load(os.path.join(storage_dir, 'meta.npz'))
+        birth_values = torch.from_numpy(meta['birth_values'])
+        store = cls(
+            tuple(meta['channels'].tolist()),
+            int(meta['num_frames']),
+            chunk_size=int(meta['chunk_size']),
+            fill_value=torch.from_numpy(meta['fill_value']),
+            storage_dir=storage_dir,
+            dtype=birth_values.dtype,
+            storage=str(meta['storage']) if 'storage' in meta.files else 'float32')
+        store.birth_time = torch.from_numpy(meta['birth_time'])
+        store.birth_values = birth_values
+        store.num_rows = store.birth_time.shape[0]
+        store.closed = set(meta['closed'].tolist())
+        store.open_chunk = int(meta['open_chunk'])
+        for c in meta['chunk_ids'].tolist():
+            if c in store.closed:
+                # copy-on-write mapping, closed chunks are never written
+                chunk = store._from_numpy(np.load(store._chunk_path(c), mmap_mode='c'))
+            else:
+                chunk = torch.from_numpy(np.load(store._chunk_path(c, closed=False)))
+            store.chunks[c] = chunk
+            store.chunk_rows[c] = chunk.shape[1]
+            store.row_index[c] = torch.from_numpy(meta[f"row_index_{c}"])
+            if f"scale_{c}" in meta.files:
+                store.chunk_scales[c] = torch.from_numpy(meta[f"scale_{c}"])
+        return store
+
+    @classmethod
+    def from_dense(cls, dense, birth_time, chunk_size=16, fill_value=None, storage_dir=None, storage='float32'):
+        """
+        Function to create a store from a dense [N, *channels, T] tensor,
+        e.g., when loading a checkpoint. Chunks only hold the Gaussians born
+        up to their last frame, earlier frames read the pre-birth value.
+        """
+        store = cls(
+            dense.shape[1:-1],
+            dense.shape[-1],
+            chunk_size=chunk_size,
+            fill_value=fill_value,
+            storage_dir=storage_dir,
+            device=dense.device,
+            dtype=dense.dtype,
+            storage=storage)
+        birth_time = birth_time.long().to(dense.device).flatten()
+        store.birth_time = birth_time
+        # value of the frame before birth, i.e., the birth position for means3D
+        # and rotations and zero padding for the other histories
+        store.birth_values = dense[
+            torch.arange(dense.shape[0], device=dense.device), ..., (birth_time - 1).clamp(min=0)]
+        store.num_rows = dense.shape[0]
+        for c in range((dense.shape[-1] + chunk_size - 1) // chunk_size):
+            born = torch.nonzero(birth_time < (c + 1) * chunk_size).squeeze(1)
+            frames = dense[born][..., c*chunk_size:(c+1)*chunk_size].movedim(-1, 0)
+            chunk = store.fill_value.expand((chunk_size, born.shape[0]) + store.channels).clone()
+            chunk[:frames.shape[0]] = frames
+            index = -torch.ones(dense.shape[0], dtype=torch.int32, device=dense.device)
+            index[born] = torch.arange(born.shape[0], dtype=torch.int32, device=dense.device)
+            store.chunks[c] = chunk
+            store.chunk_rows[c] = born.shape[0]
+            store.row_index[c] = index
+        return store
+
+
+def get_frame(traj, time_idx, ids=None, device=None):
+    """
+    Function to read a frame of a per-Gaussian history that is either a
+    TrajectoryStore or a dense [N, *channels, T] tensor.
+    """
+    if isinstance(traj, TrajectoryStore):
+        return traj.frame(time_idx, ids, device=device)
+    values = traj[ids][..., time_idx] if ids is not None else traj[..., time_idx]
+    return values if device is None else values.to(device)
+
+
+def set_frame(traj, time_idx, values):
+    if isinstance(traj, TrajectoryStore):
+        traj.set_frame(time_idx, values)
+    else:
+        traj[..., time_idx] = values
+
+
+def version_key(traj):
+    """
+    Function to get the identity and in-place version of a TrajectoryStore,
+    tensor or any object with a version counter (e.g., the neighbor graph)
+    """
+    version = traj._version if isinstance(traj, torch.Tensor) else traj.version
+    return (id(traj), version)
+
+
+def get_trajectory(traj, ids, device=None):
+    """
+    Function to read the trajectories [n, *channels, T] of the given
+    Gaussians of a per-Gaussian history that is either a TrajectoryStore
+    or a dense [N, *channels, T] tensor.
+    """
+    if isinstance(traj, TrajectoryStore):
+        values = traj.trajectory(ids)
+    else:
+        values = traj[ids.to(traj.device)]
+    return values if device is None else values.to(device)
+
+
+def load_trajectory_stores(
+        variables,
+        keys=('means3D', 'unnorm_rotations', 'rgb_colors', 'log_scales', 'visibility'),
+        chunk_size=16,
+        precision=None):
+    """
+    Function to restore the trajectory stores of checkpoint variables, i.e.,
+    open saved stores given by their directory or convert dense histories,
+    the birth times are given by variables['timestep']. precision maps keys
+    to the storage precision of converted histories (default float32).
+    """
+    precision = dict() if precision is None else precision
+    fill_values = {'unnorm_rotations': [1, 0, 0, 0]}
+    for k in keys:
+        if k not in variables.keys():
+            continue
+        if isinstance(variables[k], str):
+            variables[k] = TrajectoryStore.load(variables[k])
+        elif isinstance(variables[k], torch.Tensor):
+            variables[k] = TrajectoryStore.from_dense(
+                variables[k].cpu().float(),
+                variables['timestep'].cpu(),
+                chunk_size=chunk_size,
+                fill_value=fill_values.get(k, None),
+                storage=precision.get(k, 'float32'))
+    return variables
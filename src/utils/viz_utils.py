@@ -35,6 +35,7 @@ import flow_vis
 import glob
 import torch
 import json
+from src.utils.trajectory_store import TrajectoryStore
 
 
 color_map = cm.get_cmap("jet")
@@ -94,7 +95,8 @@ def get_cam_poses(novel_view_mode, dataset, config, num_frames, device, params):
         avg_w2c = params['w2c'] @ torch.linalg.inv(train_c2ws[0])
 
         # zoom out a bit
-        scene_center = params['means3D'][:, :, :].reshape(-1, 3).mean(dim=0)
+        means3D = params['means3D'].to_dense().to(device) if isinstance(params['means3D'], TrajectoryStore) else params['means3D']
+        scene_center = means3D[:, :, :].reshape(-1, 3).mean(dim=0)
         lookat = scene_center - avg_w2c[:3, -1]
         if avg_w2c.sum() == 4:
             if 'DAVIS' in config['data']['basedir']:
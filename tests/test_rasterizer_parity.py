@@ -0,0 +1,40 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import pytest
+
+from src.model.feature_renderer import TorchRasterizer
+from scripts.check_rasterizer_parity import load_fixture, render
+
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'rasterizer_parity_cuda.npz')
+# max abs difference to the CUDA rasterizer, radius in pixels
+TOLERANCES = {
+    'im': 1e-4,
+    'radius': 1,
+    'weight_sum': 1e-4,
+    'means2D_grad': 1e-3}
+
+
+@pytest.fixture(scope='module')
+def parity():
+    if not os.path.isfile(FIXTURE):
+        pytest.skip(
+            f"{FIXTURE} missing, generate it with the CUDA rasterizer: "
+            "python scripts/check_rasterizer_parity.py --device cuda:0 "
+            "--fixture tests/fixtures/rasterizer_parity_cuda.npz --save_fixture")
+    fixture = dict(np.load(FIXTURE))
+    cam, rendervar = load_fixture(fixture, 'cpu')
+    result = render(TorchRasterizer(raster_settings=cam), rendervar)
+    return result, fixture
+
+
+@pytest.mark.parametrize('key', list(TOLERANCES.keys()))
+def test_torch_rasterizer_matches_cuda(parity, key):
+    result, fixture = parity
+    reference = fixture[f"ref_{key}"]
+    assert result[key].shape == reference.shape
+    diff = np.abs(result[key].astype(np.float64) - reference.astype(np.float64)).max()
+    assert diff <= TOLERANCES[key], f"{key}: max abs difference {diff}"
@@ -0,0 +1,124 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import math
+import numpy as np
+import pytest
+import torch
+import torch.nn.functional as F
+
+from src.model.feature_renderer import TorchRasterizer, quat_to_rotmat
+from src.utils.camera_helpers import setup_camera
+
+
+BLOCK_SIZE = 16
+
+
+def make_scene(width, height, means3D, scales, opacities, seed=0):
+    """
+    Gaussians given by their means, scales and opacities in front of an
+    identity camera, rotations and colors fixed by the seed.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    num_gauss = len(means3D)
+    k = torch.tensor([[0.8 * width, 0, width / 2], [0, 0.8 * width, height / 2], [0, 0, 1]])
+    cam = setup_camera(width, height, k, np.eye(4), device='cpu')
+    rendervar = {
+        'means3D': torch.tensor(means3D, dtype=torch.float32),
+        'means2D': torch.zeros((num_gauss, 3), requires_grad=True),
+        'opacities': torch.tensor(opacities, dtype=torch.float32).reshape(-1, 1),
+        'scales': torch.tensor(scales, dtype=torch.float32),
+        'rotations': F.normalize(torch.randn(num_gauss, 4, generator=generator)),
+        'colors_precomp': torch.rand(num_gauss, 3, generator=generator)}
+    return cam, k, rendervar
+
+
+def naive_rasterize(k, width, height, means3D, scales, rotations, opacities, colors):
+    """
+    Per-pixel front-to-back alpha blending as specified by the CUDA
+    rasterizer: pinhole projection of the centers (pixel centers at +0.5),
+    EWA projection of the covariance with 0.3 dilation, 3 sigma radius,
+    Gaussians only touch the 16x16 tiles overlapped by their radius, alpha
+    clamped to 0.99 and skipped below 1/255, blending stops before the
+    transmittance drops below 1e-4. Identity camera, no clamping of the
+    Jacobian, i.e., all Gaussians well inside the field of view.
+    """
+    fx, fy, cx, cy = k[0, 0].item(), k[1, 1].item(), k[0, 2].item(), k[1, 2].item()
+    rot = quat_to_rotmat(rotations).double()
+    gaussians = list()
+    for i in range(means3D.shape[0]):
+        x, y, z = means3D[i].double().tolist()
+        cov3D = rot[i] @ torch.diag(scales[i].double() ** 2) @ rot[i].T
+        jac = torch.tensor([[fx / z, 0, -fx * x / z**2], [0, fy / z, -fy * y / z**2]], dtype=torch.float64)
+        cov2D = jac @ cov3D @ jac.T + 0.3 * torch.eye(2, dtype=torch.float64)
+        a, b, c = cov2D[0, 0].item(), cov2D[0, 1].item(), cov2D[1, 1].item()
+        det = a * c - b * b
+        mid = 0.5 * (a + c)
+        radius = math.ceil(3 * math.sqrt(mid + math.sqrt(max(mid * mid - det, 0.1))))
+        u, v = fx * x / z + cx - 0.5, fy * y / z + cy - 0.5
+        tiles = (
+            math.floor((u - radius) / BLOCK_SIZE), math.floor((v - radius) / BLOCK_SIZE),
+            math.floor((u + radius + BLOCK_SIZE - 1) / BLOCK_SIZE), math.floor((v + radius + BLOCK_SIZE - 1) / BLOCK_SIZE))
+        gaussians.append((z, u, v, (c / det, -b / det, a / det), radius, tiles, i))
+
+    im = np.zeros((3, height, width))
+    weight_sum = np.zeros((height, width))
+    for py in range(height):
+        for px in range(width):
+            transmittance = 1.0
+            for z, u, v, conic, radius, tiles, i in sorted(gaussians):
+                tile_x, tile_y = px // BLOCK_SIZE, py // BLOCK_SIZE
+                if not (tiles[0] <= tile_x < tiles[2] and tiles[1] <= tile_y < tiles[3]):
+                    continue
+                dx, dy = u - px, v - py
+                power = -0.5 * (conic[0] * dx**2 + conic[2] * dy**2) - conic[1] * dx * dy
+                if power > 0:
+                    continue
+                alpha = min(0.99, opacities[i].item() * math.exp(power))
+                if alpha < 1 / 255:
+                    continue
+                if transmittance * (1 - alpha) < 0.0001:
+                    break
+                im[:, py, px] += alpha * transmittance * colors[i].double().numpy()
+                weight_sum[py, px] += alpha * transmittance
+                transmittance *= 1 - alpha
+    radius = np.array([g[4] for g in gaussians])
+    return im, radius, weight_sum
+
+
+def test_torch_rasterizer_matches_naive_blending():
+    # overlapping Gaussians of different size and opacity across 2x2 tiles,
+    # one with opacity above the clamp
+    width, height = 32, 24
+    means3D = [[0.0, 0.0, 3.0], [0.3, -0.1, 3.5], [-0.4, 0.2, 2.5], [0.1, 0.3, 4.0], [-0.2, -0.3, 3.2]]
+    scales = [[0.2, 0.1, 0.1], [0.05, 0.3, 0.1], [0.1, 0.1, 0.2], [0.3, 0.3, 0.05], [0.02, 0.04, 0.03]]
+    opacities = [0.8, 0.6, 0.995, 0.5, 0.9]
+    cam, k, rendervar = make_scene(width, height, means3D, scales, opacities)
+    im, radius, _, weight, _ = TorchRasterizer(raster_settings=cam)(**rendervar)
+    ref_im, ref_radius, ref_weight_sum = naive_rasterize(
+        k, width, height, rendervar['means3D'], rendervar['scales'], rendervar['rotations'],
+        rendervar['opacities'].reshape(-1), rendervar['colors_precomp'])
+
+    assert np.array_equal(radius.numpy(), ref_radius)
+    assert np.abs(im.detach().numpy() - ref_im).max() <= 1e-5
+    assert np.abs(weight.sum(dim=0).detach().numpy() - ref_weight_sum).max() <= 1e-5
+
+
+def test_torch_rasterizer_gradcheck():
+    # broad Gaussians on a single tile, i.e., every pixel is blended with
+    # alpha above 1/255 and below the clamp and the loss is smooth
+    width, height = 16, 16
+    means3D = [[0.0, 0.0, 3.0], [0.2, -0.1, 3.5], [-0.1, 0.15, 4.0]]
+    scales = [[0.6, 0.5, 0.5], [0.7, 0.6, 0.5], [0.8, 0.7, 0.6]]
+    opacities = [0.4, 0.5, 0.6]
+    cam, _, rendervar = make_scene(width, height, means3D, scales, opacities)
+    rasterizer = TorchRasterizer(raster_settings=cam)
+    keys = ['means3D', 'means2D', 'opacities', 'colors_precomp', 'scales', 'rotations']
+    inputs = tuple(rendervar[k].detach().clone().requires_grad_(True) for k in keys)
+
+    def render_im(*inputs):
+        return rasterizer(**dict(zip(keys, inputs)))[0]
+
+    # float32 rasterizer, finite differences with a large step
+    assert torch.autograd.gradcheck(render_im, inputs, eps=1e-3, atol=1e-3, rtol=1e-2)